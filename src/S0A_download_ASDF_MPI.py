@@ -19,7 +19,7 @@ This script:
     1) downloads sesimic data located in a broad region defined by user or using a pre-compiled station list;
     2) cleans up raw traces by removing gaps, instrumental response, downsampling and trimming to a day length;
     3) saves data into ASDF format (see Krischer et al., 2016 for more details on the data structure);
-    4) parallelize the downloading processes with MPI.
+    4) parallelize the downloading processes with MPI, and with a pool of threads sending bulk requests within each rank.
     5) avoids downloading data for stations that already have 1 or 3 channels
 
 Authors: Chengxin Jiang (chengxin_jiang@fas.harvard.edu) 
@@ -27,9 +27,9 @@ Authors: Chengxin Jiang (chengxin_jiang@fas.harvard.edu)
 
 NOTE: 
     0. MOST occasions you just need to change parameters followed with detailed explanations to run the script. 
-    1. to avoid segmentation fault later in cross-correlation calculations due to too large data in memory,
-    a rough estimation of the memory needs is made in the beginning of the code. you can reduce the value of
-    inc_hours if memory on your machine is not enough to load proposed (x) hours of noise data all at once;
+    1. a rough estimation of the memory needs for the later cross-correlation is made in the beginning of the code.
+    when it exceeds MAX_MEM, S1 spills the spectra of each chunk to a scratch file (slower but safe). you can reduce
+    the value of inc_hours if memory on your machine is not enough to load proposed (x) hours of noise data all at once;
     2. if choose to download stations from an existing CSV files, stations with the same name but different
     channel is regarded as different stations (same format as those generated by the S0A);
     3. for unknow reasons, including station location code during feteching process sometime result in no-data.
@@ -48,14 +48,19 @@ tt0=time.time()
 rootpath = './'                                                 # roothpath for the project
 direc  = os.path.join(rootpath,'RAW_DATA')                      # where to store the downloaded data
 dlist  = os.path.join(direc,'station.txt')                      # CSV file for station location info
+inv_file = os.path.join(direc,'inventory.xml')                  # StationXML file keeping the inventories of all stations for later runs (None to keep them in memory only)
 
 # download parameters
 client    = Client('IRIS')                                      # client/data center. see https://docs.obspy.org/packages/obspy.clients.fdsn.html for a list
 down_list = False                                               # download stations from a pre-compiled list or not
 flag      = False                                               # print progress when running the script; recommend to use it at the begining
+nthread   = 4                                                   # number of download requests running at the same time on each rank
+bulk_size = 10                                                  # number of channels in each bulk request
+retries   = 3                                                   # number of times a failed request is tried again (waiting 1,2,4.. s in between)
 samp_freq = 2                                                  # targeted sampling rate at X samples per seconds 
 rm_resp   = 'no'                                                # select 'no' to not remove response and use 'inv','spectrum','RESP', or 'polozeros' to remove response
 respdir   = os.path.join(rootpath,'resp')                       # directory where resp files are located (required if rm_resp is neither 'no' nor 'inv')
+resp_cachedir = None                                            # directory to keep the evaluated responses for later runs (None to only cache them in memory)
 freqmin   = 0.02                                                # pre filtering frequency bandwidth
 freqmax   = 1                                                   # note this cannot exceed Nquist freq                         
 
@@ -73,6 +78,7 @@ ncomp      = len(chan_list)
 cc_len    = 1800                                                # basic unit of data length for fft (s)
 step      = 450                                                 # overlapping between each cc_len (s)
 MAX_MEM   = 5.0                                                 # maximum memory allowed per core in GB
+write_buffer = 0.5                                              # size of cleaned data (GB) buffered before being written to the ASDF file in one batch
 
 ##################################################
 # we expect no parameters need to be changed below
@@ -84,11 +90,15 @@ if flag:
     print('station.list selected [%s] for data from %s to %s with %sh interval'%(down_list,starttime,endtime,inc_hours))
 
 # assemble parameters used for pre-processing
-prepro_para = {'rm_resp':rm_resp,'respdir':respdir,'freqmin':freqmin,'freqmax':freqmax,'samp_freq':samp_freq,'start_date':\
+prepro_para = {'rm_resp':rm_resp,'respdir':respdir,'resp_cachedir':resp_cachedir,'freqmin':freqmin,'freqmax':freqmax,'samp_freq':samp_freq,'start_date':\
     start_date,'end_date':end_date,'inc_hours':inc_hours,'cc_len':cc_len,'step':step,'MAX_MEM':MAX_MEM,'lamin':lamin,\
     'lamax':lamax,'lomin':lomin,'lomax':lomax,'ncomp':ncomp}
 metadata = os.path.join(direc,'download_info.txt') 
 
+# inventories of all stations kept across the chunks (loaded from inv_file when it exists)
+inv_cache = noise_module.InventoryCache(inv_file)
+fill_cache = not len(inv_cache)
+
 # prepare station info (existing station list vs. fetching from client)
 if down_list:
     if not os.path.isfile(dlist):
@@ -127,6 +137,7 @@ else:
                 except Exception as e:
                     print('Abort at L126 in S0A due to '+str(e))
                     sys.exit()
+                if fill_cache:inv_cache.add(inv)
 
                 for K in inv:
                     for tsta in K:
@@ -149,7 +160,7 @@ nseg_chunk = int(np.floor((nsec_chunk-cc_len)/step))+1
 npts_chunk = int(nseg_chunk*cc_len*samp_freq)
 memory_size = nsta*npts_chunk*4/1024**3
 if memory_size > MAX_MEM:
-    raise ValueError('Require %5.3fG memory but only %5.3fG provided)! Reduce inc_hours to avoid this issue!' % (memory_size,MAX_MEM))
+    print('Require %5.3fG memory but only %5.3fG provided! S1 will run out-of-core for each chunk' % (memory_size,MAX_MEM))
 
 
 ########################################################
@@ -188,6 +199,21 @@ splits = comm.bcast(splits,root=0)
 all_chunk  = comm.bcast(all_chunk,root=0)
 extra = splits % size
 
+# threads downloading the data of each rank
+downloader = noise_module.BulkDownloader(client,nthread,bulk_size,retries,inv_cache=inv_cache)
+
+# one bulk request by rank 0 for the inventories of all stations in the list
+if down_list and fill_cache:
+    inv = None
+    if rank == 0:
+        try:
+            inv = downloader.request(client.get_stations_bulk,bulk=[(net[ii],sta[ii],location[ii],'*',starttime,endtime) \
+                for ii in range(nsta)],level='response')
+        except Exception as e:
+            print(e)
+    inv_cache.add(comm.bcast(inv,root=0))
+if rank == 0:inv_cache.save()
+
 # MPI: loop through each time chunk 
 for ick in range(rank,splits,size):
 
@@ -200,10 +226,7 @@ for ick in range(rank,splits,size):
 
     # filename of the ASDF file
     ff=os.path.join(direc,all_chunk[ick]+'T'+all_chunk[ick+1]+'.h5')
-    if not os.path.isfile(ff):
-        with pyasdf.ASDFDataSet(ff,mpi=False,compression="gzip-3",mode='w') as ds:
-            pass
-    else:
+    if os.path.isfile(ff):
         with pyasdf.ASDFDataSet(ff,mpi=False,mode='r') as rds:
             alist = rds.waveforms.list()
             for ista in range(nsta):
@@ -211,37 +234,21 @@ for ick in range(rank,splits,size):
                 if tname in alist:
                     num_records[ista] = len(rds.waveforms[tname].get_waveform_tags())
 
-    # appending when file exists
-    with pyasdf.ASDFDataSet(ff,mpi=False,compression="gzip-3",mode='a') as ds:
-
-        # loop through each channel
-        for ista in range(nsta):
+    # buffer the cleaned data of the chunk and write them in batches (appending when file exists)
+    with noise_module.ChunkWriter(ff,int(write_buffer*1024**3),compression="gzip-3") as ds:
 
-            # continue when there are alreay data for sta A at day X
-            if num_records[ista] == ncomp:
-                continue
+        # channels without data for the chunk yet
+        requests = [(ista,net[ista],sta[ista],location[ista],chan[ista]) for ista in range(nsta) if num_records[ista] != ncomp]
 
-            # get inventory for specific station
-            try:
-                sta_inv = client.get_stations(network=net[ista],station=sta[ista],\
-                    location=location[ista],starttime=s1,endtime=s2,level="response")
-            except Exception as e:
-                print(e);continue
+        # download in bulk by the thread pool while cleaning the channels downloaded already
+        t0=time.time()
+        for ista,sta_inv,tr in downloader.fetch(requests,s1,s2):
+            t1=time.time()
 
             # add the inventory for all components + all time of this tation         
-            try:
-                ds.add_stationxml(sta_inv) 
-            except Exception: 
-                pass   
-
-            try:
-                # get data
-                t0=time.time()
-                tr = client.get_waveforms(network=net[ista],station=sta[ista],\
-                    channel=chan[ista],location=location[ista],starttime=s1,endtime=s2)
-                t1=time.time()
-            except Exception as e:
-                print(e,'for',sta[ista]);continue
+            if sta_inv is None:continue
+            ds.add_stationxml(sta_inv) 
+            if tr is None:continue
                 
             # preprocess to clean data  
             print(sta[ista])
@@ -255,10 +262,14 @@ for ick in range(rank,splits,size):
                     tlocation = location[ista]
                 new_tags = '{0:s}_{1:s}'.format(chan[ista].lower(),tlocation.lower())
                 ds.add_waveforms(tr,tag=new_tags)
+                noise_module.write_gaps(ds,tr,new_tags)
 
             if flag:
-                print(ds,new_tags);print('downloading data %6.2f s; pre-process %6.2f s' % ((t1-t0),(t2-t1)))
+                print(ds,new_tags);print('waiting for data %6.2f s; pre-process %6.2f s' % ((t1-t0),(t2-t1)))
+            t0=time.time()
 
+downloader.close()
+if rank == 0:inv_cache.save()
 tt1=time.time()
 print('downloading step takes %6.2f s' %(tt1-tt0))
 
@@ -3,7 +3,6 @@ import glob
 import os,gc
 import obspy
 import time
-import pyasdf
 import numpy as np
 import noise_module
 import pandas as pd
@@ -29,6 +28,8 @@ NOTE:
     significaly slows down the code, particuarly for data of a big station list. we recommend to prepare a csv file (L48) that contains 
     all sac/mseed file names with full path and their associated starttime/endtime info if possible. based on tests, this improves the
     efficiency of the code by 2-3 orders of magnitude.
+    4. The csv file (wiki_file) is now made and kept up to date by the script: only the file headers are read, the files are 
+    shared by all MPI ranks, and only new or changed files (size or modification time) are scanned again in later runs.
 '''
 
 #######################################################
@@ -52,12 +53,13 @@ samp_freq = 10                                                          # target
 stationxml= False                                                       # station.XML file exists or not
 rm_resp   = 'no'                                                        # select 'no' to not remove response and use 'inv','spectrum','RESP', or 'polozeros' to remove response
 respdir   = os.path.join(rootpath,'resp')                               # directory where resp files are located (required if rm_resp is neither 'no' nor 'inv')
+resp_cachedir = None                                                    # directory to keep the evaluated responses for later runs (None to only cache them in memory)
 freqmin   = 0.02                                                        # pre filtering frequency bandwidth
 freqmax   = 4                                                           # note this cannot exceed Nquist freq
 flag      = False                                                       # print intermediate variables and computing time
 
-# having this file saves a tons of time: see L95-126 for why
-wiki_file = os.path.join(rootpath,'allfiles_time.txt')                  # file containing the path+name for all sac/mseed files and its start-end time      
+# having this file saves a tons of time: only new or changed files are scanned again when it exists
+wiki_file = os.path.join(rootpath,'allfiles_time.txt')                  # file index with the path+name, station info, start-end time, size and mtime of all sac/mseed files      
 allfiles_path = os.path.join(RAWDATA,'*/*'+input_fmt)                   # make sure all sac/mseed files can be found through this format
 messydata = False                                                       # set this to False when daily noise data is well sorted 
 
@@ -70,13 +72,14 @@ inc_hours  = 8                                                          # sac/ms
 cc_len    = 1800                                                        # basic unit of data length for fft (s)
 step      = 450                                                         # overlapping between each cc_len (s)
 MAX_MEM   = 4.0                                                         # maximum memory allowed per core in GB
+write_buffer = 0.5                                                      # size of cleaned data (GB) buffered before being written to the ASDF file in one batch
 
 ##################################################
 # we expect no parameters need to be changed below
 
 # assemble parameters for data pre-processing
 prepro_para = {'RAWDATA':RAWDATA,'wiki_file':wiki_file,'messydata':messydata,'input_fmt':input_fmt,'stationxml':stationxml,\
-    'rm_resp':rm_resp,'respdir':respdir,'freqmin':freqmin,'freqmax':freqmax,'samp_freq':samp_freq,'inc_hours':inc_hours,\
+    'rm_resp':rm_resp,'respdir':respdir,'resp_cachedir':resp_cachedir,'freqmin':freqmin,'freqmax':freqmax,'samp_freq':samp_freq,'inc_hours':inc_hours,\
     'start_date':start_date,'end_date':end_date,'allfiles_path':allfiles_path,'cc_len':cc_len,'step':step,'MAX_MEM':MAX_MEM}
 metadata = os.path.join(DATADIR,'download_info.txt') 
 
@@ -99,10 +102,6 @@ if rank == 0:
     fout = open(metadata,'w')
     fout.write(str(prepro_para));fout.close()
 
-    # assemble timestamp info
-    allfiles = glob.glob(allfiles_path)
-    all_stimes = noise_module.make_timestamps(prepro_para)
-
     # all time chunk for output: loop for MPI
     all_chunk = noise_module.get_event_list(start_date[0],end_date[0],inc_hours)   
     splits     = len(all_chunk)-1
@@ -114,15 +113,25 @@ if rank == 0:
     npts_chunk = int(nseg_chunk*cc_len*samp_freq)
     memory_size = nsta*npts_chunk*4/1024**3
     if memory_size > MAX_MEM:
-        raise ValueError('Require %5.3fG memory but only %5.3fG provided)! Reduce inc_hours to avoid this issue!' % (memory_size,MAX_MEM))
+        print('Require %5.3fG memory but only %5.3fG provided! S1 will run out-of-core for each chunk' % (memory_size,MAX_MEM))
 else:
-    splits,all_chunk,all_stimes,allfiles = [None for _ in range(4)]
+    splits,all_chunk = [None for _ in range(2)]
 
 # broadcast the variables
 splits     = comm.bcast(splits,root=0)
 all_chunk = comm.bcast(all_chunk,root=0)
-all_stimes = comm.bcast(all_stimes,root=0)
-allfiles   = comm.bcast(allfiles,root=0)
+
+# assemble timestamp info: the headers of new/changed files are read by all ranks and the index is kept in wiki_file
+findex     = noise_module.make_file_index(prepro_para,comm)
+file_index = noise_module.FileIndex(findex)
+
+# inventories of the StationXML files read once for all chunks
+inv_cache = None
+if stationxml:
+    inv_cache = noise_module.InventoryCache()
+    for invfile in glob.glob(os.path.join(respdir,'*')):
+        try:inv_cache.add(obspy.read_inventory(invfile))
+        except Exception as e:print(e,'for',invfile)
 
 # MPI: loop through each time-chunk
 for ick in range(rank,splits,size):
@@ -135,72 +144,58 @@ for ick in range(rank,splits,size):
     time1=s1-obspy.UTCDateTime(1970,1,1)
     time2=s2-obspy.UTCDateTime(1970,1,1) 
 
-    # find all data pieces having data of the time-chunk
-    indx1 = np.where((time1>=all_stimes[:,0]) & (time1<all_stimes[:,1]))[0]
-    indx2 = np.where((time2>all_stimes[:,0]) & (time2<=all_stimes[:,1]))[0]
-    indx3 = np.concatenate((indx1,indx2))
-    indx  = np.unique(indx3)
-    if not len(indx): print('continue! no data found between %s-%s'%(s1,s2));continue
-
-    # trim down the sac/mseed file list with time in time-chunk
-    tfiles = []
-    for ii in indx:
-        tfiles.append(allfiles[ii])
-
-    # loop through station
-    nsta = len(locs)
-    for ista in range(nsta):
-
-        # the station info:
-        station = locs.iloc[ista]['station']
-        network = locs.iloc[ista]['network']
-        comp    = locs.iloc[ista]['channel']
-        if flag: print("working on station %s channel %s" % (station,comp)) 
-
-        # norrow down file list by using sta/net info in the file name
-        ttfiles  = [ifile for ifile in tfiles if station in ifile] 
-        if not len(ttfiles): continue 
-        tttfiles = [ifile for ifile in ttfiles if comp in ifile]
-        if not len(tttfiles): continue
-
-        source = obspy.Stream()
-        for ifile in tttfiles:
-            try:
-                tr = obspy.read(ifile)
-                for ttr in tr:
-                    source.append(ttr)
-            except Exception as inst:
-                print(inst);continue
+    # check whether any data pieces overlap the time-chunk
+    if not file_index.has_data(time1,time2): print('continue! no data found between %s-%s'%(s1,s2));continue
+
+    # the cleaned data of the chunk are buffered and written into its ASDF file in batches
+    ff=os.path.join(DATADIR,all_chunk[ick]+'T'+all_chunk[ick+1]+'.h5')
+    with noise_module.ChunkWriter(ff,int(write_buffer*1024**3),compression="gzip-3") as ds:
+
+        # loop through station
+        nsta = len(locs)
+        for ista in range(nsta):
+
+            # the station info:
+            station = locs.iloc[ista]['station']
+            network = locs.iloc[ista]['network']
+            comp    = locs.iloc[ista]['channel']
+            if flag: print("working on station %s channel %s" % (station,comp)) 
+
+            # files of the station/channel overlapping the time-chunk
+            tttfiles = file_index.query(network,station,comp,time1,time2)
+            if not len(tttfiles): continue
+
+            source = obspy.Stream()
+            for ifile in tttfiles:
+                try:
+                    tr = obspy.read(ifile)
+                    for ttr in tr:
+                        source.append(ttr)
+                except Exception as inst:
+                    print(inst);continue
         
-        # jump if no good data left
-        if not len(source):continue
-
-        # make inventory to save into ASDF file
-        t1=time.time()
-        inv1   = noise_module.stats2inv(source[0].stats,prepro_para,locs=locs)      
-        tr = noise_module.preprocess_raw(source,inv1,prepro_para,date_info)
-        if np.all(tr[0].data==0):continue
-        t2 = time.time()
-        if flag:print('pre-processing takes %6.2fs'%(t2-t1))
-
-        # jump if no good data left
-        if not len(tr):continue
-
-        # ready for output
-        ff=os.path.join(DATADIR,all_chunk[ick]+'T'+all_chunk[ick+1]+'.h5')
-        if not os.path.isfile(ff):
-            with pyasdf.ASDFDataSet(ff,mpi=False,compression="gzip-3",mode='w') as ds:
-                pass
-
-        with pyasdf.ASDFDataSet(ff,mpi=False,compression="gzip-3",mode='a') as ds:
-            # add the inventory for all components + all time of this tation         
-            try:ds.add_stationxml(inv1) 
-            except Exception: pass 
+            # jump if no good data left
+            if not len(source):continue
+
+            # make inventory to save into ASDF file
+            t1=time.time()
+            inv1   = noise_module.stats2inv(source[0].stats,prepro_para,locs=locs,inv_cache=inv_cache)      
+            tr = noise_module.preprocess_raw(source,inv1,prepro_para,date_info)
+            if np.all(tr[0].data==0):continue
+            t2 = time.time()
+            if flag:print('pre-processing takes %6.2fs'%(t2-t1))
+
+            # jump if no good data left
+            if not len(tr):continue
+
+            # ready for output: add the inventory for all components + all time of this tation
+            ds.add_stationxml(inv1)
 
             tlocation = str('00')        
             new_tags = '{0:s}_{1:s}'.format(comp.lower(),tlocation.lower())
             ds.add_waveforms(tr,tag=new_tags)     
-    
+            noise_module.write_gaps(ds,tr,new_tags)
+
     t3=time.time()
     print('it takes '+str(t3-t0)+' s to process '+str(inc_hours)+'h length in step 0B')
 
@@ -1,9 +1,8 @@
 import gc
 import sys
 import time
+import resource
 import scipy
-import obspy
-import pyasdf
 import datetime
 import os, glob
 import numpy as np
@@ -24,7 +23,11 @@ This main script of NoisePy:
     general pre-processing (trend, normalization) and then do FFT;
     2) save all FFT data of the same time chunk in memory;
     3) performs cross-correlation for all station pairs in the same time chunk and output the sub-stacked (if 
-    selected) into ASDF format;
+    selected) into ASDF format. the station pairs are correlated in tiles of stations (sized by MAX_MEM) with 
+    one vectorized pass per tile. when the spectra of a chunk exceed MAX_MEM, they are spilled to a memory-mapped
+    scratch file and only the tiles are loaded in memory (out-of-core mode);
+    4) with more MPI ranks than time chunks, a group of ranks works on each chunk: they split the FFT of the stations,
+    broadcast the spectra to each other and split the blocks of source/receiver tiles (set by nrank_chunk);
 
 Authors: Chengxin Jiang (chengxin_jiang@fas.harvard.edu)
          Marine Denolle (mdenolle@fas.harvard.edu)
@@ -57,6 +60,9 @@ input_fmt   = 'asdf'                                                        # st
 to_whiten   = 'no'                                                          # 'no' for no whitening, or 'running_mean', 'one_bit' for normalization
 time_norm   = 'no'                                                         # 'no' for no normalization, or 'running_mean', 'one_bit' for normalization
 cc_method   = 'coherency'                                                   # select between 'raw', 'deconv' and 'coherency'
+real_fft    = True                                                          # use rfft/irfft on the one-sided spectrum (half of the fft work of the complex fft)
+band_limit  = False                                                         # only keep/correlate spectra in [freqmin,freqmax] plus tapers (exact when whitening, saves memory for large samp_freq)
+fft_workers = 1                                                             # number of threads for the (single precision) FFTs of each MPI rank
 flag        = False                                                         # print intermediate variables and computing time for debugging purpose
 acorr_only  = False                                                         # only perform auto-correlation 
 xcorr_only  = False                                                         # only perform cross-correlation or not
@@ -78,12 +84,24 @@ substack       = True                                                       # su
 substack_len   = cc_len                                                     # how long to stack over: need to be multiples of cc_len
 smoothspect_N  = 10                                                         # moving window length to smooth spectrum amplitude (points)
 
+# station-pair selection by inter-station distance/azimuth (pairs out of range are skipped before cross-correlation)
+min_dist  = 0                                                               # min inter-station distance (km)
+max_dist  = None                                                            # max inter-station distance (km): None for no limit
+azi_range = None                                                            # [min,max] azimuth sector of the station pairs (degree, either direction): None for all
+nneighbor = None                                                            # only correlate each station with its nneighbor nearest stations: None for all
+
 # criteria for data selection
 max_over_std = 10                                                           # threahold to remove window of bad signals
 max_kurtosis = 10                                                           # max kurtosis allowed, TO BE ADDED!
+max_gap      = 0                                                            # max fraction of a window in data gaps (recorded in S0A/S0B) to be kept
 
 # maximum memory allowed per core in GB
 MAX_MEM = 4.0
+scratch_dir = CCFDIR                                                        # dir for the memory-mapped spectra when a chunk needs more than MAX_MEM
+write_buffer = 0.1                                                          # size of cc data (GB) buffered before being written to the ASDF file
+output_fmt   = 'asdf'                                                       # 'asdf' (one dataset per station pair and component) or 'columnar' (one 2D dataset per component for all pairs)
+prefetch     = True                                                         # read the next time chunk in the background while correlating the current one (when it fits in MAX_MEM)
+nrank_chunk  = 0                                                            # number of ranks sharing one time chunk (0 to set it from the number of ranks and chunks)
 
 # load useful download info if start from ASDF
 if input_fmt == 'asdf':
@@ -113,8 +131,10 @@ fc_para={'samp_freq':samp_freq,'dt':dt,'cc_len':cc_len,'step':step,'freqmin':fre
     'to_whiten':to_whiten,'time_norm':time_norm,'cc_method':cc_method,'smooth_N':smooth_N,'data_format':\
     input_fmt,'rootpath':rootpath,'CCFDIR':CCFDIR,'start_date':start_date[0],'end_date':end_date[0],\
     'inc_hours':inc_hours,'substack':substack,'substack_len':substack_len,'smoothspect_N':smoothspect_N,\
-    'maxlag':maxlag,'max_over_std':max_over_std,'max_kurtosis':max_kurtosis,'MAX_MEM':MAX_MEM,'ncomp':ncomp,\
-    'stationxml':stationxml,'rm_resp':rm_resp,'respdir':respdir}
+    'maxlag':maxlag,'max_over_std':max_over_std,'max_kurtosis':max_kurtosis,'max_gap':max_gap,'MAX_MEM':MAX_MEM,'ncomp':ncomp,\
+    'stationxml':stationxml,'rm_resp':rm_resp,'respdir':respdir,'real_fft':real_fft,\
+    'fft_workers':fft_workers,'band_limit':band_limit,'output_fmt':output_fmt,'pair_para':{'min_dist':min_dist,'max_dist':max_dist,'azi_range':azi_range,\
+    'nneighbor':nneighbor}}
 # save fft metadata for future reference
 fc_metadata  = os.path.join(CCFDIR,'fft_cc_data.txt')       
 
@@ -160,171 +180,263 @@ splits = comm.bcast(splits,root=0)
 tdir  = comm.bcast(tdir,root=0)
 if input_fmt != 'asdf': nsta = comm.bcast(nsta,root=0)
 
+# 2-D decomposition: the ranks are split into groups looping over the time chunks. ranks in one group
+# share the FFT of the chunk and split its station-pair blocks, so more ranks than chunks can be used
+if nrank_chunk<=0:nrank_chunk = np.maximum(size//splits,1)
+nrank_chunk = int(np.minimum(nrank_chunk,size))
+ngroup = size//nrank_chunk
+color  = int(np.minimum(rank//nrank_chunk,ngroup-1))
+gcomm  = comm.Split(color,rank)
+grank  = gcomm.Get_rank()
+gsize  = gcomm.Get_size()
+if rank==0 and nrank_chunk>1:print('%d ranks on %d chunks: %d ranks for each chunk'%(size,splits,nrank_chunk))
+
+# the tempory files recording cc process of each chunk
+if input_fmt == 'asdf':
+    tmpfiles = [os.path.join(CCFDIR,tfile.split('/')[-1].split('.')[0]+'.tmp') for tfile in tdir]
+else:
+    tmpfiles = [os.path.join(CCFDIR,tfile.split('/')[-1]+'.tmp') for tfile in tdir]
+
+# the traces of the next chunk are read in the background during the cross-correlation of the current one
+prefetcher = noise_module.ChunkPrefetcher(fc_para)
+
 # MPI loop: loop through each user-defined time chunk
-for ick in range (rank,splits,size):
+for ick in range (color,splits,ngroup):
     t10=time.time()   
 
     #############LOADING NOISE DATA AND DO FFT##################
 
-    # get the tempory file recording cc process
+    # get the output file for the chunk
+    tmpfile = tmpfiles[ick]
     if input_fmt == 'asdf':
-        tmpfile = os.path.join(CCFDIR,tdir[ick].split('/')[-1].split('.')[0]+'.tmp')
+        tname = tdir[ick].split('/')[-1]
     else: 
-        tmpfile = os.path.join(CCFDIR,tdir[ick].split('/')[-1]+'.tmp')
+        tname = tdir[ick].split('/')[-1]+'.h5'
+    cc_h5 = os.path.join(CCFDIR,tname)
     
     # check whether time chunk been processed or not
-    if os.path.isfile(tmpfile):
-        ftemp = open(tmpfile,'r')
-        alines = ftemp.readlines()
-        if len(alines) and alines[-1] == 'done':
-            continue
-        else:
-            ftemp.close()
-            os.remove(tmpfile)
+    chunk_done = False
+    if grank==0:chunk_done = noise_module.cc_chunk_done(tmpfile)
+    if gcomm.bcast(chunk_done,root=0):continue
     
-    # retrive station information
+    # retrive station information (and the traces of the stations for this rank of the group): the station 
+    # pairs are selected by distance/azimuth from the coordinates first and stations in no pair are not read
+    t_read0,t_wait0 = prefetcher.t_read,prefetcher.t_wait
+    sta_list,sta_pairs,traces = prefetcher.get(tdir[ick],grank,gsize)
     if input_fmt == 'asdf':
-        ds=pyasdf.ASDFDataSet(tdir[ick],mpi=False,mode='r') 
-        sta_list = ds.waveforms.list()
         nsta=ncomp*len(sta_list)
         print('found %d stations in total'%nsta)
-    else:
-        sta_list = sorted(glob.glob(os.path.join(tdir[ick],'*'+input_fmt)))
     if (len(sta_list)==0):
         print('continue! no data in %s'%tdir[ick]);continue
 
-    # crude estimation on memory needs (assume float32)
+    # frequency bins kept in memory for each segment
+    nnfft = int(next_fast_len(int(cc_len*samp_freq)))
+    if band_limit:
+        flow,_,_,fhigh = noise_module.freq_band_index(fc_para,nnfft)
+    else: flow,fhigh = 0,nnfft//2
+    nfreq = fhigh-flow
+
+    # crude estimation on memory needs (complex64 spectra plus float32 smoothed amplitudes for coherency/deconv)
     nsec_chunk = inc_hours/24*86400
     nseg_chunk = int(np.floor((nsec_chunk-cc_len)/step))
-    npts_chunk = int(nseg_chunk*cc_len*samp_freq)
-    memory_size = nsta*npts_chunk*4/1024**3
-    if memory_size > MAX_MEM:
-        raise ValueError('Require %5.3fG memory but only %5.3fG provided)! Reduce inc_hours to avoid this issue!' % (memory_size,MAX_MEM))
-
-    nnfft = int(next_fast_len(int(cc_len*samp_freq)))
-    # open array to store fft data/info in memory
-    fft_array = np.zeros((nsta,nseg_chunk*(nnfft//2)),dtype=np.complex64)
+    memory_size = nsta*nseg_chunk*nfreq*(12 if cc_method != 'raw' else 8)/1024**3
+    out_of_core = memory_size > MAX_MEM
+    if out_of_core:
+        print('Require %5.3fG memory but only %5.3fG provided! switch to out-of-core mode' % (memory_size,MAX_MEM))
+        fft_file = os.path.join(scratch_dir,tdir[ick].split('/')[-1].split('.')[0]+'.fft')
+        if gsize>1:fft_file += str(grank)
+
+    # open array to store fft data/info in memory (or in a memory-mapped file)
+    if out_of_core:
+        fft_array = np.memmap(fft_file,dtype=np.complex64,mode='w+',shape=(nsta,nseg_chunk*nfreq))
+    else:
+        fft_array = np.zeros((nsta,nseg_chunk*nfreq),dtype=np.complex64)
     fft_std   = np.zeros((nsta,nseg_chunk),dtype=np.float32)
     fft_flag  = np.zeros(nsta,dtype=np.int16)
     fft_time  = np.zeros((nsta,nseg_chunk),dtype=np.float64) 
+    # smoothed amplitude spectra for coherency/deconv: computed once per station instead of once per pair
+    if cc_method != 'raw' and out_of_core:
+        fft_norm = np.memmap(fft_file+'_norm',dtype=np.float32,mode='w+',shape=(nsta,nseg_chunk*nfreq))
+    elif cc_method != 'raw':
+        fft_norm = np.zeros((nsta,nseg_chunk*nfreq),dtype=np.float32)
+    else: fft_norm = np.zeros((nsta,0),dtype=np.float32)
     # station information (for every channel)
     station=[];network=[];channel=[];clon=[];clat=[];location=[];elevation=[]     
 
-    # loop through all stations
-    iii = 0
-    for ista in range(len(sta_list)):
-        tmps = sta_list[ista]
-
-        if input_fmt == 'asdf':
-            # get station and inventory
-            try:
-                inv1 = ds.waveforms[tmps]['StationXML']
-            except Exception as e:
-                print('abort! no stationxml for %s in file %s'%(tmps,tdir[ick]))
-                continue
-            sta,net,lon,lat,elv,loc = noise_module.sta_info_from_inv(inv1)
-
-            # get days information: works better than just list the tags 
-            all_tags = ds.waveforms[tmps].get_waveform_tags()
-            if len(all_tags)==0:continue
-            
-        else: # get station information
-            all_tags = [1]
-            sta = tmps.split('/')[-1]
-
-        #----loop through each stream----
-        for itag in range(len(all_tags)):
-            if flag:print("working on station %s and trace %s" % (sta,all_tags[itag]))
-
-            # read waveform data
-            if input_fmt == 'asdf':
-                source = ds.waveforms[tmps][all_tags[itag]]
-            else:
-                source = obspy.read(tmps)
-                inv1   = noise_module.stats2inv(source[0].stats,fc_para)
-                sta,net,lon,lat,elv,loc = noise_module.sta_info_from_inv(inv1)
-
-            comp = source[0].stats.channel
-            if comp[-1] =='U': comp.replace('U','Z')
-            if len(source)==0:continue
-
-            # cut daily-long data into smaller segments (dataS always in 2D)
-            trace_stdS,dataS_t,dataS = noise_module.cut_trace_make_statis(fc_para,source)        # optimized version:3-4 times faster
-            if not len(dataS): continue
-            N = dataS.shape[0]
-
-            # do normalization if needed
-            source_white = noise_module.noise_processing(fc_para,dataS)
-            Nfft = source_white.shape[1];Nfft2 = Nfft//2
-            if flag:print('N and Nfft are %d (proposed %d),%d (proposed %d)' %(N,nseg_chunk,Nfft,nnfft))
-
-            # keep track of station info to write into parameter section of ASDF files
-            station.append(sta);network.append(net);channel.append(comp),clon.append(lon)
-            clat.append(lat);location.append(loc);elevation.append(elv)
-
-            # load fft data in memory for cross-correlations
-            data = source_white[:,:Nfft2]
-            fft_array[iii] = data.reshape(data.size)
-            fft_std[iii]   = trace_stdS
-            fft_flag[iii]  = 1
-            fft_time[iii]  = dataS_t
-            iii+=1
-            del trace_stdS,dataS_t,dataS,source_white,data
-    
-    if input_fmt == 'asdf': del ds
+    # loop through all stations (or the part of the stations for this rank of the group)
+    iii = 0;dataS_buf = None;raw_bytes = 0
+    for tmps,inv1,tag,source,gaps in traces:
+        sta,net,lon,lat,elv,loc = noise_module.sta_info_from_inv(inv1)
+        if flag:print("working on station %s and trace %s" % (sta,tag))
+        raw_bytes += np.sum([tr.data.nbytes for tr in source])
+
+        comp = source[0].stats.channel
+        if comp[-1] =='U': comp.replace('U','Z')
+        if len(source)==0:continue
+
+        # cut daily-long data into smaller segments (dataS always in 2D)
+        trace_stdS,dataS_t,dataS = noise_module.cut_trace_make_statis(fc_para,source,dataS_buf)   # segments are copied into the reused buffer
+        if not len(dataS): continue
+        dataS_buf = dataS
+        N = dataS.shape[0]
+
+        # windows in data gaps are removed from the cross-correlation like bad windows
+        trace_stdS[noise_module.segment_gaps(gaps,dataS_t,cc_len)>fc_para['max_gap']] = np.nan
+
+        # do normalization if needed
+        source_white = noise_module.noise_processing(fc_para,dataS)
+        Nfft = int(next_fast_len(int(dataS.shape[1])));Nfft2 = Nfft//2
+        if flag:print('N and Nfft are %d (proposed %d),%d (proposed %d)' %(N,nseg_chunk,Nfft,nnfft))
+
+        # keep track of station info to write into parameter section of ASDF files
+        station.append(sta);network.append(net);channel.append(comp),clon.append(lon)
+        clat.append(lat);location.append(loc);elevation.append(elv)
+
+        # load fft data in memory for cross-correlations (smoothing done on the whole spectrum)
+        data = np.complex64(source_white[:,:Nfft2])
+        if cc_method != 'raw':
+            temp = noise_module.smooth_spect(fc_para,data.reshape(data.size)).reshape(N,Nfft2)
+            fft_norm[iii] = temp[:,flow:fhigh].reshape(N*nfreq)
+        data = data[:,flow:fhigh]
+        fft_array[iii] = data.reshape(data.size)
+        fft_std[iii]   = trace_stdS
+        fft_flag[iii]  = 1
+        fft_time[iii]  = dataS_t
+        iii+=1
+        del trace_stdS,dataS_t,dataS,source_white,data
+    traces = [];source = []
+    if flag:print('reading the chunk takes %6.2fs, waiting for it %6.2fs' % (prefetcher.t_read-t_read0,prefetcher.t_wait-t_wait0))
+
+    # share the spectra and station info with all ranks of the group (same order as one rank)
+    if gsize>1:
+        iii = noise_module.bcast_rows(gcomm,[fft_array,fft_norm,fft_std,fft_flag,fft_time],iii)
+        station   = sum(gcomm.allgather(station),[]);network   = sum(gcomm.allgather(network),[])
+        channel   = sum(gcomm.allgather(channel),[]);clon      = sum(gcomm.allgather(clon),[])
+        clat      = sum(gcomm.allgather(clat),[]);location  = sum(gcomm.allgather(location),[])
+        elevation = sum(gcomm.allgather(elevation),[])
+        N = nseg_chunk;Nfft = nnfft
 
     # check whether array size is enough
-    if iii!=nsta:
+    if iii!=nsta and grank==0:
         print('it seems some stations miss data in download step, but it is OKAY!')
 
     #############PERFORM CROSS-CORRELATION##################
-    ftmp = open(tmpfile,'w')
-    # make cross-correlations 
-    for iiS in range(iii):
-        fft1 = fft_array[iiS]
-        source_std = fft_std[iiS]
-        sou_ind = np.where((source_std<fc_para['max_over_std'])&(source_std>0)&(np.isnan(source_std)==0))[0]
-        if not fft_flag[iiS] or not len(sou_ind): continue
-                
-        t0=time.time()
-        #-----------get the smoothed source spectrum for decon later----------
-        sfft1 = noise_module.smooth_source_spect(fc_para,fft1)
-        sfft1 = sfft1.reshape(N,Nfft2)
-        t1=time.time()
-        if flag: 
-            print('smoothing source takes %6.4fs' % (t1-t0))
-
-        # get index right for auto/cross correlation
-        istart=iiS;iend=iii
-        if acorr_only:iend=np.minimum(iiS+3,iii)
-        if xcorr_only:istart=np.minimum(iiS+ncomp,iii)
-
-        #-----------now loop III for each receiver B----------
-        for iiR in range(istart,iend):
-            if flag:print('receiver: %s %s' % (station[iiR],network[iiR]))
-            if not fft_flag[iiR]: continue
-                
-            fft2 = fft_array[iiR];sfft2 = fft2.reshape(N,Nfft2)
-            receiver_std = fft_std[iiR]
-
-            #---------- check the existence of earthquakes ----------
-            rec_ind = np.where((receiver_std<fc_para['max_over_std'])&(receiver_std>0)&(np.isnan(receiver_std)==0))[0]
-            bb=np.intersect1d(sou_ind,rec_ind)
-            if len(bb)==0:continue
-
+    # pairs already saved by an interrupted run are skipped (the log only keeps the saved pairs)
+    if grank==0:
+        cc_done = noise_module.cc_resume_list(tmpfile,cc_h5)
+        if len(cc_done):print('resume %s with %d pairs done'%(tname,len(cc_done)))
+        ftmp = open(tmpfile,'w')
+        for tpair in sorted(cc_done):ftmp.write(tpair+'\n')
+        ftmp.close()
+    else: cc_done = None
+    cc_done = gcomm.bcast(cc_done,root=0)
+    ftmp = open(tmpfile,'a')
+
+    # segments without earthquakes/glitches for each station
+    fft_good = (fft_std<fc_para['max_over_std'])&(fft_std>0)&(np.isnan(fft_std)==0)
+    fft_good[fft_flag==0] = False
+
+    # number of stations in each source/receiver tile to fit in memory (besides the write buffer): 
+    # spectra of the tiles are read from the scratch file in out-of-core mode
+    write_bytes = int(write_buffer*1024**3)
+    if out_of_core:
+        fft_array.flush()
+        if cc_method != 'raw':fft_norm.flush()
+        mem_used = write_bytes
+    else:
+        mem_used = fft_array.nbytes+fft_norm.nbytes+write_bytes
+
+    # traces of the next chunk of the group (about the size of this one) are read during the cross-correlation
+    next_chunk = next((jck for jck in range(ick+ngroup,splits,ngroup) if not noise_module.cc_chunk_done(tmpfiles[jck])),None)
+    if prefetch and next_chunk is not None and mem_used+raw_bytes < MAX_MEM*1024**3:
+        prefetcher.submit(tdir[next_chunk],grank,gsize)
+        mem_used += raw_bytes
+    ntile = noise_module.cc_tile_size(fc_para,nseg_chunk,nnfft,mem_used,nfreq)
+    # station pairs selected by distance/azimuth (indices of the unique stations): the ones selected before
+    # reading, or from the coordinates of the inventories when some station had no coordinates then
+    sta_id  = np.unique([network[ii]+'.'+station[ii] for ii in range(iii)],return_index=True,return_inverse=True)
+    if sta_pairs is not None:
+        sta_indx = {name:ii for ii,name in enumerate(sta_id[0])}
+        cc_keep  = set([(sta_indx[sta1],sta_indx[sta2]) for sta1,sta2 in sta_pairs if sta1 in sta_indx and sta2 in sta_indx])
+    else:
+        cc_keep = noise_module.select_station_pairs(np.array(clon)[sta_id[1]],np.array(clat)[sta_id[1]],fc_para['pair_para'])
+    sta_id  = sta_id[2]
+    if cc_keep is not None and flag:print('%d station pairs selected by distance/azimuth'%len(cc_keep))
+
+    # enough blocks of source/receiver tiles for all ranks of the group
+    # and the CCFs of one block (at most nseg_chunk rows of the lags each) fit in the write buffer, 
+    # which is only flushed in the turn of the rank so that the ranks never write the file at once
+    if gsize>1:
+        ntile1 = int(np.ceil((np.sqrt(8*gsize+1)-1)/2))
+        ntile  = int(np.maximum(np.minimum(ntile,np.ceil(iii/ntile1)),1))
+        ccf_bytes = (nseg_chunk if substack else 1)*(int(2*maxlag*samp_freq)+1)*4
+        ntile  = int(np.maximum(np.minimum(ntile,np.floor(np.sqrt(write_bytes/ccf_bytes))),1))
+    if flag:print('correlating %d stations in tiles of %d'%(iii,ntile))
+
+    # output file for the chunk is held open by one writer for the whole chunk and the pairs are
+    # recorded in the tmp file once they are flushed to disk
+    max_bytes = np.inf if gsize>1 else write_bytes
+    if output_fmt == 'columnar':
+        ccf_ds = noise_module.ColumnarCCFWriter(cc_h5,max_bytes,ftmp)
+    else:
+        ccf_ds = noise_module.CCFWriter(cc_h5,max_bytes,ftmp)
+
+    # make cross-correlations block by block of source/receiver tiles: ranks of the group take the
+    # blocks in turn and write into the ASDF file one after another at the end of each round
+    blocks = [[iS0,iR0] for iS0 in range(0,iii,ntile) for iR0 in range(iS0,iii,ntile)]
+    iS0_old = -1
+    for iround in range(int(np.ceil(len(blocks)/gsize))):
+        if iround*gsize+grank < len(blocks):
+            iS0,iR0 = blocks[iround*gsize+grank]
+            iS1 = np.minimum(iS0+ntile,iii)
+            iR1 = np.minimum(iR0+ntile,iii)
+
+            #-----------get index right for auto/cross correlation----------
+            pairs = []
+            for iiS in range(iS0,iS1):
+                istart=iiS;iend=iii
+                if acorr_only:iend=np.minimum(iiS+3,iii)
+                if xcorr_only:istart=np.minimum(iiS+ncomp,iii)
+                for iiR in range(np.maximum(istart,iR0),np.minimum(iend,iR1)):
+                    if cc_keep is not None and (sta_id[iiS],sta_id[iiR]) not in cc_keep and \
+                        (sta_id[iiR],sta_id[iiS]) not in cc_keep:continue
+                    if len(cc_done) and network[iiS]+'.'+station[iiS]+'_'+network[iiR]+'.'+station[iiR]+' '+\
+                        channel[iiS]+'_'+channel[iiR] in cc_done:continue
+                    pairs.append([iiS-iS0,iiR-iR0])
+
+            t0=time.time()
+            #-----------get the smoothed source spectrum for decon later----------
+            if iS0 != iS0_old and len(pairs):
+                sfft1 = np.zeros((iS1-iS0,N,nfreq),dtype=np.complex64)
+                for iiS in range(iS0,iS1):
+                    if not np.any(fft_good[iiS]): continue
+                    if cc_method != 'raw':
+                        sfft1[iiS-iS0] = noise_module.smooth_source_spect(fc_para,fft_array[iiS],fft_norm[iiS]).reshape(N,nfreq)
+                    else:
+                        sfft1[iiS-iS0] = noise_module.smooth_source_spect(fc_para,fft_array[iiS]).reshape(N,nfreq)
+                iS0_old = iS0
+            t1=time.time()
+            if flag: 
+                print('smoothing source takes %6.4fs' % (t1-t0))
+
+            #-----------now the tile of receivers----------
             t2=time.time()
-            corr,tcorr,ncorr=noise_module.correlate(sfft1[bb,:],sfft2[bb,:],fc_para,Nfft,fft_time[iiR][bb])
+            if len(pairs):
+                sfft2 = fft_array[iR0:iR1].reshape(iR1-iR0,N,nfreq)
+                snorm2 = None
+                if cc_method == 'coherency': snorm2 = fft_norm[iR0:iR1].reshape(iR1-iR0,N,nfreq)
+                results = noise_module.correlate_block(sfft1,sfft2,pairs,fc_para,Nfft,fft_time[iR0:iR1],\
+                    fft_good[iS0:iS1],fft_good[iR0:iR1],snorm2)
+                del sfft2,snorm2
             t3=time.time()
 
             #---------------keep daily cross-correlation into a hdf5 file--------------
-            if input_fmt == 'asdf':
-                tname = tdir[ick].split('/')[-1]
-            else: 
-                tname = tdir[ick].split('/')[-1]+'.h5'
-            cc_h5 = os.path.join(CCFDIR,tname)
-            crap  = np.zeros(corr.shape,dtype=corr.dtype)
-
-            with pyasdf.ASDFDataSet(cc_h5,mpi=False) as ccf_ds:
+            for ipair in range(len(pairs)):
+                if results[ipair] is None:continue
+                corr,tcorr,ncorr = results[ipair]
+                iiS = pairs[ipair][0]+iS0;iiR = pairs[ipair][1]+iR0
+                if flag:print('receiver: %s %s' % (station[iiR],network[iiR]))
+
                 coor = {'lonS':clon[iiS],'latS':clat[iiS],'lonR':clon[iiR],'latR':clat[iiR]}
                 comp = channel[iiS][-1]+channel[iiR][-1]
                 parameters = noise_module.cc_parameters(fc_para,coor,tcorr,ncorr,comp)
@@ -332,26 +444,42 @@ for ick in range (rank,splits,size):
                 # source-receiver pair
                 data_type = network[iiS]+'.'+station[iiS]+'_'+network[iiR]+'.'+station[iiR]
                 path = channel[iiS]+'_'+channel[iiR]
-                crap[:] = corr[:]
-                ccf_ds.add_auxiliary_data(data=crap, data_type=data_type, path=path, parameters=parameters)
-                ftmp.write(network[iiS]+'.'+station[iiS]+'.'+channel[iiS]+'_'+network[iiR]+'.'+station[iiR]+'.'+channel[iiR]+'\n')
+                ccf_ds.add_auxiliary_data(data=corr, data_type=data_type, path=path, parameters=parameters)
+            results = []
 
             t4=time.time()
-            if flag:print('read S %6.4fs, cc %6.4fs, write cc %6.4fs'% ((t1-t0),(t3-t2),(t4-t3)))
-            
-            del fft2,sfft2,receiver_std
-        del fft1,sfft1,source_std
-
-    # create a stamp to show time chunk being done
-    ftmp.write('done')
+            if flag:print('read S %6.4fs, cc %6.4fs (%d pairs), write cc %6.4fs'% ((t1-t0),(t3-t2),len(pairs),(t4-t3)))
+
+        # only one rank of the group writes into the ASDF file at a time
+        if gsize>1:
+            for irank in range(gsize):
+                if irank==grank:ccf_ds.close()
+                gcomm.Barrier()
+    sfft1 = []
+
+    # write the remaining cc data and create a stamp to show time chunk being done
+    ccf_ds.close()
+    if grank==0:ftmp.write('done')
     ftmp.close()
 
-    fft_array=[];fft_std=[];fft_flag=[];fft_time=[]
+    fft_array=[];fft_std=[];fft_flag=[];fft_time=[];fft_norm=[]
     n = gc.collect();print('unreadable garbarge',n)
+    if out_of_core:
+        os.remove(fft_file)
+        if cc_method != 'raw':os.remove(fft_file+'_norm')
+
+    # peak resident memory of this rank so far (ru_maxrss is in KB on linux)
+    peak_mem = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024**2
+    print('peak memory %5.3fG (MAX_MEM %5.3fG, out-of-core %s)' % (peak_mem,MAX_MEM,out_of_core))
 
     t11 = time.time()
     print('it takes %6.2fs to process the chunk of %s' % (t11-t10,tdir[ick].split('/')[-1]))
 
+prefetcher.close()
+if prefetcher.t_read>0:
+    print('reading data takes %6.2fs in total, %6.2fs (%4.1f%%) hidden behind the cross-correlation' % (prefetcher.t_read,\
+        prefetcher.t_read-prefetcher.t_wait,100*(prefetcher.t_read-prefetcher.t_wait)/prefetcher.t_read))
+
 tt1 = time.time()
 print('it takes %6.2fs to process step 1 in total' % (tt1-tt0))
 comm.barrier()
@@ -1,7 +1,6 @@
 import sys
 import time
 import obspy
-import pyasdf
 import os, glob
 import datetime
 import numpy as np
@@ -40,6 +39,7 @@ tt0=time.time()
 rootpath  = './'         # root path for this data processing
 CCFDIR    = os.path.join(rootpath,'CCF')                            # dir where CC data is stored
 STACKDIR  = os.path.join(rootpath,'STACK')                          # dir where stacked data is going to
+PAIRDIR   = os.path.join(CCFDIR,'PAIRS')                            # dir where the pair-major CCF files are going to (if transpose)
 locations = os.path.join(rootpath,'RAW_DATA/station.txt')                    # station info including network,station,channel,latitude,longitude,elevation
 if not os.path.isfile(locations): 
     raise ValueError('Abort! station info is needed for this script')
@@ -57,8 +57,12 @@ if rotation and correction:
     locs     = pd.read_csv(corrfile)
 else: locs = []
 
+# station-pair selection by distance/azimuth: dict of min_dist,max_dist,azi_range,nneighbor (see S1)
+pair_para    = None                                                 # None to follow the selection used in S1
+
 # maximum memory allowed per core in GB
 MAX_MEM = 4.0
+transpose = True                                                    # rewrite the CCFs of each source station into one pair-major file so that a pair is loaded in one read (rows of new CCF files are appended)
 
 ##################################################
 # we expect no parameters need to be changed below
@@ -76,6 +80,7 @@ step        = fc_para['step']
 maxlag      = fc_para['maxlag']
 substack    = fc_para['substack']
 substack_len= fc_para['substack_len']
+if pair_para is None:pair_para = fc_para.get('pair_para',{})
 
 # cross component info
 if ncomp==1:enz_system = ['ZZ']
@@ -86,7 +91,7 @@ rtz_components = ['ZR','ZT','ZZ','RR','RT','RZ','TR','TT','TZ']
 stack_para={'samp_freq':samp_freq,'cc_len':cc_len,'step':step,'rootpath':rootpath,'STACKDIR':\
     STACKDIR,'start_date':start_date[0],'end_date':end_date[0],'inc_hours':inc_hours,'substack':substack,\
     'substack_len':substack_len,'maxlag':maxlag,'MAX_MEM':MAX_MEM,'keep_substack':keep_substack,\
-    'stack_method':stack_method,'rotation':rotation,'correction':correction}
+    'stack_method':stack_method,'rotation':rotation,'correction':correction,'pair_para':pair_para}
 # save fft metadata for future reference
 stack_metadata  = os.path.join(STACKDIR,'stack_data.txt') 
 
@@ -115,10 +120,14 @@ if rank == 0:
         tmp = os.path.join(STACKDIR,sta[ii])
         if not os.path.isdir(tmp):os.mkdir(tmp)
 
-    # station-pairs
+    # station-pairs (only the ones selected by distance/azimuth)
+    tlocs = tlocs.drop_duplicates(['network','station'])
+    tlocs.index = tlocs['network']+'.'+tlocs['station']
+    keep = noise_module.select_station_pairs(tlocs.loc[sta,'longitude'].values,tlocs.loc[sta,'latitude'].values,pair_para)
     pairs_all = []
     for ii in range(len(sta)-1):
         for jj in range(ii,len(sta)):
+            if keep is not None and (ii,jj) not in keep:continue
             pairs_all.append(sta[ii]+'_'+sta[jj])
 
     splits  = len(pairs_all)
@@ -133,6 +142,22 @@ splits    = comm.bcast(splits,root=0)
 ccfiles   = comm.bcast(ccfiles,root=0)
 pairs_all = comm.bcast(pairs_all,root=0)
 
+# index of where the data of each pair/component/chunk are: only new or changed CCF files are scanned again
+cindex = noise_module.make_ccf_index(ccfiles,os.path.join(CCFDIR,'ccf_index.txt'),comm)
+pair_files = cindex.groupby('pair')['file'].unique()
+
+# transpose the time-major CCF files into one pair-major file for each source station
+if transpose:
+    if rank==0 and not os.path.isdir(PAIRDIR):os.mkdir(PAIRDIR)
+    comm.barrier()
+    t0=time.time()
+    sources = sorted(set([tpair.split('_')[0] for tpair in pairs_all]))
+    for isrc in range(rank,len(sources),size):
+        tpairs = [tpair for tpair in pairs_all if tpair.split('_')[0]==sources[isrc]]
+        noise_module.transpose_ccf(cindex,tpairs,os.path.join(PAIRDIR,sources[isrc]+'.h5'),ncomp)
+    comm.barrier()
+    if rank==0:print('transposing CCF files takes %6.2fs'%(time.time()-t0))
+
 # MPI loop: loop through each user-defined time chunck
 for ipair in range (rank,splits,size):
     t0=time.time()
@@ -174,47 +199,60 @@ for ipair in range (rank,splits,size):
     # loop through all time-chuncks
     iseg = 0
     dtype = pairs_all[ipair] 
-    for ifile in ccfiles:
-
-        # load the data from daily compilation
-        ds=pyasdf.ASDFDataSet(ifile,mpi=False,mode='r')
-        try:
-            path_list   = ds.auxiliary_data[dtype].list()
-            tparameters = ds.auxiliary_data[dtype][path_list[0]].parameters 
-        except Exception: 
-            if flag:print('continue! no pair of %s in %s'%(dtype,ifile))
-            continue
+    if transpose:
+        # all chunks and components of the pair in one read
+        pdata = noise_module.read_pair_ccf(os.path.join(PAIRDIR,idir+'.h5'),dtype)
+        if pdata is not None:
+            tdata,ttime,tgood,tcomp,tparameters = pdata
+            iseg = tdata.shape[0]
+            cc_array[:iseg] = tdata
+            cc_time[:iseg]  = ttime
+            cc_ngood[:iseg] = tgood
+            cc_comp[:iseg]  = tcomp
+            del pdata,tdata
+    else:
+        # files with the pair from the index
+        for ifile in pair_files.get(dtype,[]):
+
+            # load the data from daily compilation (ASDF or columnar files of S1)
+            ds=noise_module.CCFReader(ifile)
+            try:
+                path_list   = ds.paths(dtype)
+                tparameters = ds.parameters(dtype,path_list[0])
+            except Exception: 
+                if flag:print('continue! no pair of %s in %s'%(dtype,ifile))
+                continue
         
-        if ncomp==3 and len(path_list)<9:
-            if flag:print('continue! not enough cross components for %s in %s'%(dtype,ifile))
-            continue
+            if ncomp==3 and len(path_list)<9:
+                if flag:print('continue! not enough cross components for %s in %s'%(dtype,ifile))
+                continue
 
-        if len(path_list) >9:
-            raise ValueError('more than 9 cross-component exists for %s %s! please double check'%(ifile,dtype))
+            if len(path_list) >9:
+                raise ValueError('more than 9 cross-component exists for %s %s! please double check'%(ifile,dtype))
                    
-        # load the 9-component data, which is in order in the ASDF
-        for tpath in path_list:
-            cmp1 = tpath.split('_')[0]
-            cmp2 = tpath.split('_')[1]
-            tcmp1 = cmp1[-1];tcmp2 = cmp2[-1]
-
-            # read data and parameter matrix
-            tdata = ds.auxiliary_data[dtype][tpath].data[:]
-            ttime = ds.auxiliary_data[dtype][tpath].parameters['time']
-            tgood = ds.auxiliary_data[dtype][tpath].parameters['ngood']
-            if substack:
-                for ii in range(tdata.shape[0]):
-                    cc_array[iseg] = tdata[ii]
-                    cc_time[iseg]  = ttime[ii]
-                    cc_ngood[iseg] = tgood[ii]
+            # load the 9-component data, which is in order in the ASDF
+            for tpath in path_list:
+                cmp1 = tpath.split('_')[0]
+                cmp2 = tpath.split('_')[1]
+                tcmp1 = cmp1[-1];tcmp2 = cmp2[-1]
+
+                # read data and parameter matrix
+                tdata,tpara = ds.read(dtype,tpath,['time','ngood'])
+                ttime = tpara['time']
+                tgood = tpara['ngood']
+                if substack:
+                    for ii in range(tdata.shape[0]):
+                        cc_array[iseg] = tdata[ii]
+                        cc_time[iseg]  = ttime[ii]
+                        cc_ngood[iseg] = tgood[ii]
+                        cc_comp[iseg]  = tcmp1+tcmp2
+                        iseg+=1
+                else:
+                    cc_array[iseg] = tdata
+                    cc_time[iseg]  = ttime
+                    cc_ngood[iseg] = tgood
                     cc_comp[iseg]  = tcmp1+tcmp2
                     iseg+=1
-            else:
-                cc_array[iseg] = tdata
-                cc_time[iseg]  = ttime
-                cc_ngood[iseg] = tgood
-                cc_comp[iseg]  = tcmp1+tcmp2
-                iseg+=1
 
     t1=time.time()
     if flag:print('loading CCF data takes %6.2fs'%(t1-t0))
@@ -224,6 +262,10 @@ for ipair in range (rank,splits,size):
     outfn = pairs_all[ipair]+'.h5'         
     if flag:print('ready to output to %s'%(outfn))                     
 
+    # all stacks of the pair are buffered and written into the ASDF file at once
+    stack_h5 = os.path.join(STACKDIR,idir+'/'+outfn)
+    stack_ds = noise_module.CCFWriter(stack_h5)
+
     # matrix used for rotation
     if rotation:bigstack=np.zeros(shape=(9,npts_segmt),dtype=np.float32)
     if stack_method =='both':bigstack1=np.zeros(shape=(9,npts_segmt),dtype=np.float32)
@@ -239,7 +281,6 @@ for ipair in range (rank,splits,size):
             iflag=0;break
 
         t2=time.time()
-        stack_h5 = os.path.join(STACKDIR,idir+'/'+outfn)
         # output stacked data
         if stack_method != 'both':
             cc_final,ngood_final,stamps_final,allstacks,nstacks = noise_module.stacking(cc_array[indx],cc_time[indx],cc_ngood[indx],stack_para)
@@ -247,11 +288,10 @@ for ipair in range (rank,splits,size):
             if rotation:bigstack[icomp]=allstacks
 
             # write stacked data into ASDF file
-            with pyasdf.ASDFDataSet(stack_h5,mpi=False) as ds:
-                tparameters['time']  = stamps_final[0]
-                tparameters['ngood'] = nstacks
-                data_type = 'Allstack_'+stack_method
-                ds.add_auxiliary_data(data=allstacks, data_type=data_type, path=comp, parameters=tparameters)
+            tparameters['time']  = stamps_final[0]
+            tparameters['ngood'] = nstacks
+            data_type = 'Allstack_'+stack_method
+            stack_ds.add_auxiliary_data(data=allstacks, data_type=data_type, path=comp, parameters=tparameters)
         else:
             cc_final,ngood_final,stamps_final,allstacks1,allstacks2,nstacks = noise_module.stacking(cc_array[indx],cc_time[indx],cc_ngood[indx],stack_para)
             if not len(allstacks1):continue
@@ -260,27 +300,26 @@ for ipair in range (rank,splits,size):
                 bigstack1[icomp]=allstacks2
 
             # write stacked data into ASDF file
-            with pyasdf.ASDFDataSet(stack_h5,mpi=False) as ds:
-                tparameters['time']  = stamps_final[0]
-                tparameters['ngood'] = nstacks
-                ds.add_auxiliary_data(data=allstacks1, data_type='Allstack_linear', path=comp, parameters=tparameters)
-                ds.add_auxiliary_data(data=allstacks2, data_type='Allstack_pws', path=comp, parameters=tparameters)
+            tparameters['time']  = stamps_final[0]
+            tparameters['ngood'] = nstacks
+            stack_ds.add_auxiliary_data(data=allstacks1, data_type='Allstack_linear', path=comp, parameters=tparameters)
+            stack_ds.add_auxiliary_data(data=allstacks2, data_type='Allstack_pws', path=comp, parameters=tparameters)
 
         # keep a track of all sub-stacked data from S1
         if keep_substack:
             for ii in range(cc_final.shape[0]):
-                with pyasdf.ASDFDataSet(stack_h5,mpi=False) as ds:
-                    tparameters['time']  = stamps_final[ii]
-                    tparameters['ngood'] = ngood_final[ii]
-                    data_type = 'T'+str(int(stamps_final[ii]))
-                    ds.add_auxiliary_data(data=cc_final[ii], data_type=data_type, path=comp, parameters=tparameters)            
+                tparameters['time']  = stamps_final[ii]
+                tparameters['ngood'] = ngood_final[ii]
+                data_type = 'T'+str(int(stamps_final[ii]))
+                stack_ds.add_auxiliary_data(data=cc_final[ii], data_type=data_type, path=comp, parameters=tparameters)            
         
         t3 = time.time()
         if flag:print('takes %6.2fs to stack one component with %s stacking method' %(t3-t1,stack_method))
 
     # do rotation if needed
     if rotation and iflag:
-        if np.all(bigstack==0):continue
+        if np.all(bigstack==0):
+            stack_ds.close();continue
         tparameters['station_source'] = ssta
         tparameters['station_receiver'] = rsta
         if stack_method!='both':
@@ -292,8 +331,7 @@ for ipair in range (rank,splits,size):
                 tparameters['time']  = stamps_final[0]
                 tparameters['ngood'] = nstacks
                 data_type = 'Allstack_'+stack_method
-                with pyasdf.ASDFDataSet(stack_h5,mpi=False) as ds2:
-                    ds2.add_auxiliary_data(data=bigstack_rotated[icomp], data_type=data_type, path=tpath, parameters=tparameters)
+                stack_ds.add_auxiliary_data(data=bigstack_rotated[icomp], data_type=data_type, path=tpath, parameters=tparameters)
         else:
             bigstack_rotated  = noise_module.rotation(bigstack,tparameters,locs,flag)
             bigstack_rotated1 = noise_module.rotation(bigstack1,tparameters,locs,flag)
@@ -303,14 +341,14 @@ for ipair in range (rank,splits,size):
                 comp=rtz_components[icomp]
                 tparameters['time']  = stamps_final[0]
                 tparameters['ngood'] = nstacks
-                with pyasdf.ASDFDataSet(stack_h5,mpi=False) as ds2:
-                    ds2.add_auxiliary_data(data=bigstack_rotated[icomp], data_type='Allstack_linear', path=comp, parameters=tparameters)    
-                    ds2.add_auxiliary_data(data=bigstack_rotated1[icomp], data_type='Allstack_pws', path=comp, parameters=tparameters)
+                stack_ds.add_auxiliary_data(data=bigstack_rotated[icomp], data_type='Allstack_linear', path=comp, parameters=tparameters)    
+                stack_ds.add_auxiliary_data(data=bigstack_rotated1[icomp], data_type='Allstack_pws', path=comp, parameters=tparameters)
 
     t4 = time.time()
     if flag:print('takes %6.2fs to stack/rotate all station pairs %s' %(t4-t1,pairs_all[ipair]))
 
-    # write file stamps 
+    # write the stacks and file stamps 
+    stack_ds.close()
     ftmp = open(toutfn,'w');ftmp.write('done');ftmp.close()
 
 tt1 = time.time()
@@ -5,6 +5,7 @@ import pyasdf
 import os, glob
 import datetime
 import numpy as np
+import h5py
 import noise_module
 import pandas as pd
 from mpi4py import MPI
@@ -49,6 +50,7 @@ ccomp = 'ZZ'                                                                # cr
 # pre-defined group velocity to window direct and code waves
 vmin = 0.8                                                                  # minimum velocity of the direct waves -> start of the coda window
 lwin = 150                                                                  # window length in sec for the coda waves
+lag_pad = 50                                                                # lags (s) read beyond the coda window to keep the filter edges off it (~5 periods)
 
 # basic parameters 
 freq    = [0.1,0.2,0.3,0.5]                                                   # targeted frequency band for waveform monitoring
@@ -94,7 +96,6 @@ with pyasdf.ASDFDataSet(sfile,mode='r') as ds:
         dt   = ds.auxiliary_data[dtype][ccomp].parameters['dt']
         dist = ds.auxiliary_data[dtype][ccomp].parameters['dist']
         maxlag  = ds.auxiliary_data[dtype][ccomp].parameters['maxlag']
-        tdata = ds.auxiliary_data[dtype][ccomp].data[:]
     except Exception:
         raise ValueError('cannot open %s to read'%sfile)
 
@@ -103,9 +104,14 @@ twin = [int(dist/vmin),int(dist/vmin)+lwin]
 if twin[1] > maxlag:
     raise ValueError('proposed window exceeds limit! reduce %d'%lwin)
 
+# only the lags of the coda windows (plus lag_pad) are read for the ref and cur waveforms
+lag_range  = [-min(np.max(twin)+lag_pad,maxlag),min(np.max(twin)+lag_pad,maxlag)]
+read_stats = {}
+cwin = noise_module.read_ccf_window(sfile,dtype,ccomp,lag_range,stats=read_stats)
+
 # ref and tvec
-ref  = tdata
-tvec_all = np.arange(-maxlag,maxlag+dt,dt)
+ref  = cwin.data
+tvec_all = cwin.lag
 # add 20 s to the coda window for plotting purpose
 disp_indx = np.where(np.abs(tvec_all)<=np.max(twin)+20)[0]
 # casual and acasual coda window 
@@ -135,7 +141,7 @@ else:
     tick_inc = 2
 
 # load all current waveforms and get corr-coeff
-with pyasdf.ASDFDataSet(sfile,mode='r') as ds:
+with h5py.File(sfile,'r') as ds:
 
     # loop through each freq band
     for ifreq in range(nfreq):
@@ -154,10 +160,10 @@ with pyasdf.ASDFDataSet(sfile,mode='r') as ds:
         # loop through each cur waveforms and do filtering
         igood = 0
         for ii in range(nwin):
-            try:
-                cur[igood]  = ds.auxiliary_data[substacks[ii+2]][ccomp].data[:]
-            except Exception:
+            cwin = noise_module.read_ccf_window(ds,substacks[ii+2],ccomp,lag_range,stats=read_stats)
+            if cwin is None:
                 continue
+            cur[igood]  = cwin.data
             timestamp[igood] = obspy.UTCDateTime(np.float(substacks[ii+2][1:]))
             tcur[igood]  = bandpass(cur[igood],freq1,freq2,int(1/dt),corners=4,zerophase=True)
             if norm_flag:
@@ -306,4 +312,7 @@ with pyasdf.ASDFDataSet(sfile,mode='r') as ds:
         # save figure or just show
         outfname = outdir+'/{0:s}_{1:4.2f}_{2:4.2f}Hz.pdf'.format(sfile.split('/')[-1],freq1,freq2)
         plt.savefig(outfname, format='pdf', dpi=400)
-        plt.close()
\ No newline at end of file
+        plt.close()
+
+print('read %d of %d bytes of the waveforms (%d of %d bytes stored)'%(read_stats['read'],read_stats['full'],\
+    read_stats['stored_read'],read_stats['stored_full']))
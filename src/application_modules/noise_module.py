@@ -2,8 +2,10 @@ import os
 import glob
 import copy
 import obspy
+import collections
 import scipy
 import time
+import h5py
 import pycwt
 import pyasdf
 import datetime
@@ -697,6 +699,237 @@ def cc_parameters(cc_para,coor,tcorr,ncorr,comp):
         'comp':comp}
     return parameters
 
+class CCFReader(object):
+    '''
+    this class reads the cross-correlation functions of one file of S1 in the ASDF format (one auxiliary
+    dataset per station pair and component) or the columnar format of ColumnarCCFWriter, and gives them with
+    the same parameters as cc_parameters in both cases. for the columnar files the pair table and the time,
+    ngood and pair columns of a component are read once, and its data dataset is kept open so that the HDF5
+    chunks shared by neighbouring pairs stay in the chunk cache. it can be used in a with statement. (used
+    in S2, make_ccf_index, read_ccf_window and the plotting modules)
+    PARAMETERS:
+    ---------------------
+    h5file: name of the file of S1 or an opened h5py.File
+    '''
+    def __init__(self,h5file):
+        self.own = not isinstance(h5file,h5py.File)
+        self.f   = h5py.File(h5file,'r') if self.own else h5file
+        self.columnar = self.f.attrs.get('ccf_format','') == 'columnar'
+        self.columns  = {}
+        self.pairs    = None
+        self.shared   = {key:value for key,value in self.f.attrs.items() if key!='ccf_format'}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+        return False
+
+    def close(self):
+        if self.own:self.f.close()
+
+    def _columns(self,path):
+        '''
+        data dataset, time, ngood and pair columns and the first and last+1 rows of each pair ('rows') of
+        the columnar datasets of path
+        '''
+        if path not in self.columns:
+            if self.pairs is None:
+                self.pairs = {key:self.f['pairs'][key][:] for key in self.f['pairs'] if key!='name'}
+                self.pairs['name'] = self.f['pairs']['name'].asstr()[:]
+            grp  = self.f[path]
+            cols = {key:grp[key][:] for key in ['time','ngood','pair']}
+            cols['data'] = grp['data']
+            ipair,indx,count = np.unique(cols['pair'],return_index=True,return_counts=True)
+            cols['rows'] = {self.pairs['name'][ii]:(i1,i1+nn) for ii,i1,nn in zip(ipair,indx,count) if ii>=0}
+            self.columns[path] = cols
+        return self.columns[path]
+
+    def list(self):
+        '''
+        all cross-correlation functions of the file as [pair,path,nseg,npts]
+        '''
+        info = []
+        if self.columnar:
+            for path in self.f:
+                if path == 'pairs':continue
+                npts = self.f[path]['data'].shape[1]
+                for pair,(i1,i2) in self._columns(path)['rows'].items():info.append([pair,path,i2-i1,npts])
+        elif 'AuxiliaryData' in self.f:
+            aux = self.f['AuxiliaryData']
+            for data_type in aux:
+                for path in aux[data_type]:
+                    shape = aux[data_type][path].shape
+                    info.append([data_type,path,1 if len(shape)==1 else shape[0],shape[-1]])
+        return info
+
+    def paths(self,pair):
+        '''
+        components of a station pair in the file (sorted)
+        '''
+        if self.columnar:
+            return sorted([path for path in self.f if path!='pairs' and pair in self._columns(path)['rows']])
+        return list(self.f['AuxiliaryData'][pair].keys())
+
+    def locate(self,pair,path,keys=None):
+        '''
+        the dataset holding the pair and path, the rows of the pair in it (None for a 1D dataset) and its
+        parameters (only those of keys if given, to save reading the ASDF attributes), or None if the pair
+        and path are not in the file
+        '''
+        if self.columnar:
+            if path not in self.f or pair not in self._columns(path)['rows']:return None
+            cols  = self.columns[path]
+            i1,i2 = cols['rows'][pair]
+            ip    = cols['pair'][i1]
+            parameters = dict(self.shared)
+            for key in self.pairs:
+                if key!='name':parameters[key] = self.pairs[key][ip]
+            parameters['ngood'] = cols['ngood'][i1:i2].copy()
+            parameters['time']  = cols['time'][i1:i2].copy()
+            # a single cross-correlation function has scalar time and ngood as in the ASDF files
+            if not parameters['substack']:
+                parameters['ngood'] = parameters['ngood'][0];parameters['time'] = parameters['time'][0]
+            parameters['comp']  = path.split('_')[0][-1]+path.split('_')[1][-1]
+            return cols['data'],np.arange(i1,i2),parameters
+        try:
+            dset = self.f['AuxiliaryData'][pair][path]
+        except KeyError:
+            return None
+        parameters = dict(dset.attrs) if keys is None else {key:dset.attrs[key] for key in keys}
+        return dset,(np.arange(dset.shape[0]) if dset.ndim>1 else None),parameters
+
+    def parameters(self,pair,path):
+        '''
+        parameters of the cross-correlation functions of the pair and path
+        '''
+        return self.locate(pair,path)[2]
+
+    def read(self,pair,path,keys=None):
+        '''
+        cross-correlation functions (1D for a single one, nseg x npts for the substacks) and parameters of the
+        pair and path
+        '''
+        dset,rows,parameters = self.locate(pair,path,keys)
+        if rows is None:return dset[:],parameters
+        data = dset[rows[0]:rows[-1]+1] if len(rows) else np.zeros((0,dset.shape[1]),dtype=dset.dtype)
+        if self.columnar and not parameters['substack']:data = data[0]
+        return data,parameters
+
+# cross-correlation functions of a lag window: data (nrow x nlag, or nlag for a single stack), their lags,
+# times and the parameters of the dataset
+CCFWindow = collections.namedtuple('CCFWindow',['data','lag','time','parameters'])
+
+def lag_window(dt,maxlag,lag_range=None):
+    '''
+    this function gives the first and last+1 indices of the lags within lag_range (both ends included) on the
+    lag axis of -maxlag to maxlag in steps of dt (used in read_ccf_window)
+    '''
+    npts = int(round(2*maxlag/dt))+1
+    if lag_range is None:return 0,npts
+    indx1 = max(0,int(np.ceil((lag_range[0]+maxlag)/dt-1E-6)))
+    indx2 = min(npts,int(np.floor((lag_range[1]+maxlag)/dt+1E-6))+1)
+    if indx2<=indx1:raise ValueError('lag range %s is out of [-%s,%s]'%(lag_range,maxlag,maxlag))
+    return indx1,indx2
+
+def read_ccf_window(h5file,data_type,path=None,lag_range=None,time_range=None,stats=None):
+    '''
+    this function reads the cross-correlation functions of one dataset within a lag window and a time range
+    only. the windows are read as HDF5 hyperslabs so that only the HDF5 chunks holding them are decompressed
+    and transferred, instead of the full [-maxlag,maxlag] arrays of .data[:]. it works on the ASDF and columnar
+    files of S1 (data_type is the station pair and path the component like BHZ_BHZ), the ASDF files of S2
+    (data_type like Allstack_linear and path like ZZ) and on the pair-major files of transpose_ccf (data_type
+    is the station pair and path the component like ZZ, or None for all of them). (used in S2 and the plotting
+    and monitoring scripts)
+    PARAMETERS:
+    -----------------------
+    h5file:     name of the HDF5 file, an opened h5py.File or a CCFReader (to read many datasets)
+    data_type:  data type (or pair) of the dataset
+    path:       component of the dataset
+    lag_range:  [lag1,lag2] of the lags to read in sec (all lags if None)
+    time_range: [t1,t2) of the timestamps of the rows to read (all rows if None)
+    stats:      dict to add up the bytes of the selection ('read'), of the full dataset ('full'), and
+                stored in the file for the HDF5 chunks read ('stored_read') and for all of them ('stored_full')
+    RETURNS:
+    -----------------------
+    CCFWindow of data,lag,time,parameters or None if the dataset does not exist
+    '''
+    if isinstance(h5file,CCFReader):
+        reader = h5file
+    elif isinstance(h5file,h5py.File):
+        reader = CCFReader(h5file)
+    else:
+        with CCFReader(h5file) as reader:
+            return read_ccf_window(reader,data_type,path,lag_range,time_range,stats)
+
+    # dataset, its rows to read and their timestamps
+    if reader.columnar or 'AuxiliaryData' in reader.f:
+        located = reader.locate(data_type,path)
+        if located is None:return None
+        dset,rows,parameters = located
+        ttime = np.reshape(parameters['time'],-1)
+        if rows is None:rows = np.zeros(len(ttime),dtype=np.int64)
+        # a full read of the pair in a columnar file is its rows of the component
+        all_rows = rows if reader.columnar else None
+    else:
+        all_rows = None
+        if data_type not in reader.f:return None
+        dset  = reader.f[data_type]['data']
+        parameters = dict(reader.f[data_type].attrs)
+        ttime = reader.f[data_type]['time'][:]
+        rows  = np.arange(len(ttime))
+        if path is not None:
+            keep  = reader.f[data_type]['comp'][:].astype(str)==path
+            rows  = rows[keep];ttime = ttime[keep]
+    if time_range is not None:
+        keep  = (ttime>=time_range[0])&(ttime<time_range[1])
+        rows  = rows[keep];ttime = ttime[keep]
+    indx1,indx2 = lag_window(parameters['dt'],parameters['maxlag'],lag_range)
+
+    # hyperslab of the rows and lags (a slice when the rows are next to each other)
+    if dset.ndim==1:
+        sel = (slice(indx1,indx2),)
+        data = dset[sel] if len(rows) else np.zeros(0,dtype=dset.dtype)
+    else:
+        if len(rows) and rows[-1]-rows[0]+1==len(rows):
+            sel = (slice(rows[0],rows[-1]+1),slice(indx1,indx2))
+        else:
+            sel = (rows,slice(indx1,indx2))
+        data = dset[sel] if len(rows) else np.zeros((0,indx2-indx1),dtype=dset.dtype)
+    if stats is not None:
+        itemsize = dset.dtype.itemsize
+        stats['read']        = stats.get('read',0)+data.size*itemsize
+        if all_rows is None:
+            stats['full']        = stats.get('full',0)+dset.size*itemsize
+            stats['stored_full'] = stats.get('stored_full',0)+dset.id.get_storage_size()
+        else:
+            stats['full']        = stats.get('full',0)+len(all_rows)*dset.shape[1]*itemsize
+            stats['stored_full'] = stats.get('stored_full',0)+chunk_bytes(dset,all_rows,0,dset.shape[1])
+        stats['stored_read'] = stats.get('stored_read',0)+(chunk_bytes(dset,rows,indx1,indx2) if len(rows) else 0)
+    # a single cross-correlation function of a columnar file is 1D as in the ASDF files
+    if reader.columnar and not parameters['substack']:data = data[0] if len(data) else np.zeros(0,dtype=dset.dtype)
+    # same lag axis as np.arange(-maxlag,maxlag+dt,dt) of the scripts
+    lag = np.arange(-parameters['maxlag'],parameters['maxlag']+parameters['dt'],parameters['dt'])[indx1:indx2]
+    return CCFWindow(data,lag,ttime,parameters)
+
+def chunk_bytes(dset,rows,indx1,indx2):
+    '''
+    this function gives the bytes stored in the file for the HDF5 chunks of dset holding the rows and the lags
+    of indx1 to indx2, which is what HDF5 reads (and decompresses) for the selection (used in read_ccf_window)
+    '''
+    if dset.chunks is None:
+        return len(rows)*(indx2-indx1)*dset.dtype.itemsize if dset.ndim>1 else (indx2-indx1)*dset.dtype.itemsize
+    clag  = dset.chunks[-1]
+    lags  = range(indx1//clag*clag,indx2,clag)
+    crows = np.unique(np.asarray(rows)//dset.chunks[0])*dset.chunks[0] if dset.ndim>1 else [None]
+    nbyte = 0
+    for crow in crows:
+        for ilag in lags:
+            info = dset.id.get_chunk_info_by_coord((crow,ilag) if dset.ndim>1 else (ilag,))
+            if info.byte_offset is not None:nbyte += info.size
+    return nbyte
+
 def stacking(cc_array,cc_time,cc_ngood,stack_para):
     '''
     this function stacks the cross correlation data according to the user-defined substack_len parameter
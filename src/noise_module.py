@@ -1,21 +1,33 @@
 import os
 import glob
 import copy
+import hashlib
+import fnmatch
+import threading
+import collections
+import concurrent.futures
+import scipy.signal
 import obspy
 import scipy
+import scipy.fft
 import time
+import functools
 import pycwt
+import h5py
 import pyasdf
 import datetime
 import numpy as np
 import pandas as pd
 from numba import jit
+from fractions import Fraction
 from scipy.signal import hilbert
+from scipy.spatial import cKDTree
 from obspy.signal.util import _npts2nfft
-from obspy.signal.invsim import cosine_taper
+from obspy.signal.invsim import cosine_taper,cosine_sac_taper,invert_spectrum
 from scipy.fftpack import fft,ifft,next_fast_len
 from obspy.signal.filter import bandpass,lowpass
 from obspy.signal.regression import linear_regression
+from obspy.clients.fdsn.header import FDSNNoDataException
 from obspy.core.util.base import _get_function_from_entry_point
 from obspy.core.inventory import Inventory, Network, Station, Channel, Site
 
@@ -71,81 +83,212 @@ def get_event_list(str1,str2,inc_hours):
     
     return event
 
-def make_timestamps(prepro_para):
+def make_timestamps(prepro_para,comm=None):
     '''
     this function prepares the timestamps of both the starting and ending time of each mseed/sac file that
     is stored on local machine. this time info is used to search all stations in specific time chunck 
-    when preparing noise data in ASDF format. it creates a csv file containing all timestamp info if the 
-    file does not exist (used in S0B)f
+    when preparing noise data in ASDF format. the times are taken from the file index (see make_file_index),
+    which is created or updated in the csv file of wiki_file (used in S0B)
     PARAMETERS:
     -----------------------
     prepro_para: a dic containing all pre-processing parameters used in S0B
+    comm: MPI communicator to share the scanning of the files (optional, all ranks have to call it)
     RETURNS:
     -----------------------
     all_stimes: numpy float array containing startting and ending time for all SAC/mseed files  
     '''
+    findex = make_file_index(prepro_para,comm)
+    return findex[['starttime','endtime']].values.astype(np.float64)
+
+def file_header_info(fname,input_fmt=None):
+    '''
+    this function reads the header of a sac/mseed file (without the data) to get the station info and 
+    the starting and ending time of the file (used in make_file_index)
+    PARAMETERS:
+    -----------------------
+    fname: path of the sac/mseed file
+    input_fmt: file format ('sac' or 'mseed') to skip the format detection of obspy
+    RETURNS:
+    -----------------------
+    info: list of network, station, location, channel, starttime and endtime (timestamps, nan if the
+          file can not be read)
+    '''
+    try:
+        tr = obspy.read(fname,format=input_fmt.upper() if input_fmt else None,headonly=True)
+        return [tr[0].stats.network,tr[0].stats.station,tr[0].stats.location,tr[0].stats.channel,\
+            min([t.stats.starttime.timestamp for t in tr]),max([t.stats.endtime.timestamp for t in tr])]
+    except Exception as e:
+        print(e)
+        return ['','','','',np.nan,np.nan]
+
+def folder_time_info(fname):
+    '''
+    this function gets rough estimates of the starting and ending time of a day-long file from its folder
+    name (e.g., ./RAW_DATA/Event_2010_340/*.sac): need modified to accommodate your data (used in make_file_index)
+    '''
+    year  = int(fname.split('/')[-2].split('_')[1])
+    julia = int(fname.split('/')[-2].split('_')[2])
+    tbeg  = obspy.UTCDateTime(year=year,julday=julia).timestamp
+    return ['','','','',tbeg,tbeg+86400]
+
+def make_file_index(prepro_para,comm=None,nproc=None):
+    '''
+    this function makes the index of all sac/mseed files in allfiles_path with the station info, the starting 
+    and ending time, the size and the modification time of each file, and saves it in the csv file of wiki_file. 
+    only the headers are read (or the times are estimated from the folder names if messydata is False), and 
+    the files are shared by all MPI ranks of comm or by a pool of nproc processes. when wiki_file exists, 
+    only the new or changed files (size or mtime) are scanned again and the removed files are dropped.
+    (used in S0B)
+    PARAMETERS:
+    -----------------------
+    prepro_para: a dic containing all pre-processing parameters used in S0B (wiki_file, messydata, RAWDATA,
+                 allfiles_path and input_fmt)
+    comm:  MPI communicator (optional, all ranks have to call it and get the same index)
+    nproc: number of processes to scan the files without MPI (optional, default from 'nproc' in prepro_para or 1)
+    RETURNS:
+    -----------------------
+    findex: pandas dataframe with the columns of names, network, station, location, channel, starttime, endtime,
+            size and mtime
+    '''
     # load parameters from para dic
     wiki_file = prepro_para['wiki_file']
     messydata = prepro_para['messydata']
     RAWDATA   = prepro_para['RAWDATA']
     allfiles_path = prepro_para['allfiles_path']
-
-    if os.path.isfile(wiki_file):
-        tmp = pd.read_csv(wiki_file)
-        allfiles = tmp['names']
-        all_stimes = np.zeros(shape=(len(allfiles),2),dtype=np.float)
-        all_stimes[:,0] = tmp['starttime']
-        all_stimes[:,1] = tmp['endtime']
-    
-    # have to read each sac/mseed data one by one
+    input_fmt = prepro_para.get('input_fmt',None)
+    if nproc is None: nproc = prepro_para.get('nproc',1)
+    columns = ['names','network','station','location','channel','starttime','endtime','size','mtime']
+    rank = 0 if comm is None else comm.Get_rank()
+    size = 1 if comm is None else comm.Get_size()
+
+    # files to scan: new or changed since the last index
+    if rank == 0:
+        allfiles = sorted(glob.glob(allfiles_path))
+        if not len(allfiles): raise ValueError('Abort! no data found in subdirectory of %s'%RAWDATA)
+        fstat = np.array([[tstat.st_size,tstat.st_mtime] for tstat in map(os.stat,allfiles)]).reshape(-1,2)
+        findex = pd.DataFrame({'names':allfiles,'size':fstat[:,0].astype(np.int64),'mtime':fstat[:,1]})
+        for col in columns[1:5]:findex[col] = ''
+        findex['starttime'] = np.nan;findex['endtime'] = np.nan
+        findex = findex[columns]
+        scan = np.ones(len(allfiles),dtype=np.bool_)
+        if os.path.isfile(wiki_file):
+            old = pd.read_csv(wiki_file,dtype={'network':str,'station':str,'location':str,'channel':str},float_precision='round_trip')
+            if 'size' in old.columns and 'mtime' in old.columns:
+                old[columns[1:5]] = old[columns[1:5]].fillna('')
+                old  = old.drop_duplicates('names').set_index('names')
+                same = np.array(findex['names'].isin(old.index))
+                prev = old.reindex(findex['names'][same])
+                same[same] = (prev['size'].values==findex['size'][same].values)&(prev['mtime'].values==findex['mtime'][same].values)
+                for col in columns[1:7]:
+                    findex.loc[same,col] = old.reindex(findex['names'][same])[col].values
+                scan = ~same
+        tscan = list(findex['names'][scan])
+        print('%d files in the index, %d files to scan'%(len(findex),len(tscan)))
     else:
-        allfiles = glob.glob(allfiles_path)
-        nfiles   = len(allfiles)
-        if not nfiles: raise ValueError('Abort! no data found in subdirectory of %s'%RAWDATA)
-        all_stimes = np.zeros(shape=(nfiles,2),dtype=np.float)
-
-        if messydata:
-            # get VERY precise trace-time from the header
-            for ii in range(nfiles):
-                try:
-                    tr = obspy.read(allfiles[ii])
-                    all_stimes[ii,0] = tr[0].stats.starttime-obspy.UTCDateTime(1970,1,1)
-                    all_stimes[ii,1] = tr[0].stats.endtime-obspy.UTCDateTime(1970,1,1)
-                except Exception as e:
-                    print(e);continue
-        else:
-            # get rough estimates of the time based on the folder: need modified to accommodate your data
-            for ii in range(nfiles):
-                year  = int(allfiles[ii].split('/')[-2].split('_')[1])
-                julia = int(allfiles[ii].split('/')[-2].split('_')[2])
-                all_stimes[ii,0] = obspy.UTCDateTime(year=year,julday=julia)-obspy.UTCDateTime(year=1970,month=1,day=1)
-                all_stimes[ii,1] = all_stimes[ii,0]+86400
-        
-        # save name and time info for later use if the file not exist
-        if not os.path.isfile(wiki_file):
-            wiki_info = {'names':allfiles,'starttime':all_stimes[:,0],'endtime':all_stimes[:,1]}
-            df = pd.DataFrame(wiki_info,columns=['names','starttime','endtime'])
-            df.to_csv(wiki_file)
-    return all_stimes
+        tscan = None
+    if comm is not None: tscan = comm.bcast(tscan,root=0)
+
+    # scan the headers (or folder names) of this rank
+    func  = functools.partial(file_header_info,input_fmt=input_fmt) if messydata else folder_time_info
+    mscan = tscan[rank::size]
+    if comm is None and nproc>1 and len(mscan)>nproc:
+        with concurrent.futures.ProcessPoolExecutor(nproc) as pool:
+            info = list(pool.map(func,mscan,chunksize=max(1,len(mscan)//(nproc*16))))
+    else:
+        info = [func(ff) for ff in mscan]
+    if comm is not None:
+        info = comm.gather(info,root=0)
+    else: info = [info]
+
+    # update and save the index
+    if rank == 0:
+        if len(tscan):
+            info = [tinfo for rinfo in info for tinfo in rinfo]
+            order = np.concatenate([np.arange(ii,len(tscan),size) for ii in range(size)]).astype(np.int64)
+            rows  = np.where(scan)[0][order]
+            for icol,col in enumerate(columns[1:7]):
+                findex.loc[findex.index[rows],col] = [tinfo[icol] for tinfo in info]
+        findex.to_csv(wiki_file,index=False)
+    else:
+        findex = None
+    if comm is not None: findex = comm.bcast(findex,root=0)
+    return findex
+
+class FileIndex(object):
+    '''
+    this class keeps the file index of make_file_index in sorted intervals for each (network, station, 
+    channel), so that the files of a station overlapping a time chunk are found by binary search instead 
+    of scanning the times and names of all files. the files without station info in the index (times 
+    estimated from folder names when messydata is False) are kept in one group and matched by the station
+    and channel in the file name as before. (used in S0B)
+    PARAMETERS:
+    ----------------------
+    findex: pandas dataframe from make_file_index
+    '''
+    def __init__(self,findex):
+        self.groups = {}
+        findex = findex[np.isfinite(findex['starttime'].values)&np.isfinite(findex['endtime'].values)]
+        keys = findex[['network','station','channel']].fillna('').astype(str)
+        for key,grp in findex.groupby([keys['network'],keys['station'],keys['channel']],sort=False):
+            order = np.argsort(grp['starttime'].values,kind='stable')
+            tbeg  = grp['starttime'].values[order].astype(np.float64)
+            tend  = grp['endtime'].values[order].astype(np.float64)
+            # running max of the ending times (non-decreasing) to skip the files ending before a chunk
+            self.groups[key] = (tbeg,tend,np.maximum.accumulate(tend),np.array(grp['names'].values[order]))
+        self.unkeyed = self.groups.pop(('','',''),None)
+
+    def overlap(self,group,time1,time2):
+        # files of a group overlapping [time1,time2)
+        tbeg,tend,mend,names = group
+        i0 = np.searchsorted(mend,time1,side='right')
+        i1 = np.searchsorted(tbeg,time2,side='left')
+        if i1<=i0:return []
+        return list(names[i0:i1][tend[i0:i1]>time1])
+
+    def query(self,network,station,channel,time1,time2):
+        '''
+        returns the names of the files of the station/channel overlapping the time window [time1,time2) 
+        (timestamps)
+        '''
+        tfiles = []
+        key = (str(network),str(station),str(channel))
+        if key in self.groups:
+            tfiles = self.overlap(self.groups[key],time1,time2)
+        if self.unkeyed is not None:
+            tfiles += [ifile for ifile in self.overlap(self.unkeyed,time1,time2) if station in ifile and channel in ifile]
+        return tfiles
+
+    def has_data(self,time1,time2):
+        '''
+        returns True if any file overlaps the time window [time1,time2)
+        '''
+        groups = list(self.groups.values())
+        if self.unkeyed is not None:groups.append(self.unkeyed)
+        return any([len(self.overlap(group,time1,time2))>0 for group in groups])
 
 def preprocess_raw(st,inv,prepro_para,date_info):
     '''
     this function pre-processes the raw data stream by:
         1) check samping rate and gaps in the data;
         2) remove sigularity, trend and mean of each trace
-        3) filter and correct the time if integer time are between sampling points
+        3) resample (polyphase filter for rational ratios of sampling rates, interpolation otherwise), filter 
+           and correct the time if integer time are between sampling points
         4) remove instrument responses with selected methods including:
-            "inv"   -> using inventory information to remove_response;
+            "inv"   -> using inventory information to remove_response (as obspy remove_response);
             "spectrum"   -> use the inverse of response spectrum. (a script is provided in additional_module to estimate response spectrum from RESP files)
             "RESP_files" -> use the raw download RESP files
             "polezeros"  -> use pole/zero info for a crude correction of response
         5) trim data to a day-long sequence and interpolate it to ensure starting at 00:00:00.000
+    the traces are merged into one buffer, and the time intervals without data (gaps, nan/inf and padding) are
+    kept in the stats of the output trace as gaps (see merge_traces and write_gaps)
     (used in S0A & S0B)
     PARAMETERS:
     -----------------------
     st:  obspy stream object, containing noise data to be processed
     inv: obspy inventory object, containing stations info
     prepro_para: dict containing fft parameters, such as frequency bands and selection for instrument response removal etc. 
+                 the evaluated responses are cached in memory ('resp_cache_mem' in GB, optional) and on disk 
+                 ('resp_cachedir', optional) for the 'inv' and 'spectrum' options
     date_info:   dict of start and end time of the stream data
     RETURNS:
     -----------------------
@@ -175,28 +318,24 @@ def preprocess_raw(st,inv,prepro_para,date_info):
     sps = int(st[0].stats.sampling_rate)
     station = st[0].stats.station
 
-    # remove nan/inf, mean and trend of each trace before merging
-    for ii in range(len(st)):
-
-        #-----set nan/inf values to zeros (it does happens!)-----
-        tttindx = np.where(np.isnan(st[ii].data))
-        if len(tttindx) >0:st[ii].data[tttindx]=0
-        tttindx = np.where(np.isinf(st[ii].data))
-        if len(tttindx) >0:st[ii].data[tttindx]=0
-
-        st[ii].data = np.float32(st[ii].data)
-        st[ii].data = scipy.signal.detrend(st[ii].data,type='constant')
-        st[ii].data = scipy.signal.detrend(st[ii].data,type='linear')
-
-    # merge, taper and filter the data
-    if len(st)>1:st.merge(method=1,fill_value=0)
+    # remove nan/inf, mean and trend of each trace and merge them into one buffer (keeping the gaps)
+    st,gaps = merge_traces(st)
     st[0].taper(max_percentage=0.05,max_length=50)	# taper window
-    st[0].data = np.float32(bandpass(st[0].data,pre_filt[0],pre_filt[-1],df=sps,corners=4,zerophase=True))
+
+    # resample with the anti-aliasing polyphase filter for rational ratios of the sampling rates, so that
+    # the bandpass is done at the targeted (lower) sampling rate
+    ratio = None
+    if abs(samp_freq-sps) > 1E-4:
+        ratio = resample_ratio(st[0].stats.sampling_rate,samp_freq)
+    if ratio is not None:
+        st[0] = poly_resample(st[0],samp_freq,ratio[0],ratio[1])
+    st[0].data = np.float32(bandpass(st[0].data,pre_filt[0],pre_filt[-1],df=st[0].stats.sampling_rate,corners=4,zerophase=True))
 
     # make downsampling if needed
     if abs(samp_freq-sps) > 1E-4:
-        # downsampling here
-        st.interpolate(samp_freq,method='weighted_average_slopes')
+        # downsampling here (interpolation when the ratio is not rational)
+        if ratio is None:
+            st.interpolate(samp_freq,method='weighted_average_slopes')
         delta = st[0].stats.delta
 
         # when starttimes are between sampling points
@@ -208,8 +347,9 @@ def preprocess_raw(st,inv,prepro_para,date_info):
 
     # remove traces of too small length
 
-    # options to remove instrument response
+    # options to remove instrument response (the inverted responses are cached across calls)
     if rm_resp != 'no':
+        resp_cache = get_resp_cache(prepro_para)
         if rm_resp != 'inv':
             if (respdir is None) or (not os.path.isdir(respdir)):
                 raise ValueError('response file folder not found! abort!')
@@ -221,8 +361,8 @@ def preprocess_raw(st,inv,prepro_para,date_info):
             else:
                 try:
                     print('removing response for %s using inv'%st[0])
-                    st[0].attach_response(inv)
-                    st[0].remove_response(output="VEL",pre_filt=pre_filt,water_level=60)
+                    resp  = inv_response(st[0],inv,pre_filt,water_level=60,output="VEL",resp_cache=resp_cache)
+                    st[0] = apply_response(st[0],resp)
                 except Exception:
                     st = []
                     return st
@@ -232,7 +372,7 @@ def preprocess_raw(st,inv,prepro_para,date_info):
             specfile = glob.glob(os.path.join(respdir,'*'+station+'*'))
             if len(specfile)==0:
                 raise ValueError('no response sepctrum found for %s' % station)
-            st = resp_spectrum(st,specfile[0],samp_freq,pre_filt)
+            st = resp_spectrum(st,specfile[0],samp_freq,pre_filt,resp_cache)
 
         elif rm_resp == 'RESP':
             print('remove response using RESP files')
@@ -253,13 +393,20 @@ def preprocess_raw(st,inv,prepro_para,date_info):
 
     ntr = obspy.Stream()
     # trim a continous segment into user-defined sequences
+    tbeg,tend = st[0].stats.starttime.timestamp,st[0].stats.endtime.timestamp+st[0].stats.delta
     st[0].trim(starttime=date_info['starttime'],endtime=date_info['endtime'],pad=True,fill_value=0)
     ntr.append(st[0])
 
+    # gaps within the trimmed trace including the padded parts
+    wbeg,wend = ntr[0].stats.starttime.timestamp,ntr[0].stats.endtime.timestamp+ntr[0].stats.delta
+    gaps = np.vstack(([[wbeg,tbeg]],gaps,[[tend,wend]]))
+    gaps = np.clip(gaps,wbeg,wend)
+    ntr[0].stats.gaps = gaps[gaps[:,1]>gaps[:,0]]
+
     return ntr
 
 
-def stats2inv(stats,prepro_para,locs=None):
+def stats2inv(stats,prepro_para,locs=None,inv_cache=None):
     '''
     this function creates inventory given the stats parameters in an obspy stream or a station list.
     (used in S0B)
@@ -268,6 +415,7 @@ def stats2inv(stats,prepro_para,locs=None):
     stats: obspy trace stats object containing all station header info
     prepro_para: dict containing fft parameters, such as frequency bands and selection for instrument response removal etc. 
     locs:  panda data frame of the station list. it is needed for convering miniseed files into ASDF
+    inv_cache: InventoryCache of the StationXML files to look up first (optional)
     RETURNS:
     ------------------------
     inv: obspy inventory object of all station info to be used later
@@ -280,9 +428,12 @@ def stats2inv(stats,prepro_para,locs=None):
         if not respdir:
             raise ValueError('Abort! staxml is selected but no directory is given to access the files')
         else:
+            if inv_cache is not None:
+                inv = inv_cache.get(stats.network,stats.station,stats.location,stats.channel,stats.starttime,stats.endtime)
+                if inv is not None:return inv
             invfile = glob.glob(os.path.join(respdir,'*'+stats.station+'*'))
-            if os.path.isfile(str(invfile)):
-                inv = obspy.read_inventory(invfile)
+            if len(invfile):
+                inv = obspy.read_inventory(invfile[0])
                 return inv
 	
     inv = Inventory(networks=[],source="homegrown")
@@ -391,14 +542,17 @@ def sta_info_from_inv(inv):
     return sta,net,lon,lat,elv,location
 
 
-def cut_trace_make_statis(fc_para,source):
+def cut_trace_make_statis(fc_para,source,dataS=None):
     '''
     this function cuts continous noise data into user-defined segments, estimate the statistics of 
-    each segment and keep timestamp of each segment for later use. (used in S1)
+    each segment and keep timestamp of each segment for later use. the segments are strided views of 
+    the trace and the data are only copied once into dataS, where demean/detrend/taper and the 
+    statistics are done by one compiled kernel. (used in S1)
     PARAMETERS:
     ----------------------
     fft_para: A dictionary containing all fft and cc parameters.
     source: obspy stream object
+    dataS:  preallocated float32 buffer of (nseg,npts) to reuse for the segments (optional)
     RETURNS:
     ----------------------
     trace_stdS: standard deviation of the noise amplitude of each segment
@@ -406,7 +560,7 @@ def cut_trace_make_statis(fc_para,source):
     dataS:      2D matrix of the segmented data
     '''
     # define return variables first
-    source_params=[];dataS_t=[];dataS=[]
+    source_params=[];dataS_t=[]
 
     # load parameter from dic
     inc_hours = fc_para['inc_hours']
@@ -422,38 +576,33 @@ def cut_trace_make_statis(fc_para,source):
 
     # confim data has been correctly pre-processed
     if data.size < sps*inc_hours*3600:
-        return source_params,dataS_t,dataS
+        return source_params,dataS_t,[]
 
     # statistic to detect segments that may be associated with earthquakes
     all_madS = mad(data)	            # median absolute deviation over all noise window
     all_stdS = np.std(data)	        # standard deviation over all noise window
     if all_madS==0 or all_stdS==0 or np.isnan(all_madS) or np.isnan(all_stdS):
         print("continue! madS or stdS equals to 0 for %s" % source)
-        return source_params,dataS_t,dataS
+        return source_params,dataS_t,[]
 
-    # initialize variables
+    # overlapping segments as a read-only strided view of the trace (no copy)
     npts = cc_len*sps
-    #trace_madS = np.zeros(nseg,dtype=np.float32)
-    trace_stdS = np.zeros(nseg,dtype=np.float32)
-    dataS    = np.zeros(shape=(nseg,npts),dtype=np.float32)
-    dataS_t  = np.zeros(nseg,dtype=np.float)
-    
-    indx1 = 0
-    for iseg in range(nseg):
-        indx2 = indx1+npts
-        dataS[iseg] = data[indx1:indx2]
-        #trace_madS[iseg] = (np.max(np.abs(dataS[iseg]))/all_madS)
-        trace_stdS[iseg] = (np.max(np.abs(dataS[iseg]))/all_stdS)
-        dataS_t[iseg]    = starttime+step*iseg
-        indx1 = indx1+step*sps
-
-    # 2D array processing
-    dataS = demean(dataS)
-    dataS = detrend(dataS)
-    dataS = taper(dataS)
+    segs = np.lib.stride_tricks.as_strided(data,shape=(nseg,npts),\
+        strides=(step*sps*data.strides[0],data.strides[0]),writeable=False)
 
-    return trace_stdS,dataS_t,dataS
+    dataS_t = starttime+step*np.arange(nseg,dtype=np.float64)
 
+    # the only copy of the segments, into the buffer if provided
+    if dataS is None or dataS.shape != (nseg,npts):
+        dataS = np.zeros(shape=(nseg,npts),dtype=np.float32)
+    dataS[:] = segs
+
+    # demean, detrend and taper in one compiled pass, which also gives the max amplitude of each 
+    # segment to compare with the std of the whole trace
+    stats = demean_detrend_taper(dataS,taper_window(npts))
+    trace_stdS = (stats[:,0]/all_stdS).astype(np.float32)
+
+    return trace_stdS,dataS_t,dataS
 
 def noise_processing(fft_para,dataS):
     '''
@@ -464,13 +613,12 @@ def noise_processing(fft_para,dataS):
     fft_para: dictionary containing all useful variables used for fft and cc
     dataS: 2D matrix of all segmented noise data
     # OUTPUT VARIABLES:
-    source_white: 2D matrix of data spectra
+    source_white: 2D complex64 matrix of data spectra (one-sided of Nfft//2+1 points if real_fft is selected)
     '''
     # load parameters first
     time_norm   = fft_para['time_norm']
     to_whiten   = fft_para['to_whiten']
     smooth_N    = fft_para['smooth_N']
-    N = dataS.shape[0]
 
     #------to normalize in time or not------
     if time_norm != 'no':
@@ -478,9 +626,7 @@ def noise_processing(fft_para,dataS):
         if time_norm == 'one_bit': 	# sign normalization
             white = np.sign(dataS)
         elif time_norm == 'running_mean': # running mean: normalization over smoothed absolute average           
-            white = np.zeros(shape=dataS.shape,dtype=dataS.dtype)
-            for kkk in range(N):
-                white[kkk,:] = dataS[kkk,:]/moving_ave(np.abs(dataS[kkk,:]),smooth_N)
+            white = running_mean_norm(dataS,smooth_N)
 
     else:	# don't normalize
         white = dataS
@@ -490,37 +636,100 @@ def noise_processing(fft_para,dataS):
         source_white = whiten(white,fft_para)	# whiten and return FFT
     else:
         Nfft = int(next_fast_len(int(dataS.shape[1])))
-        source_white = scipy.fftpack.fft(white, Nfft, axis=1) # return FFT
+        source_white = fft_forward(fft_para,white,Nfft,axis=1)   # return FFT (one-sided for real_fft)
     
     return source_white
 
 
-def smooth_source_spect(cc_para,fft1):
+def fft_forward(fft_para,data,Nfft,axis=-1):
+    '''
+    this function is the forward fft used for the noise segments. it runs scipy.fft in single precision 
+    (float32 in, complex64 out) with fft_workers threads, so that the spectra are not upcasted to 
+    complex128 before being kept in memory. (used in noise_processing and whiten)
+    PARAMETERS:
+    ---------------------
+    fft_para: dict containing the fft parameters
+        real_fft:    return the one-sided spectrum (Nfft//2+1 points) from rfft (optional)
+        fft_workers: number of threads for each fft call (optional, default 1)
+    data: N-D matrix of real data
+    Nfft: number of points of the fft
+    axis: axis along which the fft is done
+    RETURNS:
+    ---------------------
+    spect: N-D complex64 matrix of spectra
+    '''
+    workers = fft_para.get('fft_workers',1)
+    data = np.asarray(data,dtype=np.float32)
+    if fft_para.get('real_fft',False):
+        return scipy.fft.rfft(data,Nfft,axis=axis,workers=workers)
+    else:
+        return scipy.fft.fft(data,Nfft,axis=axis,workers=workers)
+
+def fft_inverse(fft_para,spect,Nfft,axis=-1):
+    '''
+    this function is the inverse fft of fft_forward: single precision scipy.fft with fft_workers threads.
+    (used in spect_to_ccf)
+    PARAMETERS:
+    ---------------------
+    fft_para: dict containing the fft parameters (real_fft and fft_workers as in fft_forward)
+    spect: N-D matrix of spectra (one-sided of Nfft//2+1 points if real_fft is selected)
+    Nfft:  number of points of the ifft
+    axis:  axis along which the ifft is done
+    RETURNS:
+    ---------------------
+    data: N-D float32 matrix from irfft or complex64 matrix from ifft
+    '''
+    workers = fft_para.get('fft_workers',1)
+    spect = np.asarray(spect,dtype=np.complex64)
+    if fft_para.get('real_fft',False):
+        return scipy.fft.irfft(spect,Nfft,axis=axis,workers=workers)
+    else:
+        return scipy.fft.ifft(spect,Nfft,axis=axis,workers=workers)
+
+def smooth_spect(cc_para,fft1):
+    '''
+    this function smoothes the amplitude spectrum of a station, which is used to normalize the spectrum
+    in the deconv and coherency cross-correlation. it only needs to be done once per station in a time
+    chunk and can be shared by all station pairs of that station. (used in S1)
+    PARAMETERS:
+    ---------------------
+    cc_para: dictionary containing useful cc parameters
+    fft1:    1D spectrum (all segments of the station)
+    
+    RETURNS:
+    ---------------------
+    temp: float32 numpy array of the smoothed amplitude spectrum
+    '''
+    smoothspect_N = cc_para['smoothspect_N']
+    temp = moving_ave(np.abs(fft1),smoothspect_N)
+    return temp
+
+def smooth_source_spect(cc_para,fft1,temp=None):
     '''
     this function smoothes amplitude spectrum of the 2D spectral matrix. (used in S1)
     PARAMETERS:
     ---------------------
     cc_para: dictionary containing useful cc parameters
     fft1:    source spectrum matrix
+    temp:    precomputed smoothed amplitude spectrum of fft1 (output of smooth_spect). optional
     
     RETURNS:
     ---------------------
     sfft1: complex numpy array with normalized spectrum
     '''
     cc_method = cc_para['cc_method']
-    smoothspect_N = cc_para['smoothspect_N']
 
     if cc_method == 'deconv':
 
         #-----normalize single-station cc to z component-----
-        temp = moving_ave(np.abs(fft1),smoothspect_N)
+        if temp is None: temp = smooth_spect(cc_para,fft1)
         try:
             sfft1 = np.conj(fft1)/temp**2
         except Exception:
             raise ValueError('smoothed spectrum has zero values')
 
     elif cc_method == 'coherency':
-        temp = moving_ave(np.abs(fft1),smoothspect_N)
+        if temp is None: temp = smooth_spect(cc_para,fft1)
         try:
             sfft1 = np.conj(fft1)/temp
         except Exception:
@@ -534,7 +743,7 @@ def smooth_source_spect(cc_para,fft1):
     
     return sfft1
 
-def correlate(fft1_smoothed_abs,fft2,D,Nfft,dataS_t):
+def correlate(fft1_smoothed_abs,fft2,D,Nfft,dataS_t,fft2_smoothed=None):
     '''
     this function does the cross-correlation in freq domain and has the option to keep sub-stacks of 
     the cross-correlation if needed. it takes advantage of the linear relationship of ifft, so that 
@@ -550,14 +759,50 @@ def correlate(fft1_smoothed_abs,fft2,D,Nfft,dataS_t):
         method:  cross-correlation methods selected by the user
         freqmin: minimum frequency (Hz)
         freqmax: maximum frequency (Hz)
+        real_fft: use irfft to go back to time domain (optional)
+        fft_workers: number of threads for the ifft (optional)
     Nfft:    number of frequency points for ifft
     dataS_t: matrix of datetime object.
+    fft2_smoothed: precomputed smoothed amplitude spectrum of the receiver for coherency (optional)
     RETURNS:
     ---------------------
     s_corr: 1D or 2D matrix of the averaged or sub-stacks of cross-correlation functions in time domain
     t_corr: timestamp for each sub-stack or averaged function
     n_corr: number of included segments for each sub-stack or averaged function
     '''
+    # a single pair is a 1x1 tile for the block engine
+    pairs = np.zeros((1,2),dtype=np.int32)
+    if fft2_smoothed is not None: fft2_smoothed = fft2_smoothed[None]
+    results = correlate_block(fft1_smoothed_abs[None],fft2[None],pairs,D,Nfft,np.asarray(dataS_t)[None],\
+        norm2=fft2_smoothed)
+    return results[0]
+
+def correlate_block(sfft1,fft2,pairs,D,Nfft,dataS_t,good1=None,good2=None,norm2=None):
+    '''
+    this function cross-correlates a tile of source spectra with a tile of receiver spectra in one
+    vectorized pass. pairs sharing the same set of good segments are grouped together so that the
+    complex multiplication, the coherency normalization, the sub-stacking and the ifft are all done
+    on 3D arrays of (pair,segment,frequency) instead of one pair at a time. the outputs are identical
+    to those from calling correlate on each pair. (used in S1)
+    PARAMETERS:
+    ---------------------
+    sfft1:  3D matrix (nsource,nwin,nfreq) of smoothed source spectra (output of smooth_source_spect)
+    fft2:   3D matrix (nreceiver,nwin,nfreq) of raw receiver spectra. nfreq is Nfft//2, or the number
+            of bins in the frequency band (see freq_band_index) when band_limit is selected in D
+    pairs:  2D integer array (npair,2) of source and receiver indexes in the two tiles
+    D:      dictionary containing the cc parameters (see correlate)
+    Nfft:   number of frequency points for ifft
+    dataS_t: 2D matrix (nreceiver,nwin) of the timestamps of each receiver segment
+    good1:  2D boolean matrix (nsource,nwin) of segments to use for the source (default: all)
+    good2:  2D boolean matrix (nreceiver,nwin) of segments to use for the receiver (default: all)
+    norm2:  3D matrix (nreceiver,nwin,nfreq) of precomputed smoothed amplitude spectra of the receivers
+            (output of smooth_spect) for the coherency method. when not given, they are computed here
+            over the common good segments of each pair
+    RETURNS:
+    ---------------------
+    results: list of (s_corr,t_corr,n_corr) for each pair (see correlate), None if the pair has no
+             common good segments
+    '''
     #----load paramters----
     dt      = D['dt']
     maxlag  = D['maxlag']
@@ -565,96 +810,326 @@ def correlate(fft1_smoothed_abs,fft2,D,Nfft,dataS_t):
     cc_len  = D['cc_len'] 
     substack= D['substack']                                                          
     substack_len  = D['substack_len']
-    smoothspect_N = D['smoothspect_N']
-
-    nwin  = fft1_smoothed_abs.shape[0]
-    Nfft2 = fft1_smoothed_abs.shape[1]
-
-    #------convert all 2D arrays into 1D to speed up--------
-    corr = np.zeros(nwin*Nfft2,dtype=np.complex64)
-    corr = fft1_smoothed_abs.reshape(fft1_smoothed_abs.size,)*fft2.reshape(fft2.size,)
-
-    if method == "coherency":
-        temp = moving_ave(np.abs(fft2.reshape(fft2.size,)),smoothspect_N)             
-        corr /= temp
-    corr  = corr.reshape(nwin,Nfft2)
-
-    if substack:
-        if substack_len == cc_len:
-            # choose to keep all fft data for a day
-            s_corr = np.zeros(shape=(nwin,Nfft),dtype=np.float32)   # stacked correlation
-            ampmax = np.zeros(nwin,dtype=np.float32)
-            n_corr = np.zeros(nwin,dtype=np.int16)                  # number of correlations for each substack
-            t_corr = dataS_t                                        # timestamp
-            crap   = np.zeros(Nfft,dtype=np.complex64)
-            for i in range(nwin): 
-                n_corr[i]= 1           
-                crap[:Nfft2] = corr[i,:]
-                crap[:Nfft2] = crap[:Nfft2]-np.mean(crap[:Nfft2])   # remove the mean in freq domain (spike at t=0)
-                crap[-(Nfft2)+1:] = np.flip(np.conj(crap[1:(Nfft2)]),axis=0)
-                crap[0]=complex(0,0)
-                s_corr[i,:] = np.real(np.fft.ifftshift(scipy.fftpack.ifft(crap, Nfft, axis=0)))
-
-            # remove abnormal data
-            ampmax = np.max(s_corr,axis=1)
-            tindx  = np.where( (ampmax<20*np.median(ampmax)) & (ampmax>0))[0]
-            s_corr = s_corr[tindx,:]
-            t_corr = t_corr[tindx]
-            n_corr = n_corr[tindx]
-        
-        else:     
-            # get time information
-            Ttotal = dataS_t[-1]-dataS_t[0]             # total duration of what we have now
-            tstart = dataS_t[0]
-
-            nstack = int(np.round(Ttotal/substack_len))
-            ampmax = np.zeros(nstack,dtype=np.float32)
-            s_corr = np.zeros(shape=(nstack,Nfft),dtype=np.float32)
-            n_corr = np.zeros(nstack,dtype=np.int)
-            t_corr = np.zeros(nstack,dtype=np.float)
-            crap   = np.zeros(Nfft,dtype=np.complex64)                                              
-
-            for istack in range(nstack):                                                                   
-                # find the indexes of all of the windows that start or end within 
-                itime = np.where( (dataS_t >= tstart) & (dataS_t < tstart+substack_len) )[0]  
-                if len(itime)==0:tstart+=substack_len;continue
-                
-                crap[:Nfft2] = np.mean(corr[itime,:],axis=0)   # linear average of the correlation 
-                crap[:Nfft2] = crap[:Nfft2]-np.mean(crap[:Nfft2])   # remove the mean in freq domain (spike at t=0)
-                crap[-(Nfft2)+1:]=np.flip(np.conj(crap[1:(Nfft2)]),axis=0)
-                crap[0]=complex(0,0)
-                s_corr[istack,:] = np.real(np.fft.ifftshift(scipy.fftpack.ifft(crap, Nfft, axis=0)))
-                n_corr[istack] = len(itime)               # number of windows stacks
-                t_corr[istack] = tstart                   # save the time stamps
-                tstart += substack_len
-                #print('correlation done and stacked at time %s' % str(t_corr[istack]))
+    band_limit    = D.get('band_limit',False)
+
+    nwin  = sfft1.shape[1]
+    nfreq = sfft1.shape[2]
+    Nfft2 = Nfft//2
+    # first frequency bin of the stored spectra
+    if band_limit:
+        low = freq_band_index(D,Nfft)[0]
+    else: low = 0
+    if good1 is None: good1 = np.ones((sfft1.shape[0],nwin),dtype=np.bool_)
+    if good2 is None: good2 = np.ones((fft2.shape[0],nwin),dtype=np.bool_)
+
+    # index of lags to keep in [-maxlag maxlag]
+    t = np.arange(-Nfft2+1, Nfft2)*dt
+    ind = np.where(np.abs(t) <= maxlag)[0]
+
+    # group pairs by their common good segments (and timestamps) to vectorize over pairs
+    pairs  = np.asarray(pairs)
+    groups = {}
+    for ipair in range(pairs.shape[0]):
+        iS,iR = pairs[ipair]
+        bb = np.where(good1[iS]&good2[iR])[0]
+        if not len(bb): continue
+        key = bb.tobytes()+dataS_t[iR][bb].tobytes()
+        groups.setdefault(key,[]).append(ipair)
+
+    results = [None]*pairs.shape[0]
+    for key in groups:
+        gpair = np.array(groups[key])
+        iS = pairs[gpair,0];iR = pairs[gpair,1]
+        bb = np.where(good1[iS[0]]&good2[iR[0]])[0]
+        tdata = dataS_t[iR[0]][bb]
+        npair = len(gpair);nb = len(bb)
+
+        #------cross-spectrum of all pairs in the group--------
+        corr = sfft1[iS][:,bb,:]*fft2[iR][:,bb,:]
+
+        if method == "coherency" and norm2 is not None:
+            corr /= norm2[iR][:,bb,:]
+        elif method == "coherency":
+            # smoothed receiver spectrum only computed once per receiver of the group
+            for tR in np.unique(iR):
+                temp = smooth_spect(D,fft2[tR][bb].reshape(nb*nfreq,))
+                corr[iR==tR] /= temp.reshape(nb,nfreq)
+
+        if substack:
+            if substack_len == cc_len:
+                # choose to keep all fft data for a day
+                n_corr = np.ones(nb,dtype=np.int16)             # number of correlations for each substack
+                t_corr = tdata                                  # timestamp
+                s_corr = spect_to_ccf(D,corr,Nfft,low=low)
             
-            # remove abnormal data
-            ampmax = np.max(s_corr,axis=1)
-            tindx  = np.where( (ampmax<20*np.median(ampmax)) & (ampmax>0))[0]
-            s_corr = s_corr[tindx,:]
-            t_corr = t_corr[tindx]
-            n_corr = n_corr[tindx]
+            else:     
+                # get time information
+                Ttotal = tdata[-1]-tdata[0]                     # total duration of what we have now
+                tstart = tdata[0]
+
+                nstack = int(np.round(Ttotal/substack_len))
+                n_corr = np.zeros(nstack,dtype=np.int64)
+                t_corr = np.zeros(nstack,dtype=np.float64)
+                scorr  = np.zeros(shape=(npair,nstack,nfreq),dtype=np.complex64)
+
+                for istack in range(nstack):                                                                   
+                    # find the indexes of all of the windows that start or end within 
+                    itime = np.where( (tdata >= tstart) & (tdata < tstart+substack_len) )[0]  
+                    if len(itime)==0:tstart+=substack_len;continue
+                    
+                    scorr[:,istack] = np.mean(corr[:,itime,:],axis=1)   # linear average of the correlation 
+                    n_corr[istack] = len(itime)               # number of windows stacks
+                    t_corr[istack] = tstart                   # save the time stamps
+                    tstart += substack_len
+                
+                s_corr = spect_to_ccf(D,scorr,Nfft,low=low)
+
+            # remove abnormal data for each pair
+            ampmax = np.max(s_corr,axis=2)
+            for ii in range(npair):
+                tindx  = np.where( (ampmax[ii]<20*np.median(ampmax[ii])) & (ampmax[ii]>0))[0]
+                results[gpair[ii]] = (s_corr[ii][tindx][:,ind],t_corr[tindx],n_corr[tindx])
 
+        else:
+            # average daily cross correlation functions
+            s_corr = spect_to_ccf(D,np.mean(corr,axis=1),Nfft,zero_dc=False,low=low)
+            s_corr = s_corr[:,ind]
+            for ii in range(npair):
+                results[gpair[ii]] = (s_corr[ii],tdata[0],nb)
+
+    return results
+
+def spect_to_ccf(D,corr,Nfft,zero_dc=True,low=0):
+    '''
+    this function transforms the one-sided cross-spectra back to the time domain. band-limited spectra
+    are zero-padded back to Nfft//2 points, the mean of each spectrum is removed (spike at t=0) and the 
+    batched inverse fft is done along the last axis, either
+    with irfft on the one-sided spectra or with ifft after rebuilding the negative frequencies by 
+    Hermitian symmetry. (used in S1)
+    PARAMETERS:
+    ---------------------
+    D:    dict containing the fft parameters for fft_inverse (real_fft to use irfft instead of the full ifft)
+    corr: N-D matrix of one-sided cross-spectra with frequency on the last axis
+    Nfft: number of frequency points for ifft
+    zero_dc: set the zero-frequency term to 0 (done for the sub-stacks but not for the daily average)
+    low:  index of the first frequency bin of corr in the one-sided spectrum (0 if not band-limited)
+    RETURNS:
+    ---------------------
+    s_corr: N-D float32 matrix of cross-correlation functions centered at zero lag
+    '''
+    real_fft = D.get('real_fft',False)
+    Nfft2 = Nfft//2
+    nfreq = corr.shape[-1]
+    if real_fft:
+        crap  = np.zeros(corr.shape[:-1]+(Nfft//2+1,),dtype=np.complex64)
     else:
-        # average daily cross correlation functions
-        n_corr = nwin
-        s_corr = np.zeros(Nfft,dtype=np.float32)
-        t_corr = dataS_t[0]
-        crap   = np.zeros(Nfft,dtype=np.complex64)
-        crap[:Nfft2] = np.mean(corr,axis=0)
-        crap[:Nfft2] = crap[:Nfft2]-np.mean(crap[:Nfft2],axis=0)
-        crap[-(Nfft2)+1:]=np.flip(np.conj(crap[1:(Nfft2)]),axis=0)
-        s_corr = np.real(np.fft.ifftshift(scipy.fftpack.ifft(crap, Nfft, axis=0)))
-
-    # trim the CCFs in [-maxlag maxlag] 
-    t = np.arange(-Nfft2+1, Nfft2)*dt
-    ind = np.where(np.abs(t) <= maxlag)[0]
-    if s_corr.ndim==1:
-        s_corr = s_corr[ind]
-    elif s_corr.ndim==2:
-        s_corr = s_corr[:,ind]
-    return s_corr,t_corr,n_corr
+        crap  = np.zeros(corr.shape[:-1]+(Nfft,),dtype=np.complex64)
+    crap[...,low:low+nfreq] = corr
+    crap[...,:Nfft2] = crap[...,:Nfft2]-np.mean(crap[...,:Nfft2],axis=-1,keepdims=True)   # remove the mean in freq domain (spike at t=0)
+    if zero_dc: crap[...,0] = complex(0,0)
+
+    if real_fft:
+        s_corr = np.fft.ifftshift(fft_inverse(D,crap,Nfft,axis=-1),axes=-1)
+    else:
+        crap[...,-(Nfft2)+1:] = np.flip(np.conj(crap[...,1:(Nfft2)]),axis=-1)
+        s_corr = np.real(np.fft.ifftshift(fft_inverse(D,crap,Nfft,axis=-1),axes=-1))
+    return s_corr.astype(np.float32)
+
+def cc_tile_size(cc_para,nwin,Nfft,mem_used=0,nfreq=None):
+    '''
+    this function estimates the number of station pairs that can be cross-correlated in one block 
+    of correlate_block within the memory budget of MAX_MEM. (used in S1)
+    PARAMETERS:
+    ---------------------
+    cc_para:  dict containing the cc parameters including MAX_MEM (in GB)
+    nwin:     number of segments in the time chunk
+    Nfft:     number of frequency points for ifft
+    mem_used: memory (in bytes) already taken by the spectra in memory
+    nfreq:    number of frequency bins kept for each segment (default Nfft//2)
+    RETURNS:
+    ---------------------
+    ntile: number of stations in each source/receiver tile
+    '''
+    # cross-spectra (complex64) + ifft buffer (complex64) + ccfs (float32) for each pair
+    if nfreq is None: nfreq = Nfft//2
+    nbytes = nwin*(3*nfreq*8+Nfft*8+Nfft*4)
+    budget = cc_para['MAX_MEM']*1024**3-mem_used
+    ntile  = int(np.floor(np.sqrt(max(budget,0)/nbytes)))
+    return max(ntile,1)
+
+def bcast_rows(comm,arrays,nrow):
+    '''
+    this function shares the rows of arrays filled by each rank of an MPI communicator with all 
+    other ranks of it. each rank fills its own rows from the top of the arrays, which are moved 
+    after the rows of the lower ranks and broadcasted as one block per rank (split in pieces of at
+    most 1 GB for the 32-bit counts of MPI). (used in S1 when several ranks share the FFT of one
+    time chunk)
+    PARAMETERS:
+    ---------------------
+    comm:   MPI communicator of the ranks sharing the arrays
+    arrays: list of numpy arrays (or memmaps) with the same number of rows on all ranks
+    nrow:   number of rows filled by this rank
+    RETURNS:
+    ---------------------
+    ntotal: total number of rows on all ranks
+    '''
+    rank   = comm.Get_rank()
+    counts = comm.allgather(nrow)
+    offset = np.concatenate(([0],np.cumsum(counts))).astype(np.int64)
+    for arr in arrays:
+        if arr.size==0:continue
+        if offset[rank]:arr[offset[rank]:offset[rank+1]] = arr[:nrow].copy()
+        step = max(1,2**30//max(arr[:1].nbytes,1))
+        for irank in range(comm.Get_size()):
+            for ii in range(offset[irank],offset[irank+1],step):
+                comm.Bcast(arr[ii:min(ii+step,offset[irank+1])],root=irank)
+    return int(offset[-1])
+
+def geodesic_inverse(lat1,lon1,lat2,lon2,a=6378137.0,f=1/298.257223563):
+    '''
+    this function computes the distance and the forward and backward azimuths between arrays of points on
+    the WGS84 ellipsoid with the Vincenty inverse formulae of obspy.geodetics.base.calc_vincenty_inverse
+    (used by gps2dist_azimuth without geographiclib), vectorized over the points. nearly antipodal points
+    that do not converge get (20004314.5,0,0) as in gps2dist_azimuth. (used in select_station_pairs)
+    PARAMETERS:
+    ---------------------
+    lat1,lon1: latitude and longitude of the first points (degree)
+    lat2,lon2: latitude and longitude of the second points (degree)
+    RETURNS:
+    ---------------------
+    dist,azi,baz: distance (m), azimuth from the first to the second points and back-azimuth (degree)
+    '''
+    lat1 = np.radians(np.asarray(lat1,dtype=np.float64));lat2 = np.radians(np.asarray(lat2,dtype=np.float64))
+    # longitudes in [-180,180] as in obspy
+    lon1,lon2 = [np.asarray(lon,dtype=np.float64) for lon in [lon1,lon2]]
+    lon1,lon2 = [np.radians(np.where(lon>180,lon-360*np.ceil((lon-180)/360),np.where(lon<-180,lon+360*np.ceil((-180-lon)/360),lon))) for lon in [lon1,lon2]]
+    b = a*(1-f)
+    u_1 = np.arctan((1-f)*np.tan(lat1));u_2 = np.arctan((1-f)*np.tan(lat2))
+    omega = lon2-lon1
+    dlon  = omega.copy()
+    # same tolerance as math.isclose
+    same  = (np.abs(lat1-lat2)<=1e-9*np.maximum(np.abs(lat1),np.abs(lat2)))&(np.abs(lon1-lon2)<=1e-9*np.maximum(np.abs(lon1),np.abs(lon2)))
+    # iterate on the points that have not converged yet
+    todo = ~same;fail = np.zeros(dlon.shape,dtype=bool)
+    sin_sigma = np.ones(dlon.shape);cos_sigma = np.ones(dlon.shape);sigma = np.zeros(dlon.shape)
+    sqr_sin_sigma = np.ones(dlon.shape);sqr_cos_alpha = np.ones(dlon.shape);cos2sigma_m = np.zeros(dlon.shape)
+    for it in range(101):
+        if not np.any(todo):break
+        cu1,su1,cu2,su2,tl = np.cos(u_1[todo]),np.sin(u_1[todo]),np.cos(u_2[todo]),np.sin(u_2[todo]),dlon[todo]
+        tsqr = (cu2*np.sin(tl))**2+(cu1*su2-su1*cu2*np.cos(tl))**2
+        tsin = np.sqrt(tsqr)
+        tcos = su1*su2+cu1*cu2*np.cos(tl)
+        tsig = np.arctan2(tsin,tcos)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            sin_alpha = cu1*cu2*np.sin(tl)/tsin
+            tca = 1-sin_alpha*sin_alpha
+            t2m = np.where(tca==0,0,tcos-2*su1*su2/tca)
+        c = (f/16)*tca*(4+f*(4-3*tca))
+        new_dlon = omega[todo]+(1-c)*f*sin_alpha*(tsig+c*tsin*(t2m+c*tcos*(-1+2*t2m**2)))
+        sin_sigma[todo],cos_sigma[todo],sigma[todo],sqr_sin_sigma[todo] = tsin,tcos,tsig,tsqr
+        sqr_cos_alpha[todo],cos2sigma_m[todo] = tca,t2m
+        with np.errstate(divide='ignore',invalid='ignore'):
+            done = ~((new_dlon!=0)&(np.abs((tl-new_dlon)/new_dlon)>1.0e-9))
+        fail[np.where(todo)[0][~np.isfinite(new_dlon)]] = True
+        dlon[todo] = new_dlon
+        todo[np.where(todo)[0][done|~np.isfinite(new_dlon)]] = False
+    fail |= todo
+
+    u2 = sqr_cos_alpha*(a*a-b*b)/(b*b)
+    _a = 1+(u2/16384)*(4096+u2*(-768+u2*(320-175*u2)))
+    _b = (u2/1024)*(256+u2*(-128+u2*(74-47*u2)))
+    delta_sigma = _b*sin_sigma*(cos2sigma_m+(_b/4)*(cos_sigma*(-1+2*cos2sigma_m**2)-(_b/6)*\
+        cos2sigma_m*(-3+4*sqr_sin_sigma)*(-3+4*cos2sigma_m**2)))
+    dist = b*_a*(sigma-delta_sigma)
+    alpha12 = np.arctan2(np.cos(u_2)*np.sin(dlon),np.cos(u_1)*np.sin(u_2)-np.sin(u_1)*np.cos(u_2)*np.cos(dlon))
+    alpha21 = np.arctan2(np.cos(u_1)*np.sin(dlon),-np.sin(u_1)*np.cos(u_2)+np.cos(u_1)*np.sin(u_2)*np.cos(dlon))
+    alpha12 = np.where(alpha12<0,alpha12+2*np.pi,alpha12)
+    alpha21 = alpha21+np.pi
+    alpha21 = np.where(alpha21>2*np.pi,alpha21-2*np.pi,alpha21)
+    alpha12 = alpha12*360/(2.0*np.pi);alpha21 = alpha21*360/(2.0*np.pi)
+    dist[same] = 0;alpha12[same] = 0;alpha21[same] = 0
+    dist[fail] = 20004314.5;alpha12[fail] = 0;alpha21[fail] = 0
+    return dist,alpha12,alpha21
+
+def select_station_pairs(lon,lat,pair_para):
+    '''
+    this function selects the station pairs by inter-station distance, azimuth and number of nearest
+    neighbours. the candidate pairs are found with a KD-tree on the stations (unit sphere) and then 
+    checked with the same geodesic distance/azimuth as in cc_parameters (vectorized, see geodesic_inverse).
+    without max_dist and nneighbor the pairs of each station are checked row by row, so the full list of
+    pairs is never built. (used in S1 and S2)
+    PARAMETERS:
+    ---------------------
+    lon,lat:   longitude and latitude of each station (degree)
+    pair_para: dict containing the selection parameters (each can be None to not use it)
+        min_dist:  min inter-station distance (km)
+        max_dist:  max inter-station distance (km)
+        azi_range: [min,max] azimuth sector of the inter-station path (degree), checked for the azimuth 
+                   and back-azimuth as the order of the stations in a pair is alphabetical
+        nneighbor: number of nearest stations to keep for each station
+    RETURNS:
+    ---------------------
+    keep: set of (ii,jj) station indices (ii<=jj) of the selected pairs, including the auto-correlations
+          when min_dist is 0. None when all pairs are selected
+    '''
+    min_dist  = pair_para.get('min_dist',None)
+    max_dist  = pair_para.get('max_dist',None)
+    azi_range = pair_para.get('azi_range',None)
+    nneighbor = pair_para.get('nneighbor',None)
+    if not min_dist and max_dist is None and azi_range is None and nneighbor is None:
+        return None
+
+    # stations on the unit sphere: chord length is monotonic with the great-circle distance
+    nsta = len(lon)
+    lon  = np.asarray(lon,dtype=np.float64);lat = np.asarray(lat,dtype=np.float64)
+    xyz  = np.column_stack((np.cos(np.radians(lat))*np.cos(np.radians(lon)),\
+        np.cos(np.radians(lat))*np.sin(np.radians(lon)),np.sin(np.radians(lat))))
+    tree = cKDTree(xyz)
+
+    # candidate pairs (ii<jj) within max_dist (1% margin for the ellipsoid) and/or among the nearest neighbours
+    cand = None
+    if max_dist is not None:
+        rchord = 2*np.sin(np.minimum(1.01*max_dist/6371.0,np.pi)/2)
+        cand   = tree.query_pairs(rchord,output_type='ndarray').reshape(-1,2)
+    if nneighbor is not None and nsta>1:
+        # a few more candidates than needed as the tree works on the sphere, sorted by geodesic distance
+        kk = int(np.minimum(2*nneighbor+1,nsta))
+        _,indx = tree.query(xyz,k=kk)
+        indx = np.asarray(indx).reshape(nsta,kk)
+        ista = np.repeat(np.arange(nsta),kk).reshape(nsta,kk)
+        tdist = geodesic_inverse(lat[ista],lon[ista],lat[indx],lon[indx])[0]
+        indx = np.take_along_axis(indx,np.argsort(tdist,axis=1,kind='stable'),axis=1)
+        other = indx!=ista
+        other &= np.cumsum(other,axis=1)<=nneighbor
+        near = np.unique(np.sort(np.column_stack((ista[other],indx[other])),axis=1),axis=0)
+        if cand is None:
+            cand = near
+        else:
+            # pairs in both lists, with the pair (ii,jj) coded as ii*nsta+jj
+            cand = near[np.isin(near[:,0]*nsta+near[:,1],cand[:,0].astype(np.int64)*nsta+cand[:,1])]
+    elif nneighbor is not None:
+        cand = np.zeros((0,2),dtype=np.int64)
+
+    # check the candidates with the geodesic distance/azimuth (all pairs of one station at a time
+    # when there is no list of candidates)
+    keep = set()
+    blocks = [cand] if cand is not None else \
+        (np.column_stack((np.full(nsta-ii-1,ii),np.arange(ii+1,nsta))) for ii in range(nsta))
+    for tcand in blocks:
+        if not len(tcand):continue
+        ii,jj = tcand[:,0],tcand[:,1]
+        dist,azi,baz = geodesic_inverse(lat[ii],lon[ii],lat[jj],lon[jj])
+        dist = dist/1000
+        ok = np.ones(len(ii),dtype=bool)
+        if min_dist is not None:ok &= dist>=min_dist
+        if max_dist is not None:ok &= dist<=max_dist
+        if azi_range is not None and azi_range[1]-azi_range[0]<360:
+            width = (azi_range[1]-azi_range[0])%360
+            ok &= ((azi-azi_range[0])%360<=width)|((baz-azi_range[0])%360<=width)
+        keep.update(zip(ii[ok].tolist(),jj[ok].tolist()))
+    if not min_dist:
+        for ii in range(nsta):keep.add((ii,ii))
+    return keep
 
 def cc_parameters(cc_para,coor,tcorr,ncorr,comp):
     '''
@@ -697,6 +1172,1116 @@ def cc_parameters(cc_para,coor,tcorr,ncorr,comp):
         'comp':comp}
     return parameters
 
+class CCFWriter(object):
+    '''
+    this class buffers the cross-correlation functions (or their stacks) that go into one ASDF file
+    and writes them in bulk. the file is opened once on the first flush and held open until close,
+    so each station pair costs a python append instead of an HDF5 open/close and metadata flush. it
+    follows the add_auxiliary_data interface of pyasdf and can be used in a with statement like 
+    ASDFDataSet. (used in S1, S2 and version_optimize_IO/S3A&S3B)
+    PARAMETERS:
+    ---------------------
+    h5file:    path of the ASDF file to write into
+    max_bytes: size (in bytes) of the data buffered in memory before they are flushed to the file
+    logfile:   opened text file to record 'data_type path' of each item once it is on disk (optional)
+    '''
+    def __init__(self,h5file,max_bytes=100*1024**2,logfile=None):
+        self.h5file    = h5file
+        self.max_bytes = max_bytes
+        self.logfile   = logfile
+        self.ds        = None
+        self.buffer    = []
+        self.nbytes    = 0
+        self.nwrite    = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+        return False
+
+    def add_auxiliary_data(self,data,data_type,path,parameters):
+        '''
+        keep one item in the buffer and flush the buffer when it exceeds max_bytes. data and 
+        parameters are copied as the main scripts reuse their arrays and dicts for the next pair
+        '''
+        data = np.array(data)
+        self.buffer.append((data,data_type,path,copy.deepcopy(parameters)))
+        self.nbytes += data.nbytes
+        if self.nbytes >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        '''
+        write all buffered items into the ASDF file and record them in the logfile
+        '''
+        if not len(self.buffer):return
+        self._write(self.buffer)
+        if self.logfile is not None:
+            for data,data_type,path,parameters in self.buffer:
+                self.logfile.write(data_type+' '+path+'\n')
+            self.logfile.flush()
+        self.nwrite += len(self.buffer)
+        self.buffer  = []
+        self.nbytes  = 0
+
+    def _write(self,items):
+        '''
+        write the items into the ASDF file (opened on the first call)
+        '''
+        if self.ds is None:
+            self.ds = pyasdf.ASDFDataSet(self.h5file,mpi=False)
+        for data,data_type,path,parameters in items:
+            self.ds.add_auxiliary_data(data=data,data_type=data_type,path=path,parameters=parameters)
+        self.ds.flush()
+
+    def close(self):
+        '''
+        flush the remaining items and close the ASDF file
+        '''
+        self.flush()
+        if self.ds is not None:
+            # pyasdf closes the underlying HDF5 file once the dataset is released
+            del self.ds
+            self.ds = None
+
+class ColumnarCCFWriter(CCFWriter):
+    '''
+    this class writes the cross-correlation functions of one time chunk into a columnar HDF5 file instead of
+    one ASDF auxiliary dataset (and its dict of parameters) per station pair and component. the file holds:
+        attrs:              ccf_format='columnar' and the parameters shared by all pairs (dt,maxlag,cc_method,substack)
+        pairs/name,lonS,..: table of the station pairs with their coordinates, distance and azimuths
+        <path>/data:        chunked 2D array of the cross-correlation functions of all pairs of the component path
+                            (such as BHZ_BHZ), one row per segment and the rows of a pair next to each other
+        <path>/time,ngood:  timestamp and number of good windows of each row
+        <path>/pair:        row of the station pair in pairs/ for each row
+    so that a chunk has a few large datasets instead of millions of small HDF5 objects. the buffered items
+    are appended to the datasets at each flush. it has the interface of CCFWriter and the files are read
+    by CCFReader. (used in S1)
+    PARAMETERS:
+    ---------------------
+    h5file:     path of the HDF5 file to write into (appended if it exists)
+    max_bytes:  size (in bytes) of the data buffered in memory before they are flushed to the file
+    logfile:    opened text file to record 'data_type path' of each item once it is on disk (optional)
+    chunk_rows: number of rows in each HDF5 chunk of <path>/data (the lags are chunked by 1024 points)
+    '''
+    shared_keys = ['dt','maxlag','cc_method','substack']
+    pair_keys   = ['lonS','latS','lonR','latR','dist','azi','baz']
+
+    def __init__(self,h5file,max_bytes=100*1024**2,logfile=None,chunk_rows=32):
+        super(ColumnarCCFWriter,self).__init__(h5file,max_bytes,logfile)
+        self.chunk_rows = chunk_rows
+        self.pair_index = {}
+
+    def _append(self,grp,key,values,**kwargs):
+        '''
+        append values to the dataset key of grp along the first axis (created on the first call)
+        '''
+        if key not in grp:
+            grp.create_dataset(key,data=values,maxshape=(None,)+values.shape[1:],**kwargs)
+        else:
+            dset = grp[key]
+            nrow = dset.shape[0]
+            dset.resize(nrow+len(values),axis=0)
+            dset[nrow:] = values
+
+    def _write(self,items):
+        '''
+        append the items to the columnar file (opened on the first call)
+        '''
+        if self.ds is None:
+            self.ds = h5py.File(self.h5file,'a')
+            if 'pairs' in self.ds:
+                self.pair_index = {name:ii for ii,name in enumerate(self.ds['pairs']['name'].asstr()[:])}
+        f = self.ds
+        if 'ccf_format' not in f.attrs:
+            f.attrs['ccf_format'] = 'columnar'
+            for key in self.shared_keys:f.attrs[key] = items[0][3][key]
+
+        # new station pairs
+        new = [];pairs = f.require_group('pairs')
+        for data,data_type,path,parameters in items:
+            if data_type in self.pair_index:continue
+            self.pair_index[data_type] = len(self.pair_index)
+            new.append((data_type,parameters))
+        if len(new):
+            self._append(pairs,'name',np.array([data_type for data_type,parameters in new],dtype=h5py.string_dtype()),chunks=True)
+            for key in self.pair_keys:
+                self._append(pairs,key,np.array([parameters[key] for data_type,parameters in new],dtype=np.float32),chunks=True)
+
+        # rows of each component in the order of the items
+        for path in dict.fromkeys([item[2] for item in items]):
+            pitems = [item for item in items if item[2]==path]
+            nrow  = [item[0].size//item[0].shape[-1] for item in pitems]
+            cdata = np.concatenate([np.reshape(item[0],(nn,item[0].shape[-1])) for item,nn in zip(pitems,nrow)])
+            ttime = np.concatenate([np.reshape(item[3]['time'],-1) for item in pitems])
+            tgood = np.concatenate([np.reshape(item[3]['ngood'],-1) for item in pitems])
+            tpair = np.repeat([self.pair_index[item[1]] for item in pitems],nrow).astype(np.int32)
+            grp = f.require_group(path)
+            # the pair is written last with a fill value of -1, so rows cut by a crash are not taken for a pair
+            self._append(grp,'data',cdata,chunks=(self.chunk_rows,min(cdata.shape[1],1024)),compression='gzip',compression_opts=3)
+            self._append(grp,'time',ttime,chunks=True)
+            self._append(grp,'ngood',tgood,chunks=True)
+            self._append(grp,'pair',tpair,chunks=True,fillvalue=-1)
+        f.flush()
+
+    def close(self):
+        '''
+        flush the remaining items and close the HDF5 file
+        '''
+        self.flush()
+        if self.ds is not None:
+            self.ds.close()
+            self.ds = None
+
+class CCFReader(object):
+    '''
+    this class reads the cross-correlation functions of one file of S1 in the ASDF format (one auxiliary
+    dataset per station pair and component) or the columnar format of ColumnarCCFWriter, and gives them with
+    the same parameters as cc_parameters in both cases. for the columnar files the pair table and the time,
+    ngood and pair columns of a component are read once, and its data dataset is kept open so that the HDF5
+    chunks shared by neighbouring pairs stay in the chunk cache. it can be used in a with statement. (used
+    in S2, make_ccf_index, read_ccf_window and the plotting modules)
+    PARAMETERS:
+    ---------------------
+    h5file: name of the file of S1 or an opened h5py.File
+    '''
+    def __init__(self,h5file):
+        self.own = not isinstance(h5file,h5py.File)
+        self.f   = h5py.File(h5file,'r') if self.own else h5file
+        self.columnar = self.f.attrs.get('ccf_format','') == 'columnar'
+        self.columns  = {}
+        self.pairs    = None
+        self.shared   = {key:value for key,value in self.f.attrs.items() if key!='ccf_format'}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+        return False
+
+    def close(self):
+        if self.own:self.f.close()
+
+    def _columns(self,path):
+        '''
+        data dataset, time, ngood and pair columns and the first and last+1 rows of each pair ('rows') of
+        the columnar datasets of path
+        '''
+        if path not in self.columns:
+            if self.pairs is None:
+                self.pairs = {key:self.f['pairs'][key][:] for key in self.f['pairs'] if key!='name'}
+                self.pairs['name'] = self.f['pairs']['name'].asstr()[:]
+            grp  = self.f[path]
+            cols = {key:grp[key][:] for key in ['time','ngood','pair']}
+            cols['data'] = grp['data']
+            ipair,indx,count = np.unique(cols['pair'],return_index=True,return_counts=True)
+            cols['rows'] = {self.pairs['name'][ii]:(i1,i1+nn) for ii,i1,nn in zip(ipair,indx,count) if ii>=0}
+            self.columns[path] = cols
+        return self.columns[path]
+
+    def list(self):
+        '''
+        all cross-correlation functions of the file as [pair,path,nseg,npts]
+        '''
+        info = []
+        if self.columnar:
+            for path in self.f:
+                if path == 'pairs':continue
+                npts = self.f[path]['data'].shape[1]
+                for pair,(i1,i2) in self._columns(path)['rows'].items():info.append([pair,path,i2-i1,npts])
+        elif 'AuxiliaryData' in self.f:
+            aux = self.f['AuxiliaryData']
+            for data_type in aux:
+                for path in aux[data_type]:
+                    shape = aux[data_type][path].shape
+                    info.append([data_type,path,1 if len(shape)==1 else shape[0],shape[-1]])
+        return info
+
+    def paths(self,pair):
+        '''
+        components of a station pair in the file (sorted)
+        '''
+        if self.columnar:
+            return sorted([path for path in self.f if path!='pairs' and pair in self._columns(path)['rows']])
+        return list(self.f['AuxiliaryData'][pair].keys())
+
+    def locate(self,pair,path,keys=None):
+        '''
+        the dataset holding the pair and path, the rows of the pair in it (None for a 1D dataset) and its
+        parameters (only those of keys if given, to save reading the ASDF attributes), or None if the pair
+        and path are not in the file
+        '''
+        if self.columnar:
+            if path not in self.f or pair not in self._columns(path)['rows']:return None
+            cols  = self.columns[path]
+            i1,i2 = cols['rows'][pair]
+            ip    = cols['pair'][i1]
+            parameters = dict(self.shared)
+            for key in self.pairs:
+                if key!='name':parameters[key] = self.pairs[key][ip]
+            parameters['ngood'] = cols['ngood'][i1:i2].copy()
+            parameters['time']  = cols['time'][i1:i2].copy()
+            # a single cross-correlation function has scalar time and ngood as in the ASDF files
+            if not parameters['substack']:
+                parameters['ngood'] = parameters['ngood'][0];parameters['time'] = parameters['time'][0]
+            parameters['comp']  = path.split('_')[0][-1]+path.split('_')[1][-1]
+            return cols['data'],np.arange(i1,i2),parameters
+        try:
+            dset = self.f['AuxiliaryData'][pair][path]
+        except KeyError:
+            return None
+        parameters = dict(dset.attrs) if keys is None else {key:dset.attrs[key] for key in keys}
+        return dset,(np.arange(dset.shape[0]) if dset.ndim>1 else None),parameters
+
+    def parameters(self,pair,path):
+        '''
+        parameters of the cross-correlation functions of the pair and path
+        '''
+        return self.locate(pair,path)[2]
+
+    def read(self,pair,path,keys=None):
+        '''
+        cross-correlation functions (1D for a single one, nseg x npts for the substacks) and parameters of the
+        pair and path
+        '''
+        dset,rows,parameters = self.locate(pair,path,keys)
+        if rows is None:return dset[:],parameters
+        data = dset[rows[0]:rows[-1]+1] if len(rows) else np.zeros((0,dset.shape[1]),dtype=dset.dtype)
+        if self.columnar and not parameters['substack']:data = data[0]
+        return data,parameters
+
+class ChunkWriter(object):
+    '''
+    this class collects the cleaned traces, inventories and gaps that go into the ASDF file of one
+    time chunk and writes them in batches: the file is opened once per batch instead of once per
+    station. the batch is written (and gzip compressed) by a background thread, so that the writing
+    overlaps with the downloading/pre-processing of the next stations. it follows the add_waveforms,
+    add_stationxml and add_auxiliary_data interface of pyasdf and can be used in a with statement like
+    ASDFDataSet. (used in S0A & S0B)
+    PARAMETERS:
+    ---------------------
+    h5file:      path of the ASDF file to write into (created if not existing)
+    max_bytes:   size (in bytes) of the traces buffered in memory before a batch is submitted
+    compression: compression of the waveforms passed to pyasdf
+    '''
+    def __init__(self,h5file,max_bytes=500*1024**2,compression='gzip-3'):
+        self.h5file      = h5file
+        self.max_bytes   = max_bytes
+        self.compression = compression
+        self.buffer      = []
+        self.nbytes      = 0
+        self.nwrite      = 0
+        self.job         = None
+        self.pool        = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+        return False
+
+    def add_stationxml(self,inv):
+        self.buffer.append(('stationxml',inv))
+
+    def add_waveforms(self,tr,tag):
+        '''
+        keep the stream in the buffer (not copied: the main scripts get a new stream from preprocess_raw
+        for every station) and submit the batch when the buffer exceeds max_bytes
+        '''
+        self.buffer.append(('waveforms',tr,tag))
+        self.nbytes += np.sum([ttr.data.nbytes for ttr in tr])
+        if self.nbytes >= self.max_bytes:
+            self.flush()
+
+    def add_auxiliary_data(self,data,data_type,path,parameters):
+        data = np.array(data)
+        self.buffer.append(('auxiliary',data,data_type,path,copy.deepcopy(parameters)))
+        self.nbytes += data.nbytes
+
+    def _write(self,batch):
+        '''
+        write one batch into the ASDF file. items failing (e.g., the inventory of a station already
+        in the file) are reported and skipped as when writing them one by one
+        '''
+        with pyasdf.ASDFDataSet(self.h5file,mpi=False,compression=self.compression,mode='a') as ds:
+            for item in batch:
+                try:
+                    if item[0] == 'stationxml':
+                        ds.add_stationxml(item[1])
+                    elif item[0] == 'waveforms':
+                        ds.add_waveforms(item[1],tag=item[2])
+                    else:
+                        ds.add_auxiliary_data(data=item[1],data_type=item[2],path=item[3],parameters=item[4])
+                except Exception as e:
+                    if item[0] != 'stationxml':print('failed to write %s into %s: %s'%(item[0],self.h5file,e))
+        return len(batch)
+
+    def wait(self):
+        '''
+        wait for the batch being written (exceptions of the writing thread are raised here)
+        '''
+        if self.job is not None:
+            self.nwrite += self.job.result()
+            self.job = None
+
+    def flush(self):
+        '''
+        submit the buffered items to the writing thread. only one batch is in flight at a time
+        so that at most two batches are kept in memory
+        '''
+        self.wait()
+        if not len(self.buffer):return
+        self.job    = self.pool.submit(self._write,self.buffer)
+        self.buffer = []
+        self.nbytes = 0
+
+    def close(self):
+        '''
+        write the remaining items and stop the writing thread
+        '''
+        self.flush()
+        self.wait()
+        self.pool.shutdown()
+
+class BulkDownloader(object):
+    '''
+    this class downloads the inventories and waveforms of a list of channels for one time chunk with a
+    pool of threads. the channels are grouped into batches requested through the bulk methods of the client
+    (get_stations_bulk/get_waveforms_bulk) when it has them, and one by one otherwise. failed requests are
+    tried again after a growing waiting time. the batches are downloaded ahead of the caller and kept in a
+    bounded queue, so that the downloading overlaps with the pre-processing of the previous batch. (used in S0A)
+    PARAMETERS:
+    ---------------------
+    client:    data client with get_stations and get_waveforms (e.g., obspy.clients.fdsn.Client or any
+               object with the same methods and keywords, such as a local server for testing)
+    nthread:   number of requests running at the same time
+    bulk_size: number of channels in one bulk request
+    retries:   number of times a failed request is tried again
+    backoff:   waiting time (s) before the first retry, doubled for each following one
+    max_queue: number of downloaded batches waiting for the caller before the downloading pauses
+    inv_cache: InventoryCache to get the inventories from before asking the client (optional)
+    '''
+    def __init__(self,client,nthread=4,bulk_size=10,retries=3,backoff=1.,max_queue=2,inv_cache=None):
+        self.client    = client
+        self.nthread   = nthread
+        self.bulk_size = bulk_size
+        self.retries   = retries
+        self.backoff   = backoff
+        self.max_queue = max_queue
+        self.inv_cache = inv_cache
+        self.pool      = concurrent.futures.ThreadPoolExecutor(max_workers=nthread)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+        return False
+
+    def request(self,func,**kwargs):
+        '''
+        call one request of the client and try again when it fails. returns None if no data is available
+        '''
+        for itry in range(self.retries+1):
+            try:
+                return func(**kwargs)
+            except FDSNNoDataException:
+                return None
+            except Exception as e:
+                if itry == self.retries:raise
+                print('request failed (%s), trying again in %4.1fs'%(str(e).splitlines()[0],self.backoff*2**itry))
+                time.sleep(self.backoff*2**itry)
+
+    def get_inventory(self,keys,s1,s2):
+        '''
+        get the inventory with responses of each station in keys [(net,sta,loc),...] as a dict
+        '''
+        out = {}
+        if hasattr(self.client,'get_stations_bulk') and len(keys)>1:
+            try:
+                inv = self.request(self.client.get_stations_bulk,bulk=[key+('*',s1,s2) for key in keys],level='response')
+                for key in keys:
+                    out[key] = None if inv is None else inv.select(network=key[0],station=key[1],location=key[2])
+                    if out[key] is not None and not len(out[key].networks):out[key] = None
+                return out
+            except Exception as e:
+                print('bulk station request failed (%s), requesting one by one'%e)
+        for key in keys:
+            try:
+                out[key] = self.request(self.client.get_stations,network=key[0],station=key[1],\
+                    location=key[2],starttime=s1,endtime=s2,level='response')
+            except Exception as e:
+                print(e,'for',key[1]);out[key] = None
+        return out
+
+    def get_waveforms(self,keys,s1,s2):
+        '''
+        get the stream of each channel in keys [(net,sta,loc,chan),...] as a dict
+        '''
+        out = {}
+        if hasattr(self.client,'get_waveforms_bulk') and len(keys)>1:
+            try:
+                st = self.request(self.client.get_waveforms_bulk,bulk=[key+(s1,s2) for key in keys])
+                for key in keys:
+                    out[key] = None if st is None else st.select(network=key[0],station=key[1],location=key[2],channel=key[3])
+                    # trimmed to the chunk as done by get_waveforms of obspy (but not by get_waveforms_bulk)
+                    if out[key] is not None:out[key].trim(s1,s2)
+                    if out[key] is not None and not len(out[key]):out[key] = None
+                return out
+            except Exception as e:
+                print('bulk waveform request failed (%s), requesting one by one'%e)
+        for key in keys:
+            try:
+                out[key] = self.request(self.client.get_waveforms,network=key[0],station=key[1],\
+                    location=key[2],channel=key[3],starttime=s1,endtime=s2)
+            except Exception as e:
+                print(e,'for',key[1]);out[key] = None
+        return out
+
+    def _fetch_batch(self,batch,s1,s2):
+        # inventories from the cache first and from the client for the stations not covered
+        invs = {}
+        if self.inv_cache is not None:
+            for indx,key in batch:
+                invs[key] = self.inv_cache.get(*key,s1,s2)
+        stas = list(dict.fromkeys([key[:3] for indx,key in batch if invs.get(key) is None]))
+        if len(stas):
+            sta_invs = self.get_inventory(stas,s1,s2)
+            for indx,key in batch:
+                if invs.get(key) is None:invs[key] = sta_invs[key[:3]]
+            if self.inv_cache is not None:
+                for sta_inv in sta_invs.values():self.inv_cache.add(sta_inv)
+        trs  = self.get_waveforms([key for indx,key in batch],s1,s2)
+        return [(indx,invs[key],trs[key]) for indx,key in batch]
+
+    def fetch(self,requests,s1,s2):
+        '''
+        generator of (index,inventory,stream) of each channel in requests between s1 and s2, in the order of
+        requests. inventory or stream is None when not available
+        PARAMETERS:
+        ---------------------
+        requests: list of (index,net,sta,loc,chan) with index being any tag of the channel for the caller
+        s1,s2:    starting and ending time of the chunk in obspy.UTCDateTime
+        '''
+        batches = [[(req[0],tuple(req[1:])) for req in requests[ii:ii+self.bulk_size]] \
+            for ii in range(0,len(requests),self.bulk_size)]
+        queue = collections.deque()
+        for batch in batches:
+            queue.append(self.pool.submit(self._fetch_batch,batch,s1,s2))
+            if len(queue) < self.nthread+self.max_queue:continue
+            for item in queue.popleft().result():
+                yield item
+        while len(queue):
+            for item in queue.popleft().result():
+                yield item
+
+    def close(self):
+        self.pool.shutdown()
+
+class InventoryCache(object):
+    '''
+    this class keeps the station inventories (with responses) of a whole campaign in memory, indexed by
+    net.sta.loc with the epochs of each channel, so that the inventory of a station for a time chunk is
+    found without asking the data center again. it is filled once at the beginning (from one bulk request
+    or the StationXML files) and can be saved in a StationXML file to be reused by later runs. only the
+    stations without any channel epoch covering the chunk are requested again. (used in S0A & S0B)
+    PARAMETERS:
+    ---------------------
+    cachefile: StationXML file to load the inventories from and save them into (optional)
+    '''
+    def __init__(self,cachefile=None):
+        self.cachefile = cachefile
+        self.inv       = Inventory(networks=[],source='NoisePy')
+        self.epochs    = {}
+        self.locs      = {}
+        self.changed   = False
+        self.lock      = threading.Lock()
+        if cachefile is not None and os.path.isfile(cachefile):
+            self.add(obspy.read_inventory(cachefile))
+            self.changed = False
+
+    def __len__(self):
+        return len(self.epochs)
+
+    def add(self,inv):
+        '''
+        add the networks/stations/channels of an inventory into the cache and index their epochs
+        '''
+        if inv is None:return
+        with self.lock:
+            self.inv.networks.extend(inv.networks)
+            for net in inv:
+                for sta in net:
+                    for cha in sta:
+                        key = '%s.%s.%s'%(net.code,sta.code,cha.location_code)
+                        tbeg = -np.inf if cha.start_date is None else cha.start_date.timestamp
+                        tend = np.inf if cha.end_date is None else cha.end_date.timestamp
+                        self.epochs.setdefault(key,[]).append((cha.code,tbeg,tend))
+                        self.locs.setdefault(net.code+'.'+sta.code,set()).add(cha.location_code)
+            self.changed = True
+
+    def covers(self,net,sta,loc,chan,time1,time2):
+        '''
+        check whether a channel (loc and chan can be wildcards) has an epoch covering time1-time2 in timestamp
+        '''
+        if '*' in loc or '?' in loc:
+            locs = [tloc for tloc in self.locs.get(net+'.'+sta,[]) if fnmatch.fnmatch(tloc,loc)]
+        else:locs = [loc]
+        for tloc in locs:
+            for tchan,tbeg,tend in self.epochs.get('%s.%s.%s'%(net,sta,tloc),[]):
+                if tbeg<=time1 and tend>=time2 and fnmatch.fnmatch(tchan,chan):
+                    return True
+        return False
+
+    def get(self,net,sta,loc,chan,starttime,endtime):
+        '''
+        get the inventory of the station for the time range (as returned by get_stations of the data center
+        with level='response'), or None when the channel is not covered by the cache
+        '''
+        if not self.covers(net,sta,loc,chan,starttime.timestamp,endtime.timestamp):return None
+        with self.lock:
+            return self.inv.select(network=net,station=sta,location=loc,starttime=starttime,endtime=endtime)
+
+    def save(self):
+        '''
+        write the cache into cachefile if new inventories are added
+        '''
+        if self.cachefile is None or not self.changed:return
+        with self.lock:
+            tmpfile = self.cachefile+'.tmp'
+            self.inv.write(tmpfile,format='STATIONXML')
+            os.replace(tmpfile,self.cachefile)
+            self.changed = False
+
+class ChunkPrefetcher(object):
+    '''
+    this class reads the traces of the next time chunk in a background thread while the current chunk is
+    cross-correlated. the chunks not prefetched are read when they are processed. it keeps the timing of
+    the reading: t_read is the time spent on reading and t_wait the time the main loop waited for the data,
+    so that t_read-t_wait is the reading hidden behind the computing. (used in S1)
+    PARAMETERS:
+    ---------------------
+    fc_para: dict containing the fft/cc parameters (data_format and the ones of stats2inv for sac/mseed)
+    '''
+    def __init__(self,fc_para):
+        self.fc_para = fc_para
+        self.jobs    = {}
+        self.t_read  = 0.
+        self.t_wait  = 0.
+        self.pool    = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def _read(self,tfile,grank,gsize):
+        t0=time.time()
+        sta_list = chunk_station_list(tfile,self.fc_para['data_format'])
+        sta_list,sta_pairs = select_chunk_stations(self.fc_para,tfile,sta_list)
+        traces = list(read_chunk(self.fc_para,tfile,sta_list[grank*len(sta_list)//gsize:(grank+1)*len(sta_list)//gsize]))
+        return sta_list,sta_pairs,traces,time.time()-t0
+
+    def _timed(self,traces):
+        # the reading of each station counts as waiting when done by the main loop
+        while True:
+            t0=time.time()
+            try:
+                item = next(traces)
+            except StopIteration:
+                break
+            finally:
+                dt = time.time()-t0
+                self.t_read += dt
+                self.t_wait += dt
+            yield item
+
+    def _release(self,traces):
+        # the prefetched traces are dropped as they are taken so that the raw data of the chunk are
+        # freed while the spectra are being filled
+        traces = collections.deque(traces)
+        while len(traces):
+            yield traces.popleft()
+
+    def submit(self,tfile,grank=0,gsize=1):
+        '''
+        start reading the traces of the part (grank out of gsize) of the stations of a chunk in the background
+        '''
+        self.jobs[tfile] = self.pool.submit(self._read,tfile,grank,gsize)
+
+    def get(self,tfile,grank=0,gsize=1):
+        '''
+        get the station list of a chunk (only the stations in a selected pair, see select_chunk_stations), the
+        selected station pairs and a generator of the traces of its part of the stations, which gives the
+        prefetched traces (releasing each of them once taken) or reads them one by one otherwise
+        '''
+        t0=time.time()
+        if tfile in self.jobs:
+            sta_list,sta_pairs,traces,t_read = self.jobs.pop(tfile).result()
+            self.t_read += t_read
+            self.t_wait += time.time()-t0
+            return sta_list,sta_pairs,self._release(traces)
+        sta_list = chunk_station_list(tfile,self.fc_para['data_format'])
+        sta_list,sta_pairs = select_chunk_stations(self.fc_para,tfile,sta_list)
+        dt = time.time()-t0
+        self.t_read += dt
+        self.t_wait += dt
+        return sta_list,sta_pairs,self._timed(read_chunk(self.fc_para,tfile,sta_list[grank*len(sta_list)//gsize:(grank+1)*len(sta_list)//gsize]))
+
+    def close(self):
+        for job in self.jobs.values():job.cancel()
+        self.pool.shutdown()
+
+def chunk_station_list(tfile,input_fmt):
+    '''
+    this function returns the stations (net.sta in ASDF or the sac/mseed files) of one time chunk (used in S1)
+    '''
+    if input_fmt == 'asdf':
+        with pyasdf.ASDFDataSet(tfile,mpi=False,mode='r') as ds:
+            return ds.waveforms.list()
+    return sorted(glob.glob(os.path.join(tfile,'*'+input_fmt)))
+
+def select_chunk_stations(fc_para,tfile,sta_list):
+    '''
+    this function selects the station pairs of a time chunk with select_station_pairs (pair_para of fc_para)
+    from the coordinates in the StationXML of its ASDF file (or in the sac headers), before any waveform is
+    read, and leaves out the stations that are in none of the selected pairs. (used in S1)
+    PARAMETERS:
+    ---------------------
+    fc_para:  dict containing the fft/cc parameters (data_format and pair_para)
+    tfile:    ASDF file of the chunk (or its folder of sac/mseed files)
+    sta_list: stations of the chunk (from chunk_station_list)
+    RETURNS:
+    ---------------------
+    sta_list:  stations to read
+    sta_pairs: set of (net.sta,net.sta) names (in alphabetical order) of the selected pairs, or None when
+               all pairs are selected or some station has no coordinates (then all of them are kept)
+    '''
+    pair_para = fc_para.get('pair_para',None) or {}
+    if not pair_para.get('min_dist',None) and all([pair_para.get(key,None) is None for key in ['max_dist','azi_range','nneighbor']]):
+        return sta_list,None
+
+    # station name and coordinates of each item of sta_list
+    names = [];lon = [];lat = []
+    if fc_para['data_format'] == 'asdf':
+        with pyasdf.ASDFDataSet(tfile,mpi=False,mode='r') as ds:
+            for tmps in sta_list:
+                try:
+                    coor = ds.waveforms[tmps].coordinates
+                    names.append(tmps);lon.append(coor['longitude']);lat.append(coor['latitude'])
+                except Exception:
+                    names.append(tmps);lon.append(np.nan);lat.append(np.nan)
+    else:
+        for tmps in sta_list:
+            try:
+                stats = obspy.read(tmps,headonly=True)[0].stats
+                names.append(stats.network+'.'+stats.station);lon.append(stats.sac['stlo']);lat.append(stats.sac['stla'])
+            except Exception:
+                names.append(tmps);lon.append(np.nan);lat.append(np.nan)
+    if not len(names) or np.any(np.isnan(lon)) or np.any(np.isnan(lat)):return sta_list,None
+
+    # pairs of the unique stations and the stations in any of them
+    sta,indx = np.unique(names,return_index=True)
+    keep = select_station_pairs(np.array(lon)[indx],np.array(lat)[indx],pair_para)
+    sta_pairs = set([(sta[ii],sta[jj]) for ii,jj in keep])
+    used = set([name for tpair in sta_pairs for name in tpair])
+    return [tmps for tmps,name in zip(sta_list,names) if name in used],sta_pairs
+
+def read_chunk(fc_para,tfile,sta_list):
+    '''
+    this function is a generator of the traces of the stations in one time chunk, read one by one (used in S1)
+    PARAMETERS:
+    ---------------------
+    fc_para:  dict containing the fft/cc parameters
+    tfile:    ASDF file of the chunk (or its folder of sac/mseed files)
+    sta_list: stations to read (from chunk_station_list)
+    RETURNS:
+    ---------------------
+    tmps,inv,tag,source,gaps: station, its inventory, waveform tag, obspy stream and gaps (None if not recorded)
+    '''
+    if fc_para['data_format'] == 'asdf':
+        ds = pyasdf.ASDFDataSet(tfile,mpi=False,mode='r')
+        for tmps in sta_list:
+            # get station and inventory
+            try:
+                inv1 = ds.waveforms[tmps]['StationXML']
+            except Exception as e:
+                print('abort! no stationxml for %s in file %s'%(tmps,tfile))
+                continue
+            # get days information: works better than just list the tags
+            for tag in ds.waveforms[tmps].get_waveform_tags():
+                yield tmps,inv1,tag,ds.waveforms[tmps][tag],read_gaps(ds,tmps,tag)
+        del ds
+    else:
+        for tmps in sta_list:
+            source = obspy.read(tmps)
+            yield tmps,stats2inv(source[0].stats,fc_para),1,source,None
+
+def cc_chunk_done(tmpfile):
+    '''
+    this function checks whether the time chunk of the log file (tmpfile) is done in S1 (used in S1)
+    '''
+    if not os.path.isfile(tmpfile):return False
+    with open(tmpfile,'r') as ftemp:
+        alines = ftemp.readlines()
+    return len(alines)>0 and alines[-1] == 'done'
+
+def cc_resume_list(tmpfile,cc_h5):
+    '''
+    this function reads the log of a time chunk that was interrupted in S1 and returns the station 
+    pairs already saved in its ASDF file, so that only the rest need to be cross-correlated. 
+    datasets in the file that are not in the log (partially written or not flushed yet when the 
+    job stopped) are dropped from the file. for the columnar files of ColumnarCCFWriter the rows
+    from the first one not in the log are cut off. (used in S1)
+    PARAMETERS:
+    ---------------------
+    tmpfile: log of the chunk with 'data_type path' of each pair written by CCFWriter
+    cc_h5:   ASDF (or columnar) file of the cross-correlation functions of the chunk
+    RETURNS:
+    ---------------------
+    done: set of 'data_type path' strings of the pairs that are already in cc_h5
+    '''
+    logged = set()
+    if os.path.isfile(tmpfile):
+        with open(tmpfile,'r') as f:
+            logged = set([line.strip() for line in f])
+
+    done = set()
+    if not os.path.isfile(cc_h5):return done
+    try:
+        with h5py.File(cc_h5,'a') as f:
+            if f.attrs.get('ccf_format','') == 'columnar':
+                names = f['pairs']['name'].asstr()[:] if 'pairs' in f else np.array([],dtype=str)
+                for path in [path for path in f if path!='pairs']:
+                    grp  = f[path]
+                    nrow = min([grp[key].shape[0] for key in grp])
+                    tpair = grp['pair'][:nrow]
+                    keys = [names[ii]+' '+path if 0<=ii<len(names) else '' for ii in tpair]
+                    nkeep = 0
+                    while nkeep<nrow and keys[nkeep] in logged:nkeep+=1
+                    for key in grp:grp[key].resize(nkeep,axis=0)
+                    done.update(keys[:nkeep])
+                    if not nkeep:del f[path]
+            elif 'AuxiliaryData' in f:
+                aux = f['AuxiliaryData']
+                for data_type in list(aux.keys()):
+                    for path in list(aux[data_type].keys()):
+                        if data_type+' '+path in logged:
+                            done.add(data_type+' '+path)
+                        else:
+                            del aux[data_type][path]
+                    if not len(aux[data_type]):del aux[data_type]
+    except Exception as e:
+        # the whole file can be broken when the job stops in the middle of an HDF5 write
+        print('cannot resume from %s: %s'%(cc_h5,e))
+        done = set()
+
+    if not len(done):os.remove(cc_h5)
+    return done
+
+def ccf_file_datasets(ccfile):
+    '''
+    this function lists the cross-correlation functions in one file of S1 (ASDF or columnar) as
+    [pair,path,nseg,npts] from the HDF5 metadata only (used in make_ccf_index)
+    '''
+    info = []
+    try:
+        with CCFReader(ccfile) as reader:
+            info = reader.list()
+    except Exception as e:
+        print('cannot index %s: %s'%(ccfile,e))
+    return info
+
+def make_ccf_index(ccfiles,index_file,comm=None):
+    '''
+    this function makes the index of the cross-correlation functions of S1 with the file, station pair, component
+    path, number of segments and lag points of each dataset in one pass over the files, and saves it in the csv
+    file of index_file. when index_file exists, only the new or changed files (size or mtime) are scanned again
+    and the removed files are dropped. the files are shared by all MPI ranks of comm. (used in S2)
+    PARAMETERS:
+    -----------------------
+    ccfiles:    ASDF files of the cross-correlation functions (one per time chunk)
+    index_file: csv file to keep the index
+    comm:       MPI communicator (optional, all ranks have to call it and get the same index)
+    RETURNS:
+    -----------------------
+    cindex: pandas dataframe with the columns of file, pair, path, nseg, npts, size and mtime
+    '''
+    columns = ['file','pair','path','nseg','npts','size','mtime']
+    rank = 0 if comm is None else comm.Get_rank()
+    size = 1 if comm is None else comm.Get_size()
+
+    # files to scan: new or changed since the last index
+    if rank == 0:
+        fstat = np.array([[tstat.st_size,tstat.st_mtime] for tstat in map(os.stat,ccfiles)]).reshape(-1,2)
+        fstat = pd.DataFrame({'file':ccfiles,'size':fstat[:,0].astype(np.int64),'mtime':fstat[:,1]})
+        old   = pd.DataFrame(columns=columns)
+        if os.path.isfile(index_file):
+            old = pd.read_csv(index_file,dtype={'pair':str,'path':str},float_precision='round_trip')
+            old = old.merge(fstat,on=['file','size','mtime'],how='inner')[columns]
+        tscan = list(fstat['file'][~fstat['file'].isin(old['file'])])
+        print('%d files in the CCF index, %d files to scan'%(len(ccfiles),len(tscan)))
+    else:
+        tscan = None
+    if comm is not None: tscan = comm.bcast(tscan,root=0)
+
+    # list the datasets of the files of this rank
+    info = [[ff]+tinfo for ff in tscan[rank::size] for tinfo in ccf_file_datasets(ff)]
+    if comm is not None:
+        info = comm.gather(info,root=0)
+    else: info = [info]
+
+    # update and save the index
+    if rank == 0:
+        new = pd.DataFrame([tinfo for rinfo in info for tinfo in rinfo],columns=columns[:5])
+        new = new.merge(fstat,on='file',how='left')
+        frames = [tframe for tframe in [old,new[columns]] if len(tframe)]
+        cindex = pd.concat(frames,ignore_index=True) if len(frames) else new[columns]
+        cindex = cindex.astype({'nseg':np.int64,'npts':np.int64,'size':np.int64,'mtime':np.float64})
+        cindex = cindex.sort_values(['file','pair','path'],kind='stable').reset_index(drop=True)
+        cindex.to_csv(index_file,index=False)
+    else:
+        cindex = None
+    if comm is not None: cindex = comm.bcast(cindex,root=0)
+    return cindex
+
+def select_ccf_chunks(cindex,ncomp):
+    '''
+    this function keeps the chunks of each station pair with all 9 cross components (for ncomp=3) and raises
+    an error if a chunk has more than 9 of them (used in S2)
+    '''
+    counts = cindex.groupby(['pair','file'])['path'].transform('size')
+    if np.any(counts>9):
+        raise ValueError('more than 9 cross-component exists for %s! please double check'%cindex['pair'][counts>9].iloc[0])
+    if ncomp==3:cindex = cindex[counts==9]
+    return cindex
+
+def transpose_ccf(cindex,pairs,outfile,ncomp):
+    '''
+    this function rewrites the cross-correlation functions of some station pairs from the time-major files of
+    S1 (one file per time chunk) into a pair-major HDF5 file: all data of one pair (all chunks and components
+    in the order of the chunks) are kept in one contiguous array with their times, numbers of good windows and
+    components, so that loading a pair for stacking takes one sequential read (see read_pair_ccf). each file of
+    S1 is opened once. the files of S1 in outfile are recorded (ccfiles) with a signature of their rows: when
+    they are unchanged, only the rows of the new files are appended to the arrays if these files come after
+    them in the order of the chunks, otherwise outfile is rebuilt. (used in S2)
+    PARAMETERS:
+    -----------------------
+    cindex:  index of the cross-correlation functions from make_ccf_index
+    pairs:   station pairs to keep in outfile
+    outfile: pair-major HDF5 file
+    ncomp:   number of components (chunks without all 9 cross components are left out for ncomp=3)
+    RETURNS:
+    -----------------------
+    True if outfile is (re)written or appended and False if it is up to date
+    '''
+    sel = select_ccf_chunks(cindex[cindex['pair'].isin(pairs)],ncomp)
+    sel = sel.sort_values(['pair','file','path'],kind='stable')
+    signature = lambda tsel:hashlib.md5(tsel[['pair','file','path','nseg','npts','size','mtime']].to_csv(index=False).encode()).hexdigest()
+
+    # files of S1 already in outfile and whether their rows are the same as in the index
+    old_files = []
+    if os.path.isfile(outfile):
+        try:
+            with h5py.File(outfile,'r') as f:
+                if signature(sel[sel['file'].isin(f['ccfiles'].asstr()[:])]) == f.attrs['signature']:
+                    old_files = list(f['ccfiles'].asstr()[:])
+        except Exception:pass
+    new = sel[~sel['file'].isin(old_files)]
+    if len(old_files) and not len(new):return False
+
+    if len(old_files) and new['file'].min()>max(old_files):
+        # the signature is reset first so that an interrupted append is rebuilt next time
+        with h5py.File(outfile,'a') as fout:
+            fout.attrs['signature'] = ''
+            fout.flush()
+            transpose_ccf_rows(fout,new)
+            del fout['ccfiles']
+            fout.create_dataset('ccfiles',data=np.array(sorted(sel['file'].unique()),dtype=h5py.string_dtype()))
+            fout.attrs['signature'] = signature(sel)
+        return True
+
+    tmpfile = outfile+'.tmp'
+    with h5py.File(tmpfile,'w') as fout:
+        transpose_ccf_rows(fout,sel)
+        fout.create_dataset('ccfiles',data=np.array(sorted(sel['file'].unique()),dtype=h5py.string_dtype()))
+        fout.attrs['signature'] = signature(sel)
+    os.replace(tmpfile,outfile)
+    return True
+
+def transpose_ccf_rows(fout,sel):
+    '''
+    this function appends the rows of the datasets of sel (sorted by pair, file and path) to the arrays of
+    their pairs in the opened pair-major file fout, creating the groups of the pairs not in it yet (used in
+    transpose_ccf)
+    '''
+    # rows of each dataset in the array of its pair (after the rows already in fout). the arrays are
+    # extendable, in HDF5 chunks of whole rows (of about 256 KB) so that a pair is still read in a few large pieces
+    nrow = sel.groupby('pair')['nseg'].sum()
+    npts = sel.groupby('pair')['npts'].first()
+    row0 = {}
+    for pair in nrow.index:
+        if pair not in fout:
+            grp = fout.create_group(pair)
+            crow = max(1,2**16//npts[pair])
+            grp.create_dataset('data',shape=(0,npts[pair]),maxshape=(None,npts[pair]),chunks=(crow,npts[pair]),dtype=np.float32)
+            grp.create_dataset('time',shape=(0,),maxshape=(None,),chunks=(4096,),dtype=np.float64)
+            grp.create_dataset('ngood',shape=(0,),maxshape=(None,),chunks=(4096,),dtype=np.int32)
+            grp.create_dataset('comp',shape=(0,),maxshape=(None,),chunks=(4096,),dtype='S2')
+        row0[pair] = fout[pair]['data'].shape[0]
+        for key in ['data','time','ngood','comp']:fout[pair][key].resize(row0[pair]+nrow[pair],axis=0)
+    row = (sel.groupby('pair')['nseg'].cumsum()-sel['nseg']+sel['pair'].map(row0)).values
+
+    # one pass over the time-major files: the components of a pair in one chunk are next to each
+    # other in its pair-major array and written at once
+    dsets = {pair:[fout[pair][key] for key in ['data','time','ngood','comp']] for pair in nrow.index}
+    for ccfile,rows in sel.assign(row=row).groupby('file',sort=True):
+        with CCFReader(ccfile) as reader:
+            for pair,prows in rows.groupby('pair',sort=False):
+                irow = prows['row'].iloc[0]
+                nn   = prows['nseg'].sum()
+                data = [];ttime = [];tgood = [];tcomp = []
+                for path,nseg in zip(prows['path'],prows['nseg']):
+                    tdata,tparameters = reader.read(pair,path,None if not len(data) else ['time','ngood'])
+                    data.append(tdata.reshape(nseg,-1))
+                    ttime.append(np.reshape(tparameters['time'],-1))
+                    tgood.append(np.reshape(tparameters['ngood'],-1))
+                    tcomp += [(path.split('_')[0][-1]+path.split('_')[1][-1]).encode()]*nseg
+                    # parameters of the pair from the first component of its last chunk (as used in S2 before)
+                    if len(data)==1:
+                        for key,value in tparameters.items():fout[pair].attrs[key] = value
+                dsets[pair][0][irow:irow+nn] = np.concatenate(data)
+                dsets[pair][1][irow:irow+nn] = np.concatenate(ttime)
+                dsets[pair][2][irow:irow+nn] = np.concatenate(tgood)
+                dsets[pair][3][irow:irow+nn] = tcomp
+
+def read_pair_ccf(pairfile,pair):
+    '''
+    this function reads all cross-correlation functions of a station pair from the pair-major file of
+    transpose_ccf, and returns None if the pair is not in the file (used in S2)
+    RETURNS:
+    -----------------------
+    data,time,ngood,comp: arrays of the cross-correlation functions, their times, numbers of good windows and components
+    parameters: dict of the parameters of the pair
+    '''
+    if not os.path.isfile(pairfile):return None
+    with h5py.File(pairfile,'r') as f:
+        if pair not in f:return None
+        grp = f[pair]
+        return grp['data'][:],grp['time'][:],grp['ngood'][:],grp['comp'][:].astype(str),dict(grp.attrs)
+
+# cross-correlation functions of a lag window: data (nrow x nlag, or nlag for a single stack), their lags,
+# times and the parameters of the dataset
+CCFWindow = collections.namedtuple('CCFWindow',['data','lag','time','parameters'])
+
+def lag_window(dt,maxlag,lag_range=None):
+    '''
+    this function gives the first and last+1 indices of the lags within lag_range (both ends included) on the
+    lag axis of -maxlag to maxlag in steps of dt (used in read_ccf_window)
+    '''
+    npts = int(round(2*maxlag/dt))+1
+    if lag_range is None:return 0,npts
+    indx1 = max(0,int(np.ceil((lag_range[0]+maxlag)/dt-1E-6)))
+    indx2 = min(npts,int(np.floor((lag_range[1]+maxlag)/dt+1E-6))+1)
+    if indx2<=indx1:raise ValueError('lag range %s is out of [-%s,%s]'%(lag_range,maxlag,maxlag))
+    return indx1,indx2
+
+def read_ccf_window(h5file,data_type,path=None,lag_range=None,time_range=None,stats=None):
+    '''
+    this function reads the cross-correlation functions of one dataset within a lag window and a time range
+    only. the windows are read as HDF5 hyperslabs so that only the HDF5 chunks holding them are decompressed
+    and transferred, instead of the full [-maxlag,maxlag] arrays of .data[:]. it works on the ASDF and columnar
+    files of S1 (data_type is the station pair and path the component like BHZ_BHZ), the ASDF files of S2
+    (data_type like Allstack_linear and path like ZZ) and on the pair-major files of transpose_ccf (data_type
+    is the station pair and path the component like ZZ, or None for all of them). (used in S2 and the plotting
+    and monitoring scripts)
+    PARAMETERS:
+    -----------------------
+    h5file:     name of the HDF5 file, an opened h5py.File or a CCFReader (to read many datasets)
+    data_type:  data type (or pair) of the dataset
+    path:       component of the dataset
+    lag_range:  [lag1,lag2] of the lags to read in sec (all lags if None)
+    time_range: [t1,t2) of the timestamps of the rows to read (all rows if None)
+    stats:      dict to add up the bytes of the selection ('read'), of the full dataset ('full'), and
+                stored in the file for the HDF5 chunks read ('stored_read') and for all of them ('stored_full')
+    RETURNS:
+    -----------------------
+    CCFWindow of data,lag,time,parameters or None if the dataset does not exist
+    '''
+    if isinstance(h5file,CCFReader):
+        reader = h5file
+    elif isinstance(h5file,h5py.File):
+        reader = CCFReader(h5file)
+    else:
+        with CCFReader(h5file) as reader:
+            return read_ccf_window(reader,data_type,path,lag_range,time_range,stats)
+
+    # dataset, its rows to read and their timestamps
+    if reader.columnar or 'AuxiliaryData' in reader.f:
+        located = reader.locate(data_type,path)
+        if located is None:return None
+        dset,rows,parameters = located
+        ttime = np.reshape(parameters['time'],-1)
+        if rows is None:rows = np.zeros(len(ttime),dtype=np.int64)
+        # a full read of the pair in a columnar file is its rows of the component
+        all_rows = rows if reader.columnar else None
+    else:
+        all_rows = None
+        if data_type not in reader.f:return None
+        dset  = reader.f[data_type]['data']
+        parameters = dict(reader.f[data_type].attrs)
+        ttime = reader.f[data_type]['time'][:]
+        rows  = np.arange(len(ttime))
+        if path is not None:
+            keep  = reader.f[data_type]['comp'][:].astype(str)==path
+            rows  = rows[keep];ttime = ttime[keep]
+    if time_range is not None:
+        keep  = (ttime>=time_range[0])&(ttime<time_range[1])
+        rows  = rows[keep];ttime = ttime[keep]
+    indx1,indx2 = lag_window(parameters['dt'],parameters['maxlag'],lag_range)
+
+    # hyperslab of the rows and lags (a slice when the rows are next to each other)
+    if dset.ndim==1:
+        sel = (slice(indx1,indx2),)
+        data = dset[sel] if len(rows) else np.zeros(0,dtype=dset.dtype)
+    else:
+        if len(rows) and rows[-1]-rows[0]+1==len(rows):
+            sel = (slice(rows[0],rows[-1]+1),slice(indx1,indx2))
+        else:
+            sel = (rows,slice(indx1,indx2))
+        data = dset[sel] if len(rows) else np.zeros((0,indx2-indx1),dtype=dset.dtype)
+    if stats is not None:
+        itemsize = dset.dtype.itemsize
+        stats['read']        = stats.get('read',0)+data.size*itemsize
+        if all_rows is None:
+            stats['full']        = stats.get('full',0)+dset.size*itemsize
+            stats['stored_full'] = stats.get('stored_full',0)+dset.id.get_storage_size()
+        else:
+            stats['full']        = stats.get('full',0)+len(all_rows)*dset.shape[1]*itemsize
+            stats['stored_full'] = stats.get('stored_full',0)+chunk_bytes(dset,all_rows,0,dset.shape[1])
+        stats['stored_read'] = stats.get('stored_read',0)+(chunk_bytes(dset,rows,indx1,indx2) if len(rows) else 0)
+    # a single cross-correlation function of a columnar file is 1D as in the ASDF files
+    if reader.columnar and not parameters['substack']:data = data[0] if len(data) else np.zeros(0,dtype=dset.dtype)
+    # same lag axis as np.arange(-maxlag,maxlag+dt,dt) of the scripts
+    lag = np.arange(-parameters['maxlag'],parameters['maxlag']+parameters['dt'],parameters['dt'])[indx1:indx2]
+    return CCFWindow(data,lag,ttime,parameters)
+
+def chunk_bytes(dset,rows,indx1,indx2):
+    '''
+    this function gives the bytes stored in the file for the HDF5 chunks of dset holding the rows and the lags
+    of indx1 to indx2, which is what HDF5 reads (and decompresses) for the selection (used in read_ccf_window)
+    '''
+    if dset.chunks is None:
+        return len(rows)*(indx2-indx1)*dset.dtype.itemsize if dset.ndim>1 else (indx2-indx1)*dset.dtype.itemsize
+    clag  = dset.chunks[-1]
+    lags  = range(indx1//clag*clag,indx2,clag)
+    crows = np.unique(np.asarray(rows)//dset.chunks[0])*dset.chunks[0] if dset.ndim>1 else [None]
+    nbyte = 0
+    for crow in crows:
+        for ilag in lags:
+            info = dset.id.get_chunk_info_by_coord((crow,ilag) if dset.ndim>1 else (ilag,))
+            if info.byte_offset is not None:nbyte += info.size
+    return nbyte
+
 def stacking(cc_array,cc_time,cc_ngood,stack_para):
     '''
     this function stacks the cross correlation data according to the user-defined substack_len parameter
@@ -833,15 +2418,12 @@ def check_sample_gaps(stream,date_info):
         stream = []
         return stream
     
-    freqs = []	
-    for tr in stream:
-        freqs.append(int(tr.stats.sampling_rate))
-    freq = max(freqs)
-    for tr in stream:
-        if int(tr.stats.sampling_rate) != freq:
-            stream.remove(tr)
-        if tr.stats.npts < 10:
-            stream.remove(tr)
+    # keep traces with the main sampling rate and enough points
+    freqs = np.array([int(tr.stats.sampling_rate) for tr in stream])
+    npts  = np.array([tr.stats.npts for tr in stream])
+    keep  = (freqs==np.max(freqs))&(npts>=10)
+    if not np.all(keep):
+        stream = obspy.Stream(traces=[tr for tr,kk in zip(stream,keep) if kk])
 
     return stream			
 
@@ -864,15 +2446,144 @@ def portion_gaps(stream,date_info):
     endtime   = date_info['endtime']
     npts      = (endtime-starttime)*stream[0].stats.sampling_rate
 
-    pgaps=0
-    #loop through all trace to accumulate gaps
-    for ii in range(len(stream)-1):
-        pgaps += (stream[ii+1].stats.starttime-stream[ii].stats.endtime)*stream[ii].stats.sampling_rate
+    # accumulate gaps between consecutive traces
+    tbeg = np.array([tr.stats.starttime.timestamp for tr in stream])
+    tend = np.array([tr.stats.endtime.timestamp for tr in stream])
+    sps  = np.array([tr.stats.sampling_rate for tr in stream])
+    pgaps = np.sum((tbeg[1:]-tend[:-1])*sps[:-1])
     if npts!=0:pgaps=pgaps/npts
     if npts==0:pgaps=1
     return pgaps
 
 
+def merge_traces(stream):
+    '''
+    this function merges all traces of the stream into one preallocated float32 buffer spanning from the
+    first to the last sample of the stream. each trace is written in place with nan/inf set to zero, 
+    and then demeaned and detrended in the buffer (demean_detrend_taper without taper). later traces
+    overwrite overlapping samples and gaps are filled with zeros, the same as obspy merge(method=1,
+    fill_value=0). the samples without data are tracked by a mask and returned as time intervals.
+    (used in preprocess_raw)
+    PARAMETERS:
+    ----------------------
+    stream: obspy stream object with traces of the same sampling rate
+    RETURNS:
+    ----------------------
+    stream: obspy stream object with the merged trace
+    gaps:   2D numpy array of (ngap,2) with the start and end time (timestamps) of the invalid samples 
+    '''
+    sps  = stream[0].stats.sampling_rate
+    tbeg = np.array([tr.stats.starttime.timestamp for tr in stream])
+    nps  = np.array([tr.stats.npts for tr in stream],dtype=np.int64)
+    tmin = stream[np.argmin(tbeg)].stats.starttime
+    indx = np.round((tbeg-tmin.timestamp)*sps).astype(np.int64)
+
+    data  = np.zeros(int(np.max(indx+nps)),dtype=np.float32)
+    valid = np.zeros(data.size,dtype=np.bool_)
+    for ii in np.argsort(tbeg,kind='stable'):
+        seg = data[indx[ii]:indx[ii]+nps[ii]]
+        seg[:] = stream[ii].data
+
+        #-----set nan/inf values to zeros (it does happens!)-----
+        good = np.isfinite(seg)
+        seg[~good] = 0
+        valid[indx[ii]:indx[ii]+nps[ii]] = good
+
+        # remove mean and trend of each trace (in place, no taper)
+        demean_detrend_taper(seg.reshape(1,seg.size),np.zeros(0,dtype=np.float32))
+
+    # time intervals of the invalid samples (end time is excluded)
+    if np.all(valid):
+        gaps = np.zeros((0,2))
+    else:
+        edges = np.diff(np.concatenate(([0],(~valid).astype(np.int8),[0])))
+        gaps  = np.vstack((np.where(edges==1)[0],np.where(edges==-1)[0])).T/sps+tmin.timestamp
+
+    tr = stream[np.argmin(tbeg)].copy() if len(stream)>1 else stream[0]
+    tr.data = data
+    return obspy.Stream(traces=[tr]),gaps
+
+def segment_gaps(gaps,dataS_t,cc_len):
+    '''
+    this function computes the fraction of each segment falling in the gaps recorded by preprocess_raw
+    (used in S1)
+    PARAMETERS:
+    ----------------------
+    gaps:    2D numpy array of (ngap,2) with the start and end time of the gaps
+    dataS_t: starting time of each segment
+    cc_len:  length of the segments in sec
+    RETURNS:
+    ----------------------
+    pgaps: fraction of each segment in gaps
+    '''
+    if gaps is None or len(gaps)==0:
+        return np.zeros(len(dataS_t))
+    tbeg = np.asarray(dataS_t)[:,None]
+    overlap = np.minimum(tbeg+cc_len,gaps[None,:,1])-np.maximum(tbeg,gaps[None,:,0])
+    return np.sum(np.clip(overlap,0,None),axis=1)/cc_len
+
+def write_gaps(ds,tr,tag):
+    '''
+    this function saves the gaps of the trace from preprocess_raw (if any) in the ASDF file as the
+    auxiliary data of 'Gaps' with the path of net_sta/tag. (used in S0A & S0B)
+    '''
+    gaps = tr[0].stats.get('gaps',None)
+    if gaps is None or len(gaps)==0:return
+    path = '%s_%s/%s'%(tr[0].stats.network,tr[0].stats.station,tag)
+    ds.add_auxiliary_data(data=np.asarray(gaps,dtype=np.float64),data_type='Gaps',path=path,parameters={})
+
+def read_gaps(ds,tmps,tag):
+    '''
+    this function reads the gaps of the trace saved by write_gaps, and returns None if not found (used in S1)
+    PARAMETERS:
+    ----------------------
+    ds:   pyasdf dataset of the data chunk
+    tmps: station name (net.sta) in the waveform list of ds
+    tag:  waveform tag
+    '''
+    try:
+        return ds.auxiliary_data['Gaps'][tmps.replace('.','_')][tag].data[:]
+    except Exception:
+        return None
+
+def resample_ratio(sps,samp_freq,max_factor=1000):
+    '''
+    this function finds the integer factors up/down between the sampling rate of the data and the 
+    targeted one for the polyphase resampling. (used in preprocess_raw)
+    PARAMETERS:
+    ----------------------
+    sps: sampling rate of the data
+    samp_freq: targeted sampling rate
+    max_factor: maximum of the up/down factors
+    RETURNS:
+    ----------------------
+    up,down: integer factors with samp_freq = sps*up/down, or None when the ratio is not rational 
+             with factors up to max_factor (interpolation is used instead)
+    '''
+    ratio = Fraction(samp_freq/sps).limit_denominator(max_factor)
+    if ratio.numerator == 0 or ratio.numerator > max_factor or abs(float(ratio)*sps-samp_freq) > 1E-6*samp_freq:
+        return None
+    return ratio.numerator,ratio.denominator
+
+def poly_resample(tr,samp_freq,up,down):
+    '''
+    this function resamples the trace by up/down with the zero-phase anti-aliasing polyphase FIR filter
+    of scipy.signal.resample_poly. the samples keep the starttime of the trace and the number of points
+    is the same as obspy interpolate. (used in preprocess_raw)
+    PARAMETERS:
+    ----------------------
+    tr: obspy trace object of the noise data
+    samp_freq: targeted sampling rate (sampling rate of tr*up/down)
+    up,down: integer factors from resample_ratio
+    RETURNS:
+    ----------------------
+    tr: obspy trace object resampled to samp_freq
+    '''
+    npts = int(np.floor((tr.stats.endtime-tr.stats.starttime)*samp_freq+1E-6))+1
+    tr.data = np.float32(scipy.signal.resample_poly(tr.data,up,down)[:npts])
+    tr.stats.sampling_rate = samp_freq
+    return tr
+
 @jit('float32[:](float32[:],float32)')
 def segment_interpolate(sig1,nfric):
     '''
@@ -901,7 +2612,7 @@ def segment_interpolate(sig1,nfric):
 
     return sig2
 
-def resp_spectrum(source,resp_file,downsamp_freq,pre_filt=None):
+def resp_spectrum(source,resp_file,downsamp_freq,pre_filt=None,resp_cache=None):
     '''
     this function removes the instrument response using response spectrum from evalresp.
     the response spectrum is evaluated based on RESP/PZ files before inverted using the obspy
@@ -913,26 +2624,32 @@ def resp_spectrum(source,resp_file,downsamp_freq,pre_filt=None):
     resp_file: numpy data file of response spectrum
     downsamp_freq: sampling rate of the source data
     pre_filt: pre-defined filter parameters
+    resp_cache: ResponseCache object to keep the interpolated spectrum (optional)
     RETURNS:
     ----------------------
     source: obspy stream object of noise data with instrument response removed
     '''
-    #--------resp_file is the inverted spectrum response---------
-    respz = np.load(resp_file)
-    nrespz= respz[1][:]
-    spec_freq = max(respz[0])
-
     #-------on current trace----------
     nfft = _npts2nfft(source[0].stats.npts)
     sps  = int(source[0].stats.sampling_rate)
 
-    #---------do the interpolation if needed--------
-    if spec_freq < 0.5*sps:
-        raise ValueError('spectrum file has peak freq smaller than the data, abort!')
-    else:
+    def evaluate():
+        #--------resp_file is the inverted spectrum response---------
+        respz = np.load(resp_file)
+        spec_freq = max(respz[0])
+
+        #---------do the interpolation if needed--------
+        if spec_freq < 0.5*sps:
+            raise ValueError('spectrum file has peak freq smaller than the data, abort!')
         indx = np.where(respz[0]<=0.5*sps)
         nfreq = np.linspace(0,0.5*sps,nfft//2+1)
-        nrespz= np.interp(nfreq,np.real(respz[0][indx]),respz[1][indx])
+        return np.interp(nfreq,np.real(respz[0][indx]),respz[1][indx])
+
+    if resp_cache is None:
+        nrespz = evaluate()
+    else:
+        key = ('spectrum',os.path.abspath(resp_file),os.path.getmtime(resp_file),nfft,sps)
+        nrespz = resp_cache.get(key,evaluate)
         
     #----do interpolation if necessary-----
     source_spect = np.fft.rfft(source[0].data,n=nfft)
@@ -947,6 +2664,126 @@ def resp_spectrum(source,resp_file,downsamp_freq,pre_filt=None):
     return source
 
 
+class ResponseCache(object):
+    '''
+    this class keeps the inverted instrument responses (frequency domain, including the pre-filter 
+    taper) evaluated in preprocess_raw, so that the response of a channel epoch is only evaluated once
+    for all the days with the same trace length and sampling rate. the responses are kept in memory with 
+    least-recently-used eviction, and also saved in cachedir (if provided) so that later runs can skip 
+    the evaluation entirely. (used in S0A & S0B through preprocess_raw)
+    PARAMETERS:
+    ----------------------
+    max_bytes: memory allowed for the responses kept in memory
+    cachedir:  directory to save the responses on disk (None for memory only)
+    '''
+    def __init__(self,max_bytes=1024**3,cachedir=None):
+        self.max_bytes = max_bytes
+        self.cachedir  = cachedir
+        self.items     = collections.OrderedDict()
+        self.nbytes    = 0
+        if cachedir is not None and not os.path.isdir(cachedir):
+            os.makedirs(cachedir,exist_ok=True)
+
+    def cache_file(self,key):
+        # file name from the hash of the key
+        return os.path.join(self.cachedir,hashlib.md5(repr(key).encode()).hexdigest()+'.npy')
+
+    def get(self,key,func):
+        '''
+        returns the response of key, and evaluates it with func() if not found in memory or on disk
+        '''
+        if key in self.items:
+            self.items.move_to_end(key)
+            return self.items[key]
+
+        resp = None
+        if self.cachedir is not None and os.path.isfile(self.cache_file(key)):
+            try:
+                resp = np.load(self.cache_file(key))
+            except Exception:
+                resp = None
+        if resp is None:
+            resp = func()
+            if self.cachedir is not None:
+                # write to a temporary file first so that a broken file is never loaded
+                tfile = self.cache_file(key)[:-4]+'_%d.tmp.npy'%os.getpid()
+                np.save(tfile,resp)
+                os.replace(tfile,self.cache_file(key))
+
+        resp.flags.writeable = False
+        self.items[key] = resp
+        self.nbytes += resp.nbytes
+        while self.nbytes > self.max_bytes and len(self.items)>1:
+            self.nbytes -= self.items.popitem(last=False)[1].nbytes
+        return resp
+
+_resp_caches = {}
+def get_resp_cache(prepro_para):
+    '''
+    this function returns the response cache shared by all calls of preprocess_raw with the same 
+    'resp_cachedir' (optional, None for memory only) and 'resp_cache_mem' (optional, in GB) in prepro_para
+    '''
+    key = (prepro_para.get('resp_cachedir',None),prepro_para.get('resp_cache_mem',1.0))
+    if key not in _resp_caches:
+        _resp_caches[key] = ResponseCache(int(key[1]*1024**3),key[0])
+    return _resp_caches[key]
+
+def inv_response(tr,inv,pre_filt,water_level=60,output="VEL",resp_cache=None):
+    '''
+    this function returns the inverted response of the trace from the inventory in the frequency domain
+    with the pre-filter taper included, the same as used in obspy remove_response. it is cached by 
+    channel id, epoch of the channel, npts, sampling rate, pre_filt, water level and output
+    PARAMETERS:
+    ----------------------
+    tr:  obspy trace object of the noise data
+    inv: obspy inventory object with the response of the trace
+    pre_filt: pre-defined filter parameters
+    water_level: water level in dB for the inversion of the response
+    output: output units of the response
+    resp_cache: ResponseCache object (optional)
+    RETURNS:
+    ----------------------
+    resp: complex numpy array of the inverted response of nfft//2+1 points (nfft from _npts2nfft)
+    '''
+    chan = inv.select(network=tr.stats.network,station=tr.stats.station,location=tr.stats.location,\
+        channel=tr.stats.channel,time=tr.stats.starttime)[0][0][0]
+    nfft = _npts2nfft(tr.stats.npts)
+
+    def evaluate():
+        response = inv.get_response(tr.id,tr.stats.starttime)
+        freq_response,freqs = response.get_evalresp_response(tr.stats.delta,nfft,output=output)
+        invert_spectrum(freq_response,water_level)
+        return cosine_sac_taper(freqs,flimit=pre_filt)*freq_response
+
+    if resp_cache is None:
+        return evaluate()
+    key = ('inv',tr.id,str(chan.start_date),str(chan.end_date),nfft,float(tr.stats.sampling_rate),\
+        tuple(pre_filt),water_level,output)
+    return resp_cache.get(key,evaluate)
+
+def apply_response(tr,resp):
+    '''
+    this function removes the instrument response of a trace with the inverted response from inv_response,
+    following obspy remove_response: demean and taper of the trace before the rfft multiply
+    PARAMETERS:
+    ----------------------
+    tr:   obspy trace object of the noise data
+    resp: inverted response in the frequency domain of nfft//2+1 points
+    RETURNS:
+    ----------------------
+    tr: obspy trace object with the instrument response removed
+    '''
+    data = tr.data.astype(np.float64)
+    npts = len(data)
+    data -= data.mean()
+    data *= cosine_taper(npts,0.05,sactaper=True,halfcosine=False)
+    spect = np.fft.rfft(data,n=_npts2nfft(npts))
+    spect *= resp
+    spect[-1] = abs(spect[-1])+0.0j
+    tr.data = np.fft.irfft(spect)[0:npts]
+    return tr
+
+
 def mad(arr):
     """ 
     Median Absolute Deviation: MAD = median(|Xi- median(X)|)
@@ -1025,38 +2862,81 @@ def taper(data):
     ---------------------
     data: data matrix with taper applied
     '''
-    #ndata = np.zeros(shape=data.shape,dtype=data.dtype)
     if data.ndim == 1:
-        npts = data.shape[0]
-        # window length 
-        if npts*0.05>20:wlen = 20
-        else:wlen = npts*0.05
-        # taper values
-        func = _get_function_from_entry_point('taper', 'hann')
-        if 2*wlen == npts:
-            taper_sides = func(2*wlen)
-        else:
-            taper_sides = func(2*wlen+1)
-        # taper window
-        win  = np.hstack((taper_sides[:wlen], np.ones(npts-2*wlen),taper_sides[len(taper_sides) - wlen:]))
-        data *= win
+        data *= taper_window(data.shape[0])
     elif data.ndim == 2:
-        npts = data.shape[1]
-        # window length 
-        if npts*0.05>20:wlen = 20
-        else:wlen = npts*0.05
-        # taper values
-        func = _get_function_from_entry_point('taper', 'hann')
-        if 2*wlen == npts:
-            taper_sides = func(2*wlen)
-        else:
-            taper_sides = func(2*wlen + 1)
-        # taper window
-        win  = np.hstack((taper_sides[:wlen], np.ones(npts-2*wlen),taper_sides[len(taper_sides) - wlen:]))
+        win = taper_window(data.shape[1])
         for ii in range(data.shape[0]):
             data[ii] *= win
     return data
 
+@functools.lru_cache(maxsize=16)
+def taper_window(npts,max_len=20):
+    '''
+    this function returns the hann taper window used in taper: 5% of npts on each side but at most
+    max_len points. the windows are cached for each npts so that the taper function is not looked
+    up and rebuilt for every segment
+    PARAMETERS:
+    ---------------------
+    npts:    number of points of the window
+    max_len: max number of points of the taper on each side
+    RETURNS:
+    ---------------------
+    win: read-only 1D taper window
+    '''
+    wlen = int(np.minimum(int(npts*0.05),max_len))
+    func = _get_function_from_entry_point('taper', 'hann')
+    if 2*wlen == npts:
+        taper_sides = func(2*wlen)
+    else:
+        taper_sides = func(2*wlen+1)
+    win = np.hstack((taper_sides[:wlen], np.ones(npts-2*wlen),taper_sides[len(taper_sides) - wlen:]))
+    win.flags.writeable = False
+    return win
+
+@jit(nopython = True)
+def demean_detrend_taper(data,win):
+    '''
+    this Numba compiled function removes the mean and the linear trend of each row of a 2D matrix and 
+    applies the taper window in place, with two passes over each row: the first one sums the data for
+    the least-squares line (same fit as the QR in detrend, solved in closed form with the sample index
+    centered on the middle of the row) and the second one removes the line and tapers. the 
+    amplitude statistics for data selection are collected on the way. (used in cut_trace_make_statis)
+    PARAMETERS:
+    ---------------------
+    data: 2D matrix of the segments (modified in place)
+    win:  1D taper window with the length of the rows (see taper_window), or an empty array for no taper
+    RETURNS:
+    ---------------------
+    stats: 2D matrix of (nseg,3) with the max amplitude of each raw segment, the max amplitude after
+           demean/detrend and the number of non-zero points after demean/detrend
+    '''
+    nseg,npts = data.shape
+    dotaper = win.size > 0
+    stats = np.zeros((nseg,3))
+    kc  = (npts-1)/2.
+    skk = float(npts)*(float(npts)**2-1)/12.
+    for ii in range(nseg):
+        # sums for the mean and trend, and max of the raw data
+        s0 = 0.;s1 = 0.;amax = 0.
+        for kk in range(npts):
+            xx = data[ii,kk]
+            s0 += xx;s1 += (kk-kc)*xx
+            if abs(xx)>amax:amax = abs(xx)
+        slope = 0.
+        if skk>0:slope = s1/skk
+        inter = s0/npts-slope*kc
+
+        # remove the line and taper
+        amax1 = 0.;nzero = 0
+        for kk in range(npts):
+            xx = data[ii,kk]-(inter+slope*kk)
+            if abs(xx)>amax1:amax1 = abs(xx)
+            if xx!=0:nzero += 1
+            if dotaper:xx *= win[kk]
+            data[ii,kk] = xx
+        stats[ii,0] = amax;stats[ii,1] = amax1;stats[ii,2] = nzero
+    return stats
 
 @jit(nopython = True)
 def moving_ave(A,N):
@@ -1087,6 +2967,179 @@ def moving_ave(A,N):
             B[pos]=1
     return B[N:-N]
 
+@jit(nopython = True)
+def moving_ave_row(a,b,N):
+    '''
+    this Numba compiled function does the running smooth average of moving_ave on the 1-D array a and
+    writes it into b. the running sum and the padding of the edges with the first and last N points 
+    are the same as in moving_ave, without the padded copy of the array. (used in moving_ave_2d)
+    PARAMETERS:
+    ---------------------
+    a: 1-D array of data to be smoothed (at least 2*N+1 points)
+    b: 1-D array for the smoothed data
+    N: integer, it defines the half window length to smooth
+    '''
+    npts = a.size
+    # do summing only once
+    tmp=0.
+    for i in range(N):
+        tmp+=a[i]
+    for i in range(N+1):
+        tmp+=a[i]
+    b[0]=tmp/(2*N+1)
+    # leaving points from the left padding
+    for pos in range(1,N+1):
+        tmp=tmp-a[pos-1]+a[pos+N]
+        b[pos]=tmp/(2*N+1)
+    for pos in range(N+1,npts-N):
+        tmp=tmp-a[pos-N-1]+a[pos+N]
+        b[pos]=tmp/(2*N+1)
+    # entering points from the right padding
+    for pos in range(max(npts-N,N+1),npts):
+        tmp=tmp-a[pos-N-1]+a[pos]
+        b[pos]=tmp/(2*N+1)
+    for pos in range(npts):
+        if b[pos]==0:
+            b[pos]=1
+
+@jit(nopython = True)
+def moving_ave_2d(A,N):
+    '''
+    this Numba compiled function does the running smooth average of moving_ave along each row of a 
+    2D matrix at once. each row is identical to moving_ave of that row.
+    PARAMETERS:
+    ---------------------
+    A: 2-D array of data to be smoothed along axis 1 (at least 2*N+1 points per row)
+    N: integer, it defines the half window length to smooth
+    
+    RETURNS:
+    ---------------------
+    B: 2-D array with smoothed data
+    '''
+    B = np.zeros(A.shape,A.dtype)
+    for ii in range(A.shape[0]):
+        moving_ave_row(A[ii],B[ii],N)
+    return B
+
+@jit(nopython = True)
+def running_mean_norm_row(a,out,N,b):
+    '''
+    this Numba compiled function writes a/moving_ave(abs(a),N) of the 1-D array a into out. the running
+    sum of abs(a) is taken on the fly (with the same order of the sums and the same padding of the edges
+    as moving_ave) and each point is divided by it right away, so that no smoothed array is stored.
+    (used in running_mean_norm)
+    PARAMETERS:
+    ---------------------
+    a:   1-D float array of data (at least 2*N+1 points)
+    out: 1-D array for the normalized data
+    N:   integer, it defines the half window length to smooth
+    b:   1-element array of the dtype of a to round the running mean to the precision of moving_ave
+    '''
+    npts = a.size
+    # do summing only once
+    tmp=0.
+    for i in range(N):
+        tmp+=abs(a[i])
+    for i in range(N+1):
+        tmp+=abs(a[i])
+    b[0]=tmp/(2*N+1)
+    if b[0]==0:b[0]=1
+    out[0]=a[0]/b[0]
+    # leaving points from the left padding
+    for pos in range(1,N+1):
+        tmp=tmp-abs(a[pos-1])+abs(a[pos+N])
+        b[0]=tmp/(2*N+1)
+        if b[0]==0:b[0]=1
+        out[pos]=a[pos]/b[0]
+    for pos in range(N+1,npts-N):
+        tmp=tmp-abs(a[pos-N-1])+abs(a[pos+N])
+        b[0]=tmp/(2*N+1)
+        if b[0]==0:b[0]=1
+        out[pos]=a[pos]/b[0]
+    # entering points from the right padding
+    for pos in range(max(npts-N,N+1),npts):
+        tmp=tmp-abs(a[pos-N-1])+abs(a[pos])
+        b[0]=tmp/(2*N+1)
+        if b[0]==0:b[0]=1
+        out[pos]=a[pos]/b[0]
+
+@jit(nopython = True)
+def running_mean_norm(A,N):
+    '''
+    this Numba compiled function does the running mean normalization of each row of a 2D matrix of real
+    data, i.e., A/moving_ave(abs(A),N) for each row, in one pass over each row (see running_mean_norm_row)
+    PARAMETERS:
+    ---------------------
+    A: 2-D float array of data (at least 2*N+1 points per row)
+    N: integer, it defines the half window length to smooth
+    
+    RETURNS:
+    ---------------------
+    B: 2-D array of normalized data
+    '''
+    B = np.empty(A.shape,A.dtype)
+    b = np.zeros(1,A.dtype)
+    for ii in range(A.shape[0]):
+        running_mean_norm_row(A[ii],B[ii],N,b)
+    return B
+
+def freq_band_index(fft_para,Nfft):
+    '''
+    this function finds the indexes of the frequency band [freqmin,freqmax] in the one-sided spectrum
+    of Nfft points, together with the cosine tapers of Napod points on both sides used in whitening.
+    PARAMETERS:
+    ----------------------
+    fft_para: dict containing dt, freqmin and freqmax
+    Nfft: number of points of the fft
+    RETURNS:
+    ----------------------
+    low:   first index of the left taper
+    left:  first index of the pass band
+    right: last index of the pass band
+    high:  last index (excluded) of the right taper
+    '''
+    delta   = fft_para['dt']
+    freqmin = fft_para['freqmin']
+    freqmax = fft_para['freqmax']
+
+    Napod = 100
+    Nfft = int(Nfft)
+    freqVec = scipy.fftpack.fftfreq(Nfft, d=delta)[:Nfft // 2]
+    J = np.where((freqVec >= freqmin) & (freqVec <= freqmax))[0]
+    low = J[0] - Napod
+    if low <= 0:
+        low = 1
+
+    left = J[0]
+    right = J[-1]
+    high = J[-1] + Napod
+    if high > Nfft/2:
+        high = int(Nfft//2)
+    return low,left,right,high
+
+@functools.lru_cache(maxsize=16)
+def whiten_band(Nfft,dt,freqmin,freqmax):
+    '''
+    this function returns the band indexes of freq_band_index together with the cosine tapers on both
+    sides of the band used in whiten. they are cached for each set of parameters so that they are only
+    computed once for all the stations and time chunks
+    PARAMETERS:
+    ----------------------
+    Nfft: number of points of the fft
+    dt, freqmin, freqmax: sampling space and frequency band of the whitening
+    RETURNS:
+    ----------------------
+    low,left,right,high: band indexes (see freq_band_index)
+    ltaper: read-only taper of the indexes low:left
+    rtaper: read-only taper of the indexes right:high
+    '''
+    low,left,right,high = freq_band_index({'dt':dt,'freqmin':freqmin,'freqmax':freqmax},Nfft)
+    ltaper = np.cos(np.linspace(np.pi / 2., np.pi, left - low)) ** 2
+    rtaper = np.cos(np.linspace(0., np.pi / 2., high - right)) ** 2
+    ltaper.flags.writeable = False
+    rtaper.flags.writeable = False
+    return low,left,right,high,ltaper,rtaper
+
 
 def whiten(data, fft_para):
     '''
@@ -1102,17 +3155,16 @@ def whiten(data, fft_para):
         freqmax: The upper frequency bound
         smooth_N: integer, it defines the half window length to smooth
         to_whiten: whitening method between 'one-bit' and 'running-mean'
+        real_fft: whiten the one-sided spectrum from rfft instead of the full spectrum (optional)
     RETURNS:
     ----------------------
     FFTRawSign: numpy.ndarray contains the FFT of the whitened input trace between the frequency bounds
     '''
 
     # load parameters
-    delta   = fft_para['dt']
-    freqmin = fft_para['freqmin']
-    freqmax = fft_para['freqmax']
     smooth_N  = fft_para['smooth_N']
     to_whiten = fft_para['to_whiten']
+    real_fft  = fft_para.get('real_fft',False)
 
     # Speed up FFT by padding to optimal size for FFTPACK
     if data.ndim == 1:
@@ -1122,47 +3174,28 @@ def whiten(data, fft_para):
 
     Nfft = int(next_fast_len(int(data.shape[axis])))
 
-    Napod = 100
-    Nfft = int(Nfft)
-    freqVec = scipy.fftpack.fftfreq(Nfft, d=delta)[:Nfft // 2]
-    J = np.where((freqVec >= freqmin) & (freqVec <= freqmax))[0]
-    low = J[0] - Napod
-    if low <= 0:
-        low = 1
-
-    left = J[0]
-    right = J[-1]
-    high = J[-1] + Napod
-    if high > Nfft/2:
-        high = int(Nfft//2)
+    low,left,right,high,ltaper,rtaper = whiten_band(Nfft,fft_para['dt'],fft_para['freqmin'],fft_para['freqmax'])
 
-    FFTRawSign = scipy.fftpack.fft(data, Nfft,axis=axis)
+    FFTRawSign = fft_forward(fft_para,data,Nfft,axis=axis)
     # Left tapering:
     if axis == 1:
         FFTRawSign[:,0:low] *= 0
-        FFTRawSign[:,low:left] = np.cos(
-            np.linspace(np.pi / 2., np.pi, left - low)) ** 2 * np.exp(
-            1j * np.angle(FFTRawSign[:,low:left]))
+        FFTRawSign[:,low:left] = ltaper * np.exp(1j * np.angle(FFTRawSign[:,low:left]))
         # Pass band:
         if to_whiten=='one_bit':
             FFTRawSign[:,left:right] = np.exp(1j * np.angle(FFTRawSign[:,left:right]))
         elif to_whiten == 'running_mean':
-            for ii in range(data.shape[0]):
-                tave = moving_ave(np.abs(FFTRawSign[ii,left:right]),smooth_N)
-                FFTRawSign[ii,left:right] = FFTRawSign[ii,left:right]/tave
+            FFTRawSign[:,left:right] /= moving_ave_2d(np.abs(FFTRawSign[:,left:right]),smooth_N)
         # Right tapering:
-        FFTRawSign[:,right:high] = np.cos(
-            np.linspace(0., np.pi / 2., high - right)) ** 2 * np.exp(
-            1j * np.angle(FFTRawSign[:,right:high]))
+        FFTRawSign[:,right:high] = rtaper * np.exp(1j * np.angle(FFTRawSign[:,right:high]))
         FFTRawSign[:,high:Nfft//2] *= 0
 
         # Hermitian symmetry (because the input is real)
-        FFTRawSign[:,-(Nfft//2)+1:] = np.flip(np.conj(FFTRawSign[:,1:(Nfft//2)]),axis=axis)
+        if not real_fft:
+            FFTRawSign[:,-(Nfft//2)+1:] = np.flip(np.conj(FFTRawSign[:,1:(Nfft//2)]),axis=axis)
     else:
         FFTRawSign[0:low] *= 0
-        FFTRawSign[low:left] = np.cos(
-            np.linspace(np.pi / 2., np.pi, left - low)) ** 2 * np.exp(
-            1j * np.angle(FFTRawSign[low:left]))
+        FFTRawSign[low:left] = ltaper * np.exp(1j * np.angle(FFTRawSign[low:left]))
         # Pass band:
         if to_whiten == 'one-bit':
             FFTRawSign[left:right] = np.exp(1j * np.angle(FFTRawSign[left:right]))
@@ -1170,13 +3203,12 @@ def whiten(data, fft_para):
             tave = moving_ave(np.abs(FFTRawSign[left:right]),smooth_N)
             FFTRawSign[left:right] = FFTRawSign[left:right]/tave
         # Right tapering:
-        FFTRawSign[right:high] = np.cos(
-            np.linspace(0., np.pi / 2., high - right)) ** 2 * np.exp(
-            1j * np.angle(FFTRawSign[right:high]))
+        FFTRawSign[right:high] = rtaper * np.exp(1j * np.angle(FFTRawSign[right:high]))
         FFTRawSign[high:Nfft//2] *= 0
 
         # Hermitian symmetry (because the input is real)
-        FFTRawSign[-(Nfft//2)+1:] = FFTRawSign[1:(Nfft//2)].conjugate()[::-1]
+        if not real_fft:
+            FFTRawSign[-(Nfft//2)+1:] = FFTRawSign[1:(Nfft//2)].conjugate()[::-1]
  
     return FFTRawSign
 
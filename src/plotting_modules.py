@@ -5,6 +5,7 @@ import obspy
 import scipy
 import pyasdf
 import numpy as np
+import noise_module
 import matplotlib
 import matplotlib.pyplot as plt
 from scipy.fftpack import next_fast_len
@@ -125,13 +126,15 @@ def plot_substack_cc(sfile,freqmin,freqmax,disp_lag=None,savefig=True,sdir='./')
         if sdir==None:print('no path selected! save figures in the default path')
 
     try:
-        ds = pyasdf.ASDFDataSet(sfile,mode='r')
+        # ASDF or columnar file of S1
+        ds = noise_module.CCFReader(sfile)
         # extract common variables
-        spairs = ds.auxiliary_data.list()
-        path_lists = ds.auxiliary_data[spairs[0]].list()
-        flag   = ds.auxiliary_data[spairs[0]][path_lists[0]].parameters['substack']
-        dt     = ds.auxiliary_data[spairs[0]][path_lists[0]].parameters['dt']
-        maxlag = ds.auxiliary_data[spairs[0]][path_lists[0]].parameters['maxlag']
+        spairs = sorted(set([tinfo[0] for tinfo in ds.list()]))
+        path_lists = ds.paths(spairs[0])
+        parameters = ds.parameters(spairs[0],path_lists[0])
+        flag   = parameters['substack']
+        dt     = parameters['dt']
+        maxlag = parameters['maxlag']
     except Exception:
         print("exit! cannot open %s to read"%sfile);sys.exit()
 
@@ -145,9 +148,6 @@ def plot_substack_cc(sfile,freqmin,freqmax,disp_lag=None,savefig=True,sdir='./')
 
     # t is the time labels for plotting
     t = np.arange(-int(disp_lag),int(disp_lag)+dt,step=int(2*int(disp_lag)/4)) 
-    # windowing the data
-    indx1 = int((maxlag-disp_lag)/dt)
-    indx2 = indx1+2*int(disp_lag/dt)+1
 
     for spair in spairs:
         ttr = spair.split('_')
@@ -156,16 +156,17 @@ def plot_substack_cc(sfile,freqmin,freqmax,disp_lag=None,savefig=True,sdir='./')
         for ipath in path_lists:
             chan1,chan2 = ipath.split('_')
             try:
-                dist = ds.auxiliary_data[spair][ipath].parameters['dist']
-                ngood= ds.auxiliary_data[spair][ipath].parameters['ngood']
-                ttime= ds.auxiliary_data[spair][ipath].parameters['time']
+                cwin = noise_module.read_ccf_window(ds,spair,ipath,[-disp_lag,disp_lag])
+                dist = cwin.parameters['dist']
+                ngood= cwin.parameters['ngood']
+                ttime= cwin.parameters['time']
                 timestamp = np.empty(ttime.size,dtype='datetime64[s]')
             except Exception:
                 print('continue! something wrong with %s %s'%(spair,ipath))
                 continue
             
-            # cc matrix
-            data = ds.auxiliary_data[spair][ipath].data[:,indx1:indx2]
+            # cc matrix (only the displayed lags are read)
+            data = cwin.data
             nwin = data.shape[0]
             amax = np.zeros(nwin,dtype=np.float32)
             if nwin==0 or len(ngood)==1: print('continue! no enough substacks!');continue
@@ -241,13 +242,15 @@ def plot_substack_cc_spect(sfile,freqmin,freqmax,disp_lag=None,savefig=True,sdir
         if sdir==None:print('no path selected! save figures in the default path')
 
     try:
-        ds = pyasdf.ASDFDataSet(sfile,mode='r')
+        # ASDF or columnar file of S1
+        ds = noise_module.CCFReader(sfile)
         # extract common variables
-        spairs = ds.auxiliary_data.list()
-        path_lists = ds.auxiliary_data[spairs[0]].list()
-        flag   = ds.auxiliary_data[spairs[0]][path_lists[0]].parameters['substack']
-        dt     = ds.auxiliary_data[spairs[0]][path_lists[0]].parameters['dt']
-        maxlag = ds.auxiliary_data[spairs[0]][path_lists[0]].parameters['maxlag']
+        spairs = sorted(set([tinfo[0] for tinfo in ds.list()]))
+        path_lists = ds.paths(spairs[0])
+        parameters = ds.parameters(spairs[0],path_lists[0])
+        flag   = parameters['substack']
+        dt     = parameters['dt']
+        maxlag = parameters['maxlag']
     except Exception:
         print("exit! cannot open %s to read"%sfile);sys.exit()
 
@@ -259,8 +262,7 @@ def plot_substack_cc_spect(sfile,freqmin,freqmax,disp_lag=None,savefig=True,sdir
     if not disp_lag:disp_lag=maxlag
     if disp_lag>maxlag:raise ValueError('lag excceds maxlag!')
     t = np.arange(-int(disp_lag),int(disp_lag)+dt,step=int(2*int(disp_lag)/4)) 
-    indx1 = int((maxlag-disp_lag)/dt)
-    indx2 = indx1+2*int(disp_lag/dt)+1
+    indx1,indx2 = noise_module.lag_window(dt,maxlag,[-disp_lag,disp_lag])
     nfft  = int(next_fast_len(indx2-indx1))
     freq  = scipy.fftpack.fftfreq(nfft,d=dt)[:nfft//2]
 
@@ -271,16 +273,17 @@ def plot_substack_cc_spect(sfile,freqmin,freqmax,disp_lag=None,savefig=True,sdir
         for ipath in path_lists:
             chan1,chan2 = ipath.split('_')
             try:
-                dist = ds.auxiliary_data[spair][ipath].parameters['dist']
-                ngood= ds.auxiliary_data[spair][ipath].parameters['ngood']
-                ttime= ds.auxiliary_data[spair][ipath].parameters['time']
+                cwin = noise_module.read_ccf_window(ds,spair,ipath,[-disp_lag,disp_lag])
+                dist = cwin.parameters['dist']
+                ngood= cwin.parameters['ngood']
+                ttime= cwin.parameters['time']
                 timestamp = np.empty(ttime.size,dtype='datetime64[s]')
             except Exception:
                 print('continue! something wrong with %s %s'%(spair,ipath))
                 continue
 
-            # cc matrix
-            data = ds.auxiliary_data[spair][ipath].data[:,indx1:indx2]
+            # cc matrix (only the displayed lags are read)
+            data = cwin.data
             nwin = data.shape[0]
             amax = np.zeros(nwin,dtype=np.float32)
             spec = np.zeros(shape=(nwin,nfft//2),dtype=np.complex64)
@@ -576,8 +579,7 @@ def plot_all_moveout(sfiles,dtype,freqmin,freqmax,ccomp,dist_inc,disp_lag=None,s
     if not disp_lag:disp_lag=maxlag
     if disp_lag>maxlag:raise ValueError('lag excceds maxlag!')
     t = np.arange(-int(disp_lag),int(disp_lag)+dt,step=(int(2*int(disp_lag)/4)))
-    indx1 = int((maxlag-disp_lag)/dt)
-    indx2 = indx1+2*int(disp_lag/dt)+1
+    indx1,indx2 = noise_module.lag_window(dt,maxlag,[-disp_lag,disp_lag])
 
     # cc matrix
     nwin = len(sfiles)
@@ -585,16 +587,16 @@ def plot_all_moveout(sfiles,dtype,freqmin,freqmax,ccomp,dist_inc,disp_lag=None,s
     dist = np.zeros(nwin,dtype=np.float32)
     ngood= np.zeros(nwin,dtype=np.int16)    
 
-    # load cc and parameter matrix
+    # load cc and parameter matrix (only the displayed lags are read)
     for ii in range(len(sfiles)):
         sfile = sfiles[ii]
 
-        ds = pyasdf.ASDFDataSet(sfile,mode='r')
         try:
             # load data to variables
-            dist[ii] = ds.auxiliary_data[dtype][path].parameters['dist']
-            ngood[ii]= ds.auxiliary_data[dtype][path].parameters['ngood']
-            tdata    = ds.auxiliary_data[dtype][path].data[indx1:indx2]
+            cwin = noise_module.read_ccf_window(sfile,dtype,path,[-disp_lag,disp_lag])
+            dist[ii] = cwin.parameters['dist']
+            ngood[ii]= cwin.parameters['ngood']
+            tdata    = cwin.data
         except Exception:
             print("continue! cannot read %s "%sfile);continue
 
@@ -196,13 +196,14 @@ for ista in range (rank,splits+size-extra,size):
                     #--------break a continous recording into pieces----------
                     t0=time.time()
                     for ii,win in enumerate(source[0].slide(window_length=cc_len, step=step)):
-                        win.detrend(type="constant")
-                        win.detrend(type="linear")
-                        trace_madS.append(np.max(np.abs(win.data))/all_madS)
-                        trace_stdS.append(np.max(np.abs(win.data))/all_stdS)
-                        nonzeroS.append(np.count_nonzero(win.data)/win.stats.npts)
+                        # demean/detrend/taper (max_length of 20 s) of a copy of the window in one compiled pass
+                        data  = np.array(win.data,dtype=np.float64).reshape(1,win.stats.npts)
+                        stats = noise_module.demean_detrend_taper(data,noise_module.taper_window(win.stats.npts,int(20*win.stats.sampling_rate)))
+                        win.data = data[0]
+                        trace_madS.append(stats[0,1]/all_madS)
+                        trace_stdS.append(stats[0,1]/all_stdS)
+                        nonzeroS.append(stats[0,2]/win.stats.npts)
                         nptsS.append(win.stats.npts)
-                        win.taper(max_percentage=0.05,max_length=20)
                         source_slice.append(win)
                     del source
                     
@@ -345,13 +346,14 @@ for ista in range (rank,splits+size-extra,size):
                         #--------break a continous recording into pieces----------
                         t0=time.time()
                         for ii,win in enumerate(source[0].slide(window_length=cc_len, step=step)):
-                            win.detrend(type="constant")
-                            win.detrend(type="linear")
-                            trace_madS.append(np.max(np.abs(win.data))/all_madS)
-                            trace_stdS.append(np.max(np.abs(win.data))/all_stdS)
-                            nonzeroS.append(np.count_nonzero(win.data)/win.stats.npts)
+                            # demean/detrend/taper (max_length of 20 s) of a copy of the window in one compiled pass
+                            data  = np.array(win.data,dtype=np.float64).reshape(1,win.stats.npts)
+                            stats = noise_module.demean_detrend_taper(data,noise_module.taper_window(win.stats.npts,int(20*win.stats.sampling_rate)))
+                            win.data = data[0]
+                            trace_madS.append(stats[0,1]/all_madS)
+                            trace_stdS.append(stats[0,1]/all_stdS)
+                            nonzeroS.append(stats[0,2]/win.stats.npts)
                             nptsS.append(win.stats.npts)
-                            win.taper(max_percentage=0.05,max_length=20)
                             source_slice.append(win)
                         del source
                         t1=time.time()
@@ -208,6 +208,9 @@ for ii in range(rank,splits+size-extra,size):
             print('loading data takes %6.3fs'%(t2-t1))
 
         if no_data==0:
+            #------all stacks of the pair are buffered and written into the ASDF file at once------
+            stack_ds = noise_module.CCFWriter(stack_h5)
+
             #--------make statistic analysis of CCFs at each component----------
             for icomp in range(ncomp):
                 indx1 = np.where(nflag[:,icomp]>0)[0]
@@ -249,146 +252,45 @@ for ii in range(rank,splits+size-extra,size):
                     #------------------output path and file name----------------------
                     crap   = np.zeros(int(2*maxlag/dt)+1,dtype=np.float32)
 
-                    #------in case it already exists------
-                    if not os.path.isfile(stack_h5):
-                        with pyasdf.ASDFDataSet(stack_h5,mpi=False) as stack_ds:
-                            pass 
-
-                    with pyasdf.ASDFDataSet(stack_h5,mpi=False) as stack_ds:
-
-                        tcorr = np.zeros((ncomp,int(2*maxlag/dt)+1),dtype=np.float32)
-                        #-----loop through all E-N-Z components-----
-                        for jj in range(ncomp):
-                            icomp  = enz_components[jj]
-                            tindx1 = np.arange(indx1,indx2,1)
-                            tindx2 = np.where(nflag[tindx1,jj]>0)[0]
-                            indx   = tindx1[tindx2]*ncomp+jj
-
-                            #-----accumulated good hours--------
-                            tngood = 0
-                            for tii in tindx1[tindx2]:
-                                tngood += ngood[tii,jj]
-                            new_parameters = parameters
-                            new_parameters['ngood'] = tngood
-
-                            #-----break if no good data in the stacking-days-----
-                            if len(indx)==0:
-                                continue
-
-                            #------do average-----
-                            tcorr[jj] = np.mean(corr[indx],axis=0)
-
-                            if flag:
-                                print('estimate the SNR of component %s for %s_%s in E-N-Z system' % (enz_components[jj],source,receiver))
-                            
-                            #--------evaluate the SNR of the signal at target period range-------
-                            #new_parameters = noise_module.get_SNR(tcorr[jj],snr_parameters,parameters)
+                    tcorr = np.zeros((ncomp,int(2*maxlag/dt)+1),dtype=np.float32)
+                    #-----loop through all E-N-Z components-----
+                    for jj in range(ncomp):
+                        icomp  = enz_components[jj]
+                        tindx1 = np.arange(indx1,indx2,1)
+                        tindx2 = np.where(nflag[tindx1,jj]>0)[0]
+                        indx   = tindx1[tindx2]*ncomp+jj
 
-                            #------save the time domain cross-correlation functions-----
-                            data_type = 'F'+date_s+'T'+date_e
-                            path = icomp
-                            crap = tcorr[jj]
-                            stack_ds.add_auxiliary_data(data=crap, data_type=data_type, path=path, parameters=new_parameters)
-
-                        #-------do rotation here if needed---------
-                        if do_rotation:
-                            if flag:
-                                print('doing matrix rotation now!')
-
-                            #---read azi, baz info---
-                            azi = new_parameters['azi']
-                            baz = new_parameters['baz']
-
-                            #---angles to be corrected----
-                            if correction:
-                                ind = sta_list.index(staS)
-                                acorr = angles[ind]
-                                ind = sta_list.index(staR)
-                                bcorr = angles[ind]
-                                cosa = np.cos((azi+acorr)*pi/180)
-                                sina = np.sin((azi+acorr)*pi/180)
-                                cosb = np.cos((baz+bcorr)*pi/180)
-                                sinb = np.sin((baz+bcorr)*pi/180)
-                            else:
-                                cosa = np.cos(azi*pi/180)
-                                sina = np.sin(azi*pi/180)
-                                cosb = np.cos(baz*pi/180)
-                                sinb = np.sin(baz*pi/180)
-
-                            #------9 component tensor rotation 1-by-1------
-                            for jj in range(len(rtz_components)):
-                                
-                                if jj==0:
-                                    crap = -cosb*tcorr[7]-sinb*tcorr[6]
-                                elif jj==1:
-                                    crap = sinb*tcorr[7]-cosb*tcorr[6]
-                                elif jj==2:
-                                    crap = tcorr[8]
-                                    continue
-                                elif jj==3:
-                                    crap = -cosa*cosb*tcorr[4]-cosa*sinb*tcorr[3]-sina*cosb*tcorr[1]-sina*sinb*tcorr[0]
-                                elif jj==4:
-                                    crap = cosa*sinb*tcorr[4]-cosa*cosb*tcorr[3]+sina*sinb*tcorr[1]-sina*cosb*tcorr[0]
-                                elif jj==5:
-                                    crap = cosa*tcorr[5]+sina*tcorr[2]
-                                elif jj==6:
-                                    crap = sina*cosb*tcorr[4]+sina*sinb*tcorr[3]-cosa*cosb*tcorr[1]-cosa*sinb*tcorr[0]
-                                elif jj==7:
-                                    crap = -sina*sinb*tcorr[4]+sina*cosb*tcorr[3]+cosa*sinb*tcorr[1]-cosa*cosb*tcorr[0]
-                                else:
-                                    crap = -sina*tcorr[5]+cosa*tcorr[2]
-
-                                if flag:
-                                    print('estimate the SNR of component %s for %s_%s in R-T-Z system' % (rtz_components[jj],source,receiver))
-                                #--------evaluate the SNR of the signal at target period range-------
-                                #new_parameters = noise_module.get_SNR(crap,snr_parameters,parameters)
-
-                                #------save the time domain cross-correlation functions-----
-                                data_type = 'F'+date_s+'T'+date_e
-                                path = rtz_components[jj]
-                                stack_ds.add_auxiliary_data(data=crap, data_type=data_type, path=path, parameters=new_parameters)
-            
-            t3=time.time()
-            if flag:
-                print('stack all sub-segments takes %6.3fs'%(t3-t2))
-
-            #--------------now stack all of the days---------------
-            tcorr = np.zeros((ncomp,int(2*maxlag/dt)+1),dtype=np.float32)
-            with pyasdf.ASDFDataSet(stack_h5,mpi=False) as stack_ds:
-                for jj in range(ncomp):
-                    icomp = enz_components[jj]
-
-                    tindx1 = np.arange(0,ndays,1)
-                    tindx2 = np.where(nflag[tindx1,jj]>0)[0]
-                    indx   = tindx1[tindx2]*ncomp+jj
-
-                    #-----make nan in the stacking-days-----
-                    if len(indx)==0:
-                        continue
-
-                    #------do average-----
-                    tcorr[jj] = np.mean(corr[indx],axis=0)
-
-                    if nstack<=1:
+                        #-----accumulated good hours--------
                         tngood = 0
                         for tii in tindx1[tindx2]:
                             tngood += ngood[tii,jj]
                         new_parameters = parameters
                         new_parameters['ngood'] = tngood
-                    
-                    #--------evaluate the SNR of the signal at target period range-------
-                    #new_parameters = noise_module.get_SNR(tcorr[jj],snr_parameters,parameters)
 
-                    #------save the time domain cross-correlation functions-----
-                    data_type = 'Allstacked'
-                    path = icomp
-                    crap = tcorr[jj]
-                    stack_ds.add_auxiliary_data(data=crap, data_type=data_type, path=path, parameters=new_parameters)
+                        #-----break if no good data in the stacking-days-----
+                        if len(indx)==0:
+                            continue
+
+                        #------do average-----
+                        tcorr[jj] = np.mean(corr[indx],axis=0)
+
+                        if flag:
+                            print('estimate the SNR of component %s for %s_%s in E-N-Z system' % (enz_components[jj],source,receiver))
+                        
+                        #--------evaluate the SNR of the signal at target period range-------
+                        #new_parameters = noise_module.get_SNR(tcorr[jj],snr_parameters,parameters)
+
+                        #------save the time domain cross-correlation functions-----
+                        data_type = 'F'+date_s+'T'+date_e
+                        path = icomp
+                        crap = tcorr[jj]
+                        stack_ds.add_auxiliary_data(data=crap, data_type=data_type, path=path, parameters=new_parameters)
 
-                #----do rotation-----
-                if do_rotation:
+                    #-------do rotation here if needed---------
+                    if do_rotation:
+                        if flag:
+                            print('doing matrix rotation now!')
 
-                    if nstack<=1:
                         #---read azi, baz info---
                         azi = new_parameters['azi']
                         baz = new_parameters['baz']
@@ -409,37 +311,131 @@ for ii in range(rank,splits+size-extra,size):
                             cosb = np.cos(baz*pi/180)
                             sinb = np.sin(baz*pi/180)
 
-                    #------9 component tensor rotation 1-by-1------
-                    for jj in range(len(rtz_components)):
-                        
-                        if jj==0:
-                            crap = -cosb*tcorr[7]-sinb*tcorr[6]
-                        elif jj==1:
-                            crap = sinb*tcorr[7]-cosb*tcorr[6]
-                        elif jj==2:
-                            crap = tcorr[8]
-                            continue
-                        elif jj==3:
-                            crap = -cosa*cosb*tcorr[4]-cosa*sinb*tcorr[3]-sina*cosb*tcorr[1]-sina*sinb*tcorr[0]
-                        elif jj==4:
-                            crap = cosa*sinb*tcorr[4]-cosa*cosb*tcorr[3]+sina*sinb*tcorr[1]-sina*cosb*tcorr[0]
-                        elif jj==5:
-                            crap = cosa*tcorr[5]+sina*tcorr[2]
-                        elif jj==6:
-                            crap = sina*cosb*tcorr[4]+sina*sinb*tcorr[3]-cosa*cosb*tcorr[1]-cosa*sinb*tcorr[0]
-                        elif jj==7:
-                            crap = -sina*sinb*tcorr[4]+sina*cosb*tcorr[3]+cosa*sinb*tcorr[1]-cosa*cosb*tcorr[0]
-                        else:
-                            crap = -sina*tcorr[5]+cosa*tcorr[2]
+                        #------9 component tensor rotation 1-by-1------
+                        for jj in range(len(rtz_components)):
+                            
+                            if jj==0:
+                                crap = -cosb*tcorr[7]-sinb*tcorr[6]
+                            elif jj==1:
+                                crap = sinb*tcorr[7]-cosb*tcorr[6]
+                            elif jj==2:
+                                crap = tcorr[8]
+                                continue
+                            elif jj==3:
+                                crap = -cosa*cosb*tcorr[4]-cosa*sinb*tcorr[3]-sina*cosb*tcorr[1]-sina*sinb*tcorr[0]
+                            elif jj==4:
+                                crap = cosa*sinb*tcorr[4]-cosa*cosb*tcorr[3]+sina*sinb*tcorr[1]-sina*cosb*tcorr[0]
+                            elif jj==5:
+                                crap = cosa*tcorr[5]+sina*tcorr[2]
+                            elif jj==6:
+                                crap = sina*cosb*tcorr[4]+sina*sinb*tcorr[3]-cosa*cosb*tcorr[1]-cosa*sinb*tcorr[0]
+                            elif jj==7:
+                                crap = -sina*sinb*tcorr[4]+sina*cosb*tcorr[3]+cosa*sinb*tcorr[1]-cosa*cosb*tcorr[0]
+                            else:
+                                crap = -sina*tcorr[5]+cosa*tcorr[2]
 
-                        #--------evaluate the SNR of the signal at target period range-------
-                        #new_parameters = noise_module.get_SNR(crap,snr_parameters,parameters)
+                            if flag:
+                                print('estimate the SNR of component %s for %s_%s in R-T-Z system' % (rtz_components[jj],source,receiver))
+                            #--------evaluate the SNR of the signal at target period range-------
+                            #new_parameters = noise_module.get_SNR(crap,snr_parameters,parameters)
 
-                        #------save the time domain cross-correlation functions-----
-                        data_type = 'Allstacked'
-                        path = rtz_components[jj]
-                        stack_ds.add_auxiliary_data(data=crap, data_type=data_type, path=path, parameters=new_parameters)
-            
+                            #------save the time domain cross-correlation functions-----
+                            data_type = 'F'+date_s+'T'+date_e
+                            path = rtz_components[jj]
+                            stack_ds.add_auxiliary_data(data=crap, data_type=data_type, path=path, parameters=new_parameters)
+
+            t3=time.time()
+            if flag:
+                print('stack all sub-segments takes %6.3fs'%(t3-t2))
+
+            #--------------now stack all of the days---------------
+            tcorr = np.zeros((ncomp,int(2*maxlag/dt)+1),dtype=np.float32)
+            for jj in range(ncomp):
+                icomp = enz_components[jj]
+
+                tindx1 = np.arange(0,ndays,1)
+                tindx2 = np.where(nflag[tindx1,jj]>0)[0]
+                indx   = tindx1[tindx2]*ncomp+jj
+
+                #-----make nan in the stacking-days-----
+                if len(indx)==0:
+                    continue
+
+                #------do average-----
+                tcorr[jj] = np.mean(corr[indx],axis=0)
+
+                if nstack<=1:
+                    tngood = 0
+                    for tii in tindx1[tindx2]:
+                        tngood += ngood[tii,jj]
+                    new_parameters = parameters
+                    new_parameters['ngood'] = tngood
+                
+                #--------evaluate the SNR of the signal at target period range-------
+                #new_parameters = noise_module.get_SNR(tcorr[jj],snr_parameters,parameters)
+
+                #------save the time domain cross-correlation functions-----
+                data_type = 'Allstacked'
+                path = icomp
+                crap = tcorr[jj]
+                stack_ds.add_auxiliary_data(data=crap, data_type=data_type, path=path, parameters=new_parameters)
+
+            #----do rotation-----
+            if do_rotation:
+
+                if nstack<=1:
+                    #---read azi, baz info---
+                    azi = new_parameters['azi']
+                    baz = new_parameters['baz']
+
+                    #---angles to be corrected----
+                    if correction:
+                        ind = sta_list.index(staS)
+                        acorr = angles[ind]
+                        ind = sta_list.index(staR)
+                        bcorr = angles[ind]
+                        cosa = np.cos((azi+acorr)*pi/180)
+                        sina = np.sin((azi+acorr)*pi/180)
+                        cosb = np.cos((baz+bcorr)*pi/180)
+                        sinb = np.sin((baz+bcorr)*pi/180)
+                    else:
+                        cosa = np.cos(azi*pi/180)
+                        sina = np.sin(azi*pi/180)
+                        cosb = np.cos(baz*pi/180)
+                        sinb = np.sin(baz*pi/180)
+
+                #------9 component tensor rotation 1-by-1------
+                for jj in range(len(rtz_components)):
+                    
+                    if jj==0:
+                        crap = -cosb*tcorr[7]-sinb*tcorr[6]
+                    elif jj==1:
+                        crap = sinb*tcorr[7]-cosb*tcorr[6]
+                    elif jj==2:
+                        crap = tcorr[8]
+                        continue
+                    elif jj==3:
+                        crap = -cosa*cosb*tcorr[4]-cosa*sinb*tcorr[3]-sina*cosb*tcorr[1]-sina*sinb*tcorr[0]
+                    elif jj==4:
+                        crap = cosa*sinb*tcorr[4]-cosa*cosb*tcorr[3]+sina*sinb*tcorr[1]-sina*cosb*tcorr[0]
+                    elif jj==5:
+                        crap = cosa*tcorr[5]+sina*tcorr[2]
+                    elif jj==6:
+                        crap = sina*cosb*tcorr[4]+sina*sinb*tcorr[3]-cosa*cosb*tcorr[1]-cosa*sinb*tcorr[0]
+                    elif jj==7:
+                        crap = -sina*sinb*tcorr[4]+sina*cosb*tcorr[3]+cosa*sinb*tcorr[1]-cosa*cosb*tcorr[0]
+                    else:
+                        crap = -sina*tcorr[5]+cosa*tcorr[2]
+
+                    #--------evaluate the SNR of the signal at target period range-------
+                    #new_parameters = noise_module.get_SNR(crap,snr_parameters,parameters)
+
+                    #------save the time domain cross-correlation functions-----
+                    data_type = 'Allstacked'
+                    path = rtz_components[jj]
+                    stack_ds.add_auxiliary_data(data=crap, data_type=data_type, path=path, parameters=new_parameters)
+
+            stack_ds.close()
             del corr,ampmax,nflag,ngood
 
 t4=time.time()
@@ -2,6 +2,7 @@ import os
 import glob
 import datetime
 import copy
+import functools
 import matplotlib.pyplot as plt
 from numba import jit
 import pyasdf
@@ -16,6 +17,7 @@ from obspy.signal.regression import linear_regression
 from obspy.signal.invsim import cosine_taper
 import obspy
 from obspy.signal.util import _npts2nfft
+from obspy.core.util.base import _get_function_from_entry_point
 from obspy.core.inventory import Inventory, Network, Station, Channel, Site
 
 
@@ -705,6 +707,140 @@ def optimized_correlate1(fft1_smoothed_abs,fft2,maxlag,dt,Nfft,nwin,method="cros
     
     return ncorr
 
+class CCFWriter(object):
+    '''
+    this class buffers the cross-correlation functions (or their stacks) that go into one ASDF file
+    and writes them in bulk. the file is opened once on the first flush and held open until close,
+    so each station pair costs a python append instead of an HDF5 open/close and metadata flush. it
+    follows the add_auxiliary_data interface of pyasdf and can be used in a with statement like 
+    ASDFDataSet. (used in S1, S2 and version_optimize_IO/S3A&S3B)
+    PARAMETERS:
+    ---------------------
+    h5file:    path of the ASDF file to write into
+    max_bytes: size (in bytes) of the data buffered in memory before they are flushed to the file
+    logfile:   opened text file to record 'data_type path' of each item once it is on disk (optional)
+    '''
+    def __init__(self,h5file,max_bytes=100*1024**2,logfile=None):
+        self.h5file    = h5file
+        self.max_bytes = max_bytes
+        self.logfile   = logfile
+        self.ds        = None
+        self.buffer    = []
+        self.nbytes    = 0
+        self.nwrite    = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+        return False
+
+    def add_auxiliary_data(self,data,data_type,path,parameters):
+        '''
+        keep one item in the buffer and flush the buffer when it exceeds max_bytes. data and 
+        parameters are copied as the main scripts reuse their arrays and dicts for the next pair
+        '''
+        data = np.array(data)
+        self.buffer.append((data,data_type,path,copy.deepcopy(parameters)))
+        self.nbytes += data.nbytes
+        if self.nbytes >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        '''
+        write all buffered items into the ASDF file and record them in the logfile
+        '''
+        if not len(self.buffer):return
+        if self.ds is None:
+            self.ds = pyasdf.ASDFDataSet(self.h5file,mpi=False)
+        for data,data_type,path,parameters in self.buffer:
+            self.ds.add_auxiliary_data(data=data,data_type=data_type,path=path,parameters=parameters)
+        self.ds.flush()
+        if self.logfile is not None:
+            for data,data_type,path,parameters in self.buffer:
+                self.logfile.write(data_type+' '+path+'\n')
+            self.logfile.flush()
+        self.nwrite += len(self.buffer)
+        self.buffer  = []
+        self.nbytes  = 0
+
+    def close(self):
+        '''
+        flush the remaining items and close the ASDF file
+        '''
+        self.flush()
+        if self.ds is not None:
+            # pyasdf closes the underlying HDF5 file once the dataset is released
+            del self.ds
+            self.ds = None
+
+@functools.lru_cache(maxsize=16)
+def taper_window(npts,max_len=20):
+    '''
+    this function returns the hann taper window used in taper: 5% of npts on each side but at most
+    max_len points. the windows are cached for each npts so that the taper function is not looked
+    up and rebuilt for every segment
+    PARAMETERS:
+    ---------------------
+    npts:    number of points of the window
+    max_len: max number of points of the taper on each side
+    RETURNS:
+    ---------------------
+    win: read-only 1D taper window
+    '''
+    wlen = int(np.minimum(int(npts*0.05),max_len))
+    func = _get_function_from_entry_point('taper', 'hann')
+    if 2*wlen == npts:
+        taper_sides = func(2*wlen)
+    else:
+        taper_sides = func(2*wlen+1)
+    win = np.hstack((taper_sides[:wlen], np.ones(npts-2*wlen),taper_sides[len(taper_sides) - wlen:]))
+    win.flags.writeable = False
+    return win
+
+@jit(nopython = True)
+def demean_detrend_taper(data,win):
+    '''
+    this Numba compiled function removes the mean and the linear trend of each row of a 2D matrix and 
+    applies the taper window in place, with two passes over each row: the first one sums the data for
+    the least-squares line (same fit as the QR in detrend, solved in closed form with the sample index
+    centered on the middle of the row) and the second one removes the line and tapers. the 
+    amplitude statistics for data selection are collected on the way. (used in cut_trace_make_statis)
+    PARAMETERS:
+    ---------------------
+    data: 2D matrix of the segments (modified in place)
+    win:  1D taper window with the length of the rows (see taper_window)
+    RETURNS:
+    ---------------------
+    stats: 2D matrix of (nseg,3) with the max amplitude of each raw segment, the max amplitude after
+           demean/detrend and the number of non-zero points after demean/detrend
+    '''
+    nseg,npts = data.shape
+    stats = np.zeros((nseg,3))
+    kc  = (npts-1)/2.
+    skk = float(npts)*(float(npts)**2-1)/12.
+    for ii in range(nseg):
+        # sums for the mean and trend, and max of the raw data
+        s0 = 0.;s1 = 0.;amax = 0.
+        for kk in range(npts):
+            xx = data[ii,kk]
+            s0 += xx;s1 += (kk-kc)*xx
+            if abs(xx)>amax:amax = abs(xx)
+        slope = 0.
+        if skk>0:slope = s1/skk
+        inter = s0/npts-slope*kc
+
+        # remove the line and taper
+        amax1 = 0.;nzero = 0
+        for kk in range(npts):
+            xx = data[ii,kk]-(inter+slope*kk)
+            if abs(xx)>amax1:amax1 = abs(xx)
+            if xx!=0:nzero += 1
+            data[ii,kk] = xx*win[kk]
+        stats[ii,0] = amax;stats[ii,1] = amax1;stats[ii,2] = nzero
+    return stats
+
 @jit('float32[:](float32[:],int16)')
 def moving_ave(A,N):
     '''
@@ -0,0 +1,73 @@
+import os
+import sys
+import time
+import h5py
+import tempfile
+import numpy as np
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'../../src'))
+import noise_module
+
+'''
+this script compares the two output formats of S1 for one time chunk with many station pairs: the ASDF
+file of CCFWriter (one auxiliary dataset with its dict of parameters per station pair and component) and
+the columnar file of ColumnarCCFWriter (one chunked 2D dataset per component for all pairs plus a table of
+the pairs). it reports the time to write, the file size and number of HDF5 objects, the time to open and
+list the file (as make_ccf_index does), to read all pairs and to read a lag window of all pairs through
+CCFReader. the data and parameters read from both files should be identical
+'''
+
+nsta   = 45                                            # 45 stations -> 1035 station pairs
+nseg   = 4
+dt     = 0.05
+maxlag = 20
+comps  = ['BHE','BHN','BHZ']
+rootdir = tempfile.mkdtemp()
+np.random.seed(0)
+npts = int(2*maxlag/dt)+1
+cc_para = {'dt':dt,'maxlag':maxlag,'substack':True,'cc_method':'coherency'}
+
+# synthetic cross-correlation functions of one chunk (same items for both writers)
+stas  = ['XX.S%02d'%ii for ii in range(nsta)]
+lons  = -120+np.random.rand(nsta);lats = 35+np.random.rand(nsta)
+items = []
+for ii in range(nsta):
+    for jj in range(ii,nsta):
+        coor = {'lonS':lons[ii],'latS':lats[ii],'lonR':lons[jj],'latR':lats[jj]}
+        for c1 in comps:
+            for c2 in comps:
+                parameters = noise_module.cc_parameters(cc_para,coor,np.arange(nseg)*1800.,np.ones(nseg,dtype=np.int16),c1[-1]+c2[-1])
+                items.append((np.random.randn(nseg,npts).astype(np.float32),stas[ii]+'_'+stas[jj],c1+'_'+c2,parameters))
+
+def count_objects(h5file):
+    nobj = [0]
+    def visit(name):nobj[0]+=1
+    with h5py.File(h5file,'r') as f:f.visit(visit)
+    return nobj[0]
+
+files = {}
+for name,writer in [('asdf',noise_module.CCFWriter),('columnar',noise_module.ColumnarCCFWriter)]:
+    files[name] = os.path.join(rootdir,name+'.h5')
+    t0=time.time()
+    with writer(files[name]) as ds:
+        for data,data_type,path,parameters in items:
+            ds.add_auxiliary_data(data=data,data_type=data_type,path=path,parameters=parameters)
+    t1=time.time()
+    info = noise_module.ccf_file_datasets(files[name])
+    t2=time.time()
+    with noise_module.CCFReader(files[name]) as reader:
+        res = [reader.read(pair,path) for pair,path,tseg,tpts in info]
+    t3=time.time()
+    with noise_module.CCFReader(files[name]) as reader:
+        win = [noise_module.read_ccf_window(reader,pair,path,[5,15]).data for pair,path,tseg,tpts in info]
+    t4=time.time()
+    print('%-8s: write %6.2fs, %6.2f MB in %6d HDF5 objects, open and list %6.3fs, read %6.2fs, read lags 5-15s %6.2fs (%d CCFs)'%\
+        (name,t1-t0,os.path.getsize(files[name])/1024**2,count_objects(files[name]),t2-t1,t3-t2,t4-t3,len(info)))
+    if name == 'asdf':
+        ref = {(pair,path):(tdata,tpara,twin) for (pair,path,tseg,tpts),(tdata,tpara),twin in zip(info,res,win)}
+    else:
+        same = len(ref)==len(info)
+        for (pair,path,tseg,tpts),(tdata,tpara),twin in zip(info,res,win):
+            rdata,rpara,rwin = ref[(pair,path)]
+            same &= np.array_equal(rdata,tdata) and np.array_equal(rwin,twin) and sorted(rpara)==sorted(tpara)
+            same &= all([np.array_equal(rpara[key],tpara[key]) for key in rpara])
+        print('identical data and parameters %s'%same)
@@ -0,0 +1,90 @@
+import os
+import sys
+import time
+import glob
+import pyasdf
+import tempfile
+import numpy as np
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'../../src'))
+import noise_module
+
+'''
+this script compares three ways to load all cross-correlation functions of each station pair for stacking
+in S2, on synthetic time-major CCF files of S1 (one ASDF file per chunk): opening every file for every pair
+as done before, opening only the files with the pair from the index of make_ccf_index, and reading the
+pair-major file of transpose_ccf in one read. it also times the update of the pair-major files for a new
+chunk (its rows are appended) against their first transposition. the loaded arrays should be identical
+'''
+
+nchunk = 30
+nsta   = 6
+npts   = 801
+nseg   = 20
+comps  = ['BHE','BHN','BHZ']
+rootdir = tempfile.mkdtemp()
+np.random.seed(0)
+
+# synthetic CCF files (one pair misses a chunk)
+stas  = ['XX.S%02d'%ii for ii in range(nsta)]
+pairs = [stas[ii]+'_'+stas[jj] for ii in range(nsta) for jj in range(ii,nsta)]
+t0=time.time()
+for ick in range(nchunk):
+    with noise_module.CCFWriter(os.path.join(rootdir,'chunk_%03d.h5'%ick)) as ds:
+        for pair in pairs:
+            if pair==pairs[1] and ick==3:continue
+            for c1 in comps:
+                for c2 in comps:
+                    parameters = {'dt':0.05,'maxlag':20,'comp':c1[-1]+c2[-1],'time':ick*86400+np.arange(nseg)*450.,\
+                        'ngood':np.random.randint(1,5,nseg).astype(np.int16)}
+                    ds.add_auxiliary_data(data=np.random.randn(nseg,npts).astype(np.float32),data_type=pair,\
+                        path=c1+'_'+c2,parameters=parameters)
+ccfiles = sorted(glob.glob(os.path.join(rootdir,'*.h5')))
+print('%d files of %d pairs written in %6.2fs'%(nchunk,len(pairs),time.time()-t0))
+
+def load_pair(pair,files):
+    # loading of S2 before: every file is opened and the missing pairs are skipped
+    out = []
+    for ifile in files:
+        ds = pyasdf.ASDFDataSet(ifile,mpi=False,mode='r')
+        try:
+            path_list = ds.auxiliary_data[pair].list()
+        except Exception:
+            continue
+        for tpath in path_list:
+            out.append((ds.auxiliary_data[pair][tpath].data[:],ds.auxiliary_data[pair][tpath].parameters['time']))
+    return np.concatenate([tdata for tdata,ttime in out]),np.concatenate([ttime for tdata,ttime in out])
+
+t0=time.time()
+ref = {pair:load_pair(pair,ccfiles) for pair in pairs}
+t1=time.time()
+print('all files for each pair  : %6.2fs (%d file opens)'%(t1-t0,len(pairs)*len(ccfiles)))
+
+t0=time.time()
+cindex = noise_module.make_ccf_index(ccfiles,os.path.join(rootdir,'ccf_index.txt'))
+pair_files = cindex.groupby('pair')['file'].unique()
+t1=time.time()
+res = {pair:load_pair(pair,pair_files[pair]) for pair in pairs}
+t2=time.time()
+same = all([np.array_equal(ref[pair][0],res[pair][0]) and np.array_equal(ref[pair][1],res[pair][1]) for pair in pairs])
+print('indexed files of the pair: %6.2fs (index %6.2fs), identical %s'%(t2-t1,t1-t0,same))
+
+t0=time.time()
+for sta in stas:
+    noise_module.transpose_ccf(cindex,[pair for pair in pairs if pair.startswith(sta+'_')],os.path.join(rootdir,sta+'.pairs'),3)
+t1=time.time()
+res = {pair:noise_module.read_pair_ccf(os.path.join(rootdir,pair.split('_')[0]+'.pairs'),pair) for pair in pairs}
+t2=time.time()
+same = all([np.array_equal(ref[pair][0],res[pair][0]) and np.array_equal(ref[pair][1],res[pair][1]) for pair in pairs])
+print('pair-major files         : %6.2fs (transpose %6.2fs), identical %s'%(t2-t1,t1-t0,same))
+
+# pair-major files of all chunks but the last one, then updated with the last chunk
+cindex0 = cindex[cindex['file']!=ccfiles[-1]]
+for sta in stas:
+    noise_module.transpose_ccf(cindex0,[pair for pair in pairs if pair.startswith(sta+'_')],os.path.join(rootdir,sta+'.update'),3)
+t0=time.time()
+for sta in stas:
+    noise_module.transpose_ccf(cindex,[pair for pair in pairs if pair.startswith(sta+'_')],os.path.join(rootdir,sta+'.update'),3)
+t1=time.time()
+res = {pair:noise_module.read_pair_ccf(os.path.join(rootdir,pair.split('_')[0]+'.update'),pair) for pair in pairs}
+same = all([np.array_equal(ref[pair][0],res[pair][0]) and np.array_equal(ref[pair][1],res[pair][1]) for pair in pairs])
+print('pair-major files updated for 1 new chunk: %6.2fs, identical %s'%(t1-t0,same))
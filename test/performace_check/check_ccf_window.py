@@ -0,0 +1,79 @@
+import os
+import sys
+import time
+import glob
+import h5py
+import tempfile
+import numpy as np
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'../../src'))
+import noise_module
+
+'''
+this script compares the full reads of the cross-correlation functions (.data[:] then cutting the lags)
+with the lag-window reads of noise_module.read_ccf_window, on synthetic CCF files of S1 (one ASDF file per
+chunk, compressed HDF5 chunks), their pair-major files of transpose_ccf and stacks of S2. it reports the
+bytes of the selections and the bytes stored in the HDF5 chunks read for both. the arrays should be identical
+'''
+
+nchunk = 10
+nsta   = 4
+dt     = 0.05
+maxlag = 200
+nseg   = 40
+lag_range = [-60,-20]                                  # coda window to read (s)
+comps  = ['BHE','BHN','BHZ']
+rootdir = tempfile.mkdtemp()
+np.random.seed(0)
+npts = int(2*maxlag/dt)+1
+
+# synthetic CCF files of S1 and stacks of S2
+stas  = ['XX.S%02d'%ii for ii in range(nsta)]
+pairs = [stas[ii]+'_'+stas[jj] for ii in range(nsta) for jj in range(ii,nsta)]
+for ick in range(nchunk):
+    with noise_module.CCFWriter(os.path.join(rootdir,'chunk_%03d.h5'%ick)) as ds:
+        for pair in pairs:
+            for c1 in comps:
+                for c2 in comps:
+                    parameters = {'dt':dt,'maxlag':maxlag,'comp':c1[-1]+c2[-1],'time':ick*86400+np.arange(nseg)*450.,\
+                        'ngood':np.ones(nseg,dtype=np.int16)}
+                    ds.add_auxiliary_data(data=np.random.randn(nseg,npts).astype(np.float32),data_type=pair,\
+                        path=c1+'_'+c2,parameters=parameters)
+for pair in pairs:
+    with noise_module.CCFWriter(os.path.join(rootdir,pair+'.stack')) as ds:
+        for c1 in 'ENZ':
+            for c2 in 'ENZ':
+                parameters = {'dt':dt,'maxlag':maxlag,'dist':10.,'ngood':nseg,'time':0.}
+                ds.add_auxiliary_data(data=np.random.randn(npts).astype(np.float32),data_type='Allstack_linear',\
+                    path=c1+c2,parameters=parameters)
+ccfiles = sorted(glob.glob(os.path.join(rootdir,'chunk_*.h5')))
+cindex  = noise_module.make_ccf_index(ccfiles,os.path.join(rootdir,'ccf_index.txt'))
+for sta in stas:
+    noise_module.transpose_ccf(cindex,[pair for pair in pairs if pair.startswith(sta+'_')],os.path.join(rootdir,sta+'.pairs'),3)
+indx1,indx2 = noise_module.lag_window(dt,maxlag,lag_range)
+
+def read_full(h5file,group,path):
+    # full read of the dataset and its stored bytes, then the lags are cut as done before
+    with h5py.File(h5file,'r') as f:
+        if 'AuxiliaryData' in f:
+            dset = f['AuxiliaryData'][group][path]
+            data = dset[:]
+        else:
+            dset = f[group]['data']
+            data = dset[:][f[group]['comp'][:].astype(str)==path]
+        nbyte = dset.size*dset.dtype.itemsize,dset.id.get_storage_size()
+    return data[...,indx1:indx2],nbyte
+
+tests = [('S1 chunk files',[(ff,pair,'BHZ_BHZ') for ff in ccfiles for pair in pairs]),\
+         ('pair-major files',[(os.path.join(rootdir,pair.split('_')[0]+'.pairs'),pair,'ZZ') for pair in pairs]),\
+         ('S2 stacks',[(os.path.join(rootdir,pair+'.stack'),'Allstack_linear','ZZ') for pair in pairs])]
+for name,reads in tests:
+    t0=time.time()
+    ref = [read_full(*tread) for tread in reads]
+    t1=time.time()
+    stats = {}
+    res = [noise_module.read_ccf_window(h5file,group,path,lag_range,stats=stats) for h5file,group,path in reads]
+    t2=time.time()
+    same = all([np.array_equal(tref[0],tres.data) for tref,tres in zip(ref,res)])
+    full = np.sum([tref[1] for tref in ref],axis=0)
+    print('%-16s: full reads %6.3fs (%6.2f MB, %6.2f MB stored), window reads %6.3fs (%6.2f MB, %6.2f MB stored), identical %s'%\
+        (name,t1-t0,full[0]/1024**2,full[1]/1024**2,t2-t1,stats['read']/1024**2,stats['stored_read']/1024**2,same))
@@ -0,0 +1,69 @@
+import os
+import sys
+import time
+import glob
+import pyasdf
+import numpy as np
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'../../src'))
+import noise_module
+
+'''
+this script compares the write throughput of the buffered CCFWriter with the pattern used before
+in S1, which opens the ASDF file for every station pair, on synthetic cross-correlation functions.
+it also checks that the two files hold the same data
+'''
+
+# synthetic ccfs of a small array with 9 components
+nsta  = 12
+npair = nsta*(nsta+1)//2
+nseg  = 1                           # number of substacks in each ccf
+npts  = 2001
+comps = ['BHE','BHN','BHZ']
+np.random.seed(0)
+ccfs  = np.random.randn(nseg,npts).astype(np.float32)
+parameters = {'dt':0.2,'maxlag':200,'dist':np.float32(10),'azi':np.float32(0),'baz':np.float32(180),\
+    'ngood':np.ones(nseg,dtype=np.int16),'cc_method':'raw','time':np.arange(nseg)*1800.,'substack':True,'comp':'ZZ'}
+
+tdir = os.path.join(os.path.dirname(os.path.abspath(__file__)),'ccf_writer_tmp')
+if not os.path.isdir(tdir):os.mkdir(tdir)
+for tfile in glob.glob(os.path.join(tdir,'*.h5')):os.remove(tfile)
+
+def all_items():
+    for ii in range(nsta):
+        for jj in range(ii,nsta):
+            data_type = 'XX.S%02d_XX.S%02d'%(ii,jj)
+            for c1 in comps:
+                for c2 in comps:
+                    yield data_type,c1+'_'+c2
+
+# open the file for each pair
+t0=time.time()
+for data_type,path in all_items():
+    with pyasdf.ASDFDataSet(os.path.join(tdir,'pair.h5'),mpi=False) as ds:
+        ds.add_auxiliary_data(data=ccfs,data_type=data_type,path=path,parameters=parameters)
+t1=time.time()
+
+# buffered writer with different byte budgets
+tbuf = []
+for max_bytes in [0,10*1024**2,1024**3]:
+    tfile = os.path.join(tdir,'buffer_%d.h5'%max_bytes)
+    t2=time.time()
+    with noise_module.CCFWriter(tfile,max_bytes) as ds:
+        for data_type,path in all_items():
+            ds.add_auxiliary_data(data=ccfs,data_type=data_type,path=path,parameters=parameters)
+    tbuf.append((max_bytes,time.time()-t2,tfile))
+
+nbytes = npair*len(comps)**2*ccfs.nbytes/1024**2
+print('%d pairs, %d ccfs, %6.1f MB'%(npair,npair*len(comps)**2,nbytes))
+print('open per pair:       %6.3fs (%6.1f MB/s)'%(t1-t0,nbytes/(t1-t0)))
+with pyasdf.ASDFDataSet(os.path.join(tdir,'pair.h5'),mpi=False,mode='r') as ds1:
+    for max_bytes,tt,tfile in tbuf:
+        same = True
+        with pyasdf.ASDFDataSet(tfile,mpi=False,mode='r') as ds2:
+            for data_type,path in all_items():
+                same = same and np.array_equal(ds1.auxiliary_data[data_type][path].data[:],ds2.auxiliary_data[data_type][path].data[:])
+        print('buffer %8.1f MB:   %6.3fs (%6.1f MB/s), identical %s'%(max_bytes/1024**2,tt,nbytes/tt,same))
+
+# clean up
+for tfile in glob.glob(os.path.join(tdir,'*.h5')):os.remove(tfile)
+os.rmdir(tdir)
@@ -0,0 +1,50 @@
+import os
+import sys
+import time
+import numpy as np
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'../../src'))
+import noise_module
+
+'''
+this script compares the block-wise cross-correlation (correlate_block) with the pair-by-pair
+correlate function used before in S1. it checks that the outputs are identical and compares
+the computational time of the two on synthetic spectra
+'''
+
+# synthetic spectra for a small array
+nsta  = 24
+nwin  = 44
+Nfft  = 9000
+Nfft2 = Nfft//2
+np.random.seed(0)
+spec = (np.random.randn(nsta,nwin,Nfft2)+1j*np.random.randn(nsta,nwin,Nfft2)).astype(np.complex64)
+good = np.random.rand(nsta,nwin)>0.05
+dataS_t = np.tile(np.arange(nwin)*450.,(nsta,1))
+
+for cc_method in ['raw','coherency','deconv']:
+    for substack,substack_len in [(True,1800),(True,3600),(False,1800)]:
+        D = {'dt':0.2,'maxlag':200,'cc_method':cc_method,'cc_len':1800,'substack':substack,\
+            'substack_len':substack_len,'smoothspect_N':10,'MAX_MEM':4.0}
+        sfft = np.zeros(spec.shape,dtype=np.complex64)
+        for ii in range(nsta):
+            sfft[ii] = noise_module.smooth_source_spect(D,spec[ii].reshape(spec[ii].size)).reshape(nwin,Nfft2)
+        pairs = np.array([[ii,jj] for ii in range(nsta) for jj in range(ii,nsta)])
+
+        # pair by pair
+        t0=time.time()
+        res1 = []
+        for iS,iR in pairs:
+            bb = np.where(good[iS]&good[iR])[0]
+            res1.append(noise_module.correlate(sfft[iS][bb],spec[iR][bb],D,Nfft,dataS_t[iR][bb]))
+        t1=time.time()
+
+        # all pairs in one block
+        res2 = noise_module.correlate_block(sfft,spec,pairs,D,Nfft,dataS_t,good,good)
+        t2=time.time()
+
+        same = True
+        for r1,r2 in zip(res1,res2):
+            for x,y in zip(r1,r2):
+                same = same and np.array_equal(np.asarray(x),np.asarray(y))
+        print('%-9s substack %-5s (%4ds): pairs %6.3fs, block %6.3fs, identical %s' % \
+            (cc_method,substack,substack_len,t1-t0,t2-t1,same))
@@ -0,0 +1,74 @@
+import os
+import sys
+import time
+import obspy
+import tracemalloc
+import numpy as np
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'../../src'))
+import noise_module
+
+'''
+this script compares the time and peak memory of cut_trace_make_statis using strided views of the
+trace (and a reused buffer for the segments) with the segment-by-segment copy used before, on a
+day-long 100 Hz trace. it also checks the outputs against the copy version (the fused kernel of
+demean/detrend/taper differs from the QR detrend at the float32 rounding level)
+'''
+
+def cut_trace_copy(fc_para,source):
+    # the segment-by-segment version used before in S1
+    inc_hours = fc_para['inc_hours']
+    cc_len    = fc_para['cc_len']
+    step      = fc_para['step']
+    nseg = int(np.floor((inc_hours/24*86400-cc_len)/step))
+    sps  = int(source[0].stats.sampling_rate)
+    starttime = source[0].stats.starttime-obspy.UTCDateTime(1970,1,1)
+    data = source[0].data
+    all_stdS = np.std(data)
+    npts = cc_len*sps
+    trace_stdS = np.zeros(nseg,dtype=np.float32)
+    dataS    = np.zeros(shape=(nseg,npts),dtype=np.float32)
+    dataS_t  = np.zeros(nseg,dtype=np.float64)
+    indx1 = 0
+    for iseg in range(nseg):
+        indx2 = indx1+npts
+        dataS[iseg] = data[indx1:indx2]
+        trace_stdS[iseg] = (np.max(np.abs(dataS[iseg]))/all_stdS)
+        dataS_t[iseg]    = starttime+step*iseg
+        indx1 = indx1+step*sps
+    dataS = noise_module.demean(dataS)
+    dataS = noise_module.detrend(dataS)
+    dataS = noise_module.taper(dataS)
+    return trace_stdS,dataS_t,dataS
+
+# day-long 100 Hz trace
+sps = 100
+np.random.seed(0)
+tr = obspy.Trace(data=np.random.randn(86400*sps).astype(np.float32))
+tr.stats.sampling_rate = sps
+tr.stats.starttime = obspy.UTCDateTime(2016,7,1)
+source = obspy.Stream(traces=[tr])
+fc_para = {'inc_hours':24,'cc_len':1800,'step':450}
+
+# compile the numba kernel before timing
+noise_module.cut_trace_make_statis(fc_para,source)
+
+out = []
+for name in ['copy','strided','strided+buffer']:
+    buf = None
+    if name == 'strided+buffer':
+        buf = noise_module.cut_trace_make_statis(fc_para,source)[2]
+    tracemalloc.start()
+    t0=time.time()
+    if name == 'copy':
+        res = cut_trace_copy(fc_para,source)
+    else:
+        res = noise_module.cut_trace_make_statis(fc_para,source,buf)
+    t1=time.time()
+    peak = tracemalloc.get_traced_memory()[1]/1024**2
+    tracemalloc.stop()
+    out.append(res)
+    diff = np.max(np.abs(out[0][2]-res[2]))/np.max(np.abs(out[0][2]))
+    same = np.array_equal(out[0][0],res[0]) and np.array_equal(out[0][1],res[1])
+    print('%-15s: %6.3fs, peak memory %7.1f MB (trace %5.1f MB), same stats %s, max relative diff %5.2e'%\
+        (name,t1-t0,peak,tr.data.nbytes/1024**2,same,diff))
+    del res
@@ -1,4 +1,5 @@
 import os
+import sys
 import glob
 import obspy
 import scipy
@@ -9,9 +10,14 @@ from numba import jit
 from scipy import signal
 import matplotlib.pyplot as plt
 from obspy.core.util.base import _get_function_from_entry_point
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'../../src'))
+import noise_module
 
 '''
-check efficiency of detrend, demean
+check efficiency of detrend, demean and taper: obspy functions on sliding windows, the functions
+below applied row by row on the 2D matrix of segments, and the fused numba kernel of noise_module
+(demean_detrend_taper), which also returns the segment statistics. a synthetic day-long trace is
+used when no sac files are found
 '''
 
 def detrend(data):
@@ -130,17 +136,14 @@ def test_1d(sacfile):
     t3=time.time()
     print('1D: it takes %6.3f in total with %6.3f %6.3f and %6.3f for new'%(t3-t0,t1-t0,t2-t1,t3-t2))
 
-def test_2d(sacfile):
+def test_2d(tr):
     '''
+    performance check with 2d data
     '''
     # parameters for obspy function
     cc_len = 3600
     step   = 900
-
-    # read data
-    tr = obspy.read(sacfile)
-    tdata = tr[0].data
-    ndata = tr[0].data
+    tdata  = tr[0].data.copy()
 
     # sliding
     t0=time.time()
@@ -164,6 +167,8 @@ def test_2d(sacfile):
         dataS[iseg] = tdata[indx1:indx2]
         indx1 = indx1+step*sps
 
+    fdata = dataS.copy()
+
     t2=time.time()
     dataS = demean(dataS)
     dataS = detrend(dataS)
@@ -172,12 +177,28 @@ def test_2d(sacfile):
 
     print('2D: it takes %6.3f (%d traces) in total with new'%(t3-t2,dataS.shape[0]))
 
+    # fused kernel (compiled on a small matrix first)
+    win = noise_module.taper_window(npts)
+    noise_module.demean_detrend_taper(fdata[:1,:100].copy(),win[:100])
+    t4=time.time()
+    stats = noise_module.demean_detrend_taper(fdata,win)
+    t5=time.time()
+    diff  = np.max(np.abs(fdata-dataS))/np.max(np.abs(dataS))
+    print('2D: it takes %6.3f (%d traces) in total with fused kernel, max relative diff %5.2e'%(t5-t4,fdata.shape[0],diff))
+
 def main():
     sfiles = glob.glob('/Users/chengxin/Documents/Harvard/Kanto_basin/Mesonet_BW/noise_data/Event_2010_340/*.sac')
 
+    if not len(sfiles):
+        # synthetic day-long 20 Hz trace
+        np.random.seed(0)
+        tr = obspy.Trace(data=np.cumsum(np.random.randn(86400*20)).astype(np.float32))
+        tr.stats.sampling_rate = 20
+        test_2d(obspy.Stream(traces=[tr]))
+
     for sacfile in sfiles:
         #test_1d(sacfile)
-        test_2d(sacfile)
+        test_2d(obspy.read(sacfile))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
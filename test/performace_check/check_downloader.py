@@ -0,0 +1,133 @@
+import io
+import os
+import sys
+import time
+import obspy
+import threading
+import numpy as np
+import urllib.parse
+from fnmatch import fnmatch
+from http.server import BaseHTTPRequestHandler,ThreadingHTTPServer
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'../../src'))
+import noise_module
+from obspy.clients.fdsn import Client
+from obspy.core.inventory import Inventory,Network,Station,Channel,Site
+
+'''
+this script compares the threaded bulk downloading of noise_module.BulkDownloader with the station by
+station requests used before in S0A, against a local FDSN server started in this script. the server
+serves synthetic miniSEED and StationXML through the station and dataselect services (GET and POST
+for the bulk requests), answers each request after a fixed latency to mimic a data center, and can
+fail a fraction of the requests to check the retries. the downloaded streams should be identical
+'''
+
+nsta    = 12
+chans   = ['BHE','BHN','BHZ']
+sps     = 20
+latency = 0.2                                          # waiting time (s) of the server for each request
+s1 = obspy.UTCDateTime(2016,7,1)
+s2 = s1+2*3600
+
+def make_trace(net,sta,cha):
+    # synthetic data fixed by the channel name
+    rng = np.random.default_rng(abs(hash((net,sta,cha)))%2**32)
+    tr  = obspy.Trace(data=rng.standard_normal(int((s2-s1)*sps)).astype(np.float32))
+    tr.stats.network,tr.stats.station,tr.stats.location,tr.stats.channel = net,sta,'00',cha
+    tr.stats.sampling_rate = sps
+    tr.stats.starttime = s1
+    return tr
+
+stations = ['S%02d'%ii for ii in range(nsta)]
+traces   = {('XX',sta,cha):make_trace('XX',sta,cha) for sta in stations for cha in chans}
+
+def make_inventory(keys):
+    inv = Inventory(networks=[],source='fake')
+    net = Network(code='XX',stations=[])
+    for ii,sta in enumerate(stations):
+        if not any([fnmatch(sta,key[1]) for key in keys]):continue
+        tsta = Station(code=sta,latitude=35+0.1*ii,longitude=-120,elevation=10.,site=Site(name=sta))
+        for cha in chans:
+            tsta.channels.append(Channel(code=cha,location_code='00',latitude=35+0.1*ii,longitude=-120,\
+                elevation=10.,depth=0,azimuth=0,dip=0,sample_rate=sps))
+        net.stations.append(tsta)
+    inv.networks.append(net)
+    return inv if len(net.stations) else None
+
+class FakeFDSN(BaseHTTPRequestHandler):
+    fail_every = 0
+    count = 0
+    lock  = threading.Lock()
+
+    def log_message(self,*args):
+        pass
+
+    def answer(self,service,keys):
+        time.sleep(latency)
+        with FakeFDSN.lock:
+            FakeFDSN.count += 1
+            fail = FakeFDSN.fail_every and FakeFDSN.count%FakeFDSN.fail_every==0
+        if fail:
+            self.send_response(503);self.end_headers();return
+        buf = io.BytesIO()
+        if service == 'station':
+            inv = make_inventory(keys)
+            if inv is not None:inv.write(buf,format='STATIONXML')
+        else:
+            st = obspy.Stream()
+            for key in keys:
+                st += obspy.Stream([tr for (net,sta,cha),tr in traces.items() if \
+                    fnmatch(sta,key[1]) and fnmatch(cha,key[3])])
+            if len(st):st.write(buf,format='MSEED')
+        if not buf.tell():
+            self.send_response(204);self.end_headers();return
+        self.send_response(200)
+        self.send_header('Content-Length',str(buf.tell()))
+        self.end_headers()
+        self.wfile.write(buf.getvalue())
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        par = dict(urllib.parse.parse_qsl(url.query))
+        key = (par.get('network','*'),par.get('station','*'),par.get('location','*'),par.get('channel','*'))
+        self.answer(url.path.split('/')[2],[key])
+
+    def do_POST(self):
+        url  = urllib.parse.urlparse(self.path)
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+        keys = [tuple(line.split()[:4]) for line in body.splitlines() if len(line.split())==6]
+        self.answer(url.path.split('/')[2],keys)
+
+server = ThreadingHTTPServer(('127.0.0.1',0),FakeFDSN)
+threading.Thread(target=server.serve_forever,daemon=True).start()
+client = Client('http://127.0.0.1:%d'%server.server_port,_discover_services=False)
+
+def download_seq():
+    # station by station requests used before in S0A
+    out = {}
+    for sta in stations:
+        for cha in chans:
+            inv = client.get_stations(network='XX',station=sta,location='*',starttime=s1,endtime=s2,level='response')
+            out[(sta,cha)] = (inv,client.get_waveforms(network='XX',station=sta,location='*',channel=cha,starttime=s1,endtime=s2))
+    return out
+
+def download_bulk(nthread,bulk_size):
+    out = {}
+    requests = [((sta,cha),'XX',sta,'*',cha) for sta in stations for cha in chans]
+    with noise_module.BulkDownloader(client,nthread,bulk_size,retries=3,backoff=0.1) as downloader:
+        for indx,inv,st in downloader.fetch(requests,s1,s2):
+            out[indx] = (inv,st)
+    return out
+
+t0=time.time()
+ref = download_seq()
+print('station by station      : %6.2fs for %d channels'%(time.time()-t0,len(ref)))
+
+for fail_every in [0,5]:
+    FakeFDSN.fail_every = fail_every
+    for nthread,bulk_size in [(1,1),(4,1),(1,12),(4,6)]:
+        t0=time.time()
+        res = download_bulk(nthread,bulk_size)
+        same = all([np.array_equal(ref[key][1][0].data,res[key][1][0].data) and \
+            len(res[key][0][0][0].channels)==len(chans) for key in ref])
+        print('%d threads, bulk of %2d : %6.2fs, failing every %d requests, identical %s'%(nthread,bulk_size,time.time()-t0,fail_every,same))
+server.shutdown()
@@ -0,0 +1,45 @@
+import os
+import sys
+import time
+import scipy
+import numpy as np
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'../../src'))
+import noise_module
+from scipy.fftpack import next_fast_len
+
+'''
+this script compares the single precision fft backend of noise_module (fft_forward/fft_inverse on
+scipy.fft with fft_workers threads) with the double precision scipy.fftpack path: throughput of the
+forward fft of the noise segments plus the ifft of the cross-spectra, and the accuracy of the
+resulting cross-correlation functions
+'''
+
+# synthetic segments of two stations sharing a common noise source (20 Hz, 1800 s)
+nseg = 44
+npts = 36000
+np.random.seed(0)
+common = np.random.randn(nseg,npts+50).astype(np.float32)
+dataS1 = common[:,:npts]+0.5*np.random.randn(nseg,npts).astype(np.float32)
+dataS2 = common[:,50:]+0.5*np.random.randn(nseg,npts).astype(np.float32)
+Nfft   = int(next_fast_len(npts))
+nbytes = 2*dataS1.nbytes/1024**2
+
+# double precision reference
+t0=time.time()
+fft1 = scipy.fftpack.fft(dataS1.astype(np.float64),Nfft,axis=1)
+fft2 = scipy.fftpack.fft(dataS2.astype(np.float64),Nfft,axis=1)
+ref  = np.real(scipy.fftpack.ifft(np.conj(fft1)*fft2,Nfft,axis=1))
+t1=time.time()
+print('double fftpack     : %6.3fs (%7.1f MB/s)'%(t1-t0,nbytes/(t1-t0)))
+
+for real_fft in [False,True]:
+    for workers in [1,2,4]:
+        fft_para = {'real_fft':real_fft,'fft_workers':workers}
+        t0=time.time()
+        fft1 = noise_module.fft_forward(fft_para,dataS1,Nfft,axis=1)
+        fft2 = noise_module.fft_forward(fft_para,dataS2,Nfft,axis=1)
+        corr = np.real(noise_module.fft_inverse(fft_para,np.conj(fft1)*fft2,Nfft,axis=1))
+        t1=time.time()
+        diff = np.max(np.abs(corr-ref))/np.max(np.abs(ref))
+        print('single %-5s %d thr: %6.3fs (%7.1f MB/s), %s, max relative diff %5.2e'%\
+            ('rfft' if real_fft else 'fft',workers,t1-t0,nbytes/(t1-t0),fft1.dtype,diff))
@@ -0,0 +1,47 @@
+import os
+import sys
+import time
+import obspy
+import numpy as np
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'../../src'))
+import noise_module
+from obspy.signal.filter import bandpass
+
+'''
+this script compares the polyphase resampling path of preprocess_raw (resample_poly then bandpass at
+the targeted sampling rate) with the bandpass at the raw sampling rate followed by obspy interpolate,
+on day-long traces of two sines plus noise, including a start time between the sampling points
+'''
+
+samp_freq = 20
+pre_filt  = [0.045,0.05,2,2.2]
+np.random.seed(0)
+
+for sps,off in [(100,0),(100,0.013),(40,0),(200,0)]:
+    npts = int(86400*sps)
+    tt   = np.arange(npts)/sps+off
+    tr = obspy.Trace(data=(np.sin(2*np.pi*0.5*tt)+np.sin(2*np.pi*1.3*tt)+0.1*np.random.randn(npts)).astype(np.float32))
+    tr.stats.sampling_rate = sps
+    tr.stats.starttime = obspy.UTCDateTime(2016,7,1)+off
+
+    # bandpass and interpolation
+    t0=time.time()
+    tr1 = tr.copy()
+    tr1.data = np.float32(bandpass(tr1.data,pre_filt[0],pre_filt[-1],df=sps,corners=4,zerophase=True))
+    tr1.interpolate(samp_freq,method='weighted_average_slopes')
+    t1=time.time()
+
+    # polyphase resampling and bandpass
+    tr2 = tr.copy()
+    up,down = noise_module.resample_ratio(sps,samp_freq)
+    tr2 = noise_module.poly_resample(tr2,samp_freq,up,down)
+    tr2.data = np.float32(bandpass(tr2.data,pre_filt[0],pre_filt[-1],df=samp_freq,corners=4,zerophase=True))
+    t2=time.time()
+
+    # misfit to the sines on the new samples (away from the edges)
+    tt  = np.arange(tr1.stats.npts)/samp_freq+off
+    ref = np.sin(2*np.pi*0.5*tt)+np.sin(2*np.pi*1.3*tt)
+    mis1 = np.std((tr1.data-ref)[2000:-2000])
+    mis2 = np.std((tr2.data-ref)[2000:-2000])
+    print('%3d Hz offset %5.3fs: interpolate %6.3fs, polyphase %6.3fs (%d/%d), npts %d %d, misfit %5.3f %5.3f'%\
+        (sps,off,t1-t0,t2-t1,up,down,tr1.stats.npts,tr2.stats.npts,mis1,mis2))
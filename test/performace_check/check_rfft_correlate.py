@@ -0,0 +1,44 @@
+import os
+import sys
+import time
+import numpy as np
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'../../src'))
+import noise_module
+
+'''
+this script checks the numerical equivalence of the real-FFT path (rfft in noise_processing/whiten
+and irfft in correlate) with the full complex fft path used in S1, and compares the time spent
+by the two paths on synthetic noise segments
+'''
+
+# synthetic segments of two stations sharing a common noise source
+nseg = 44
+npts = 9000
+np.random.seed(0)
+common = np.random.randn(nseg,npts+50).astype(np.float32)
+dataS1 = common[:,:npts]+0.5*np.random.randn(nseg,npts).astype(np.float32)
+dataS2 = common[:,50:]+0.5*np.random.randn(nseg,npts).astype(np.float32)
+dataS_t = np.arange(nseg)*450.
+
+for time_norm,to_whiten,cc_method in [('no','no','raw'),('no','no','coherency'),('no','no','deconv'),\
+    ('one_bit','no','raw'),('running_mean','running_mean','raw'),('no','one_bit','raw')]:
+    for substack,substack_len in [(True,1800),(False,1800)]:
+        fft_para = {'dt':0.2,'freqmin':0.05,'freqmax':2,'smooth_N':10,'time_norm':time_norm,'to_whiten':to_whiten,\
+            'maxlag':200,'cc_method':cc_method,'cc_len':1800,'substack':substack,'substack_len':substack_len,\
+            'smoothspect_N':10}
+        Nfft = int(noise_module.next_fast_len(npts));Nfft2 = Nfft//2
+
+        corrs = [];ts = []
+        for real_fft in [False,True]:
+            fft_para['real_fft'] = real_fft
+            t0=time.time()
+            fft1 = noise_module.noise_processing(fft_para,dataS1.copy())[:,:Nfft2].astype(np.complex64)
+            fft2 = noise_module.noise_processing(fft_para,dataS2.copy())[:,:Nfft2].astype(np.complex64)
+            sfft1 = noise_module.smooth_source_spect(fft_para,fft1.reshape(fft1.size)).reshape(nseg,Nfft2)
+            corr,tcorr,ncorr = noise_module.correlate(sfft1,fft2,fft_para,Nfft,dataS_t)
+            ts.append(time.time()-t0)
+            corrs.append(corr)
+
+        diff = np.max(np.abs(corrs[0]-corrs[1]))/np.max(np.abs(corrs[0]))
+        print('%-12s %-12s %-9s substack %-5s: fft %6.3fs, rfft %6.3fs, max relative diff %5.2e' % \
+            (time_norm,to_whiten,cc_method,substack,ts[0],ts[1],diff))
@@ -0,0 +1,103 @@
+import os
+import sys
+import time
+import numpy as np
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'../../src'))
+import noise_module
+from scipy.fftpack import next_fast_len
+
+'''
+this script compares the compiled running mean kernels and the cached whitening tapers used in
+noise_processing/whiten with the row-by-row moving_ave and the tapers rebuilt at every call used
+before, on a day of segments (1800 s at 20 Hz with a step of 450 s). each part is timed on its own
+(best of nrepeat runs, as the timings of a shared machine are noisy) and the whole whitening after it.
+the outputs should be identical
+'''
+
+def time_norm_rows(dataS,smooth_N):
+    # running mean normalization used before
+    white = np.zeros(shape=dataS.shape,dtype=dataS.dtype)
+    for kkk in range(dataS.shape[0]):
+        white[kkk,:] = dataS[kkk,:]/noise_module.moving_ave(np.abs(dataS[kkk,:]),smooth_N)
+    return white
+
+def whiten_rows(data,fft_para):
+    # 2D whitening used before
+    smooth_N  = fft_para['smooth_N']
+    to_whiten = fft_para['to_whiten']
+    Nfft = int(next_fast_len(int(data.shape[1])))
+    low,left,right,high = noise_module.freq_band_index(fft_para,Nfft)
+    FFTRawSign = noise_module.fft_forward(fft_para,data,Nfft,axis=1)
+    FFTRawSign[:,0:low] *= 0
+    FFTRawSign[:,low:left] = np.cos(
+        np.linspace(np.pi / 2., np.pi, left - low)) ** 2 * np.exp(
+        1j * np.angle(FFTRawSign[:,low:left]))
+    if to_whiten=='one_bit':
+        FFTRawSign[:,left:right] = np.exp(1j * np.angle(FFTRawSign[:,left:right]))
+    elif to_whiten == 'running_mean':
+        for ii in range(data.shape[0]):
+            tave = noise_module.moving_ave(np.abs(FFTRawSign[ii,left:right]),smooth_N)
+            FFTRawSign[ii,left:right] = FFTRawSign[ii,left:right]/tave
+    FFTRawSign[:,right:high] = np.cos(
+        np.linspace(0., np.pi / 2., high - right)) ** 2 * np.exp(
+        1j * np.angle(FFTRawSign[:,right:high]))
+    FFTRawSign[:,high:Nfft//2] *= 0
+    if not fft_para.get('real_fft',False):
+        FFTRawSign[:,-(Nfft//2)+1:] = np.flip(np.conj(FFTRawSign[:,1:(Nfft//2)]),axis=1)
+    return FFTRawSign
+
+# a day of 1800 s segments at 20 Hz
+nseg = 189
+npts = 36000
+np.random.seed(0)
+dataS = np.random.randn(nseg,npts).astype(np.float32)
+fft_para = {'dt':0.05,'freqmin':0.05,'freqmax':2,'smooth_N':10,'to_whiten':'running_mean','real_fft':True}
+
+nrepeat = 20
+
+def best_time(func,*args):
+    tt = []
+    for ii in range(nrepeat):
+        t0=time.time();res = func(*args);tt.append(time.time()-t0)
+    return np.min(tt),res
+
+def smooth_rows(data,smooth_N):
+    # running mean of the whitening band used before
+    return np.array([noise_module.moving_ave(data[ii],smooth_N) for ii in range(data.shape[0])])
+
+def band_rebuilt(Nfft,fft_para):
+    # band indexes and tapers computed at every call as before
+    low,left,right,high = noise_module.freq_band_index(fft_para,Nfft)
+    return low,left,right,high,np.cos(np.linspace(np.pi / 2., np.pi, left - low)) ** 2,np.cos(np.linspace(0., np.pi / 2., high - right)) ** 2
+
+def band_cached(Nfft,fft_para):
+    return noise_module.whiten_band(Nfft,fft_para['dt'],fft_para['freqmin'],fft_para['freqmax'])
+
+# compile the numba functions first
+noise_module.moving_ave(np.abs(dataS[0,:100]),10)
+noise_module.moving_ave_2d(np.abs(dataS[:1,:100]),10)
+noise_module.running_mean_norm(dataS[:1,:100],10)
+
+t1,white1 = best_time(time_norm_rows,dataS,fft_para['smooth_N'])
+t2,white2 = best_time(noise_module.running_mean_norm,dataS,fft_para['smooth_N'])
+print('time_norm running_mean: rows %6.3fs, 2D %6.3fs, identical %s'%(t1,t2,np.array_equal(white1,white2)))
+
+Nfft = int(next_fast_len(npts))
+low,left,right,high = noise_module.freq_band_index(fft_para,Nfft)
+band = np.abs(noise_module.fft_forward(fft_para,white1,Nfft,axis=1)[:,left:right])
+t1,smooth1 = best_time(smooth_rows,band,fft_para['smooth_N'])
+t2,smooth2 = best_time(noise_module.moving_ave_2d,band,fft_para['smooth_N'])
+print('running mean of the whitening band (%d points): rows %6.3fs, 2D %6.3fs, identical %s'%(right-left,t1,t2,np.array_equal(smooth1,smooth2)))
+
+t1,taper1 = best_time(band_rebuilt,Nfft,fft_para)
+t2,taper2 = best_time(band_cached,Nfft,fft_para)
+print('whitening band and tapers: rebuilt %8.6fs, cached %8.6fs, identical %s'%(t1,t2,all([np.array_equal(x1,x2) for x1,x2 in zip(taper1,taper2)])))
+
+for real_fft in [True,False]:
+    for to_whiten in ['running_mean','one_bit']:
+        fft_para['real_fft'] = real_fft
+        fft_para['to_whiten'] = to_whiten
+        t1,spec1 = best_time(whiten_rows,white1,fft_para)
+        t2,spec2 = best_time(noise_module.whiten,white1,fft_para)
+        print('whiten %-12s %-5s: rows %6.3fs, 2D %6.3fs, identical %s'%(to_whiten,'rfft' if real_fft else 'fft',\
+            t1,t2,np.array_equal(spec1,spec2)))